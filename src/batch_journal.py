@@ -0,0 +1,81 @@
+import json
+import time
+import threading
+import logging
+from pathlib import Path
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# job status in the journal
+SEARCHED = "searched"
+NO_MATCHES = "no_matches"
+DONE = "done"
+FAILED = "failed"
+
+
+def job_key(usi_or_lib_id, precursor_mz_tol, mz_tol, min_cos, libraries=None):
+    """
+    :param libraries: list of searched libraries. None: the default library
+    :return: key of a job that changes with the query and any search parameter. The reference data of the rendering
+    are not part of the key, they are recorded as the render_hash of finished jobs
+    """
+    key = "{}|{}|{}|{}".format(usi_or_lib_id, float(precursor_mz_tol), float(mz_tol), float(min_cos))
+    if libraries is not None:
+        key = "{}|{}".format(key, ",".join(libraries))
+    return key
+
+
+class JobJournal:
+    """
+    Append-only journal (one json object per line) of the batch job states. Records of the same job key are merged so
+    that later records update earlier ones, e.g., the matches of a search are kept when the rendering fails.
+    """
+
+    def __init__(self, journal_file):
+        """
+        :param journal_file: the jsonl file, is created if it does not exist
+        """
+        self.journal_file = journal_file
+        self._lock = threading.Lock()
+        self._jobs = {}
+        if Path(journal_file).exists():
+            with open(journal_file, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # incomplete last line after a crash
+                        logger.warning("Skipping corrupt journal line in {}".format(journal_file))
+                        continue
+                    self._jobs.setdefault(record["key"], {}).update(record)
+            logger.info("Loaded {} jobs from journal {}".format(len(self._jobs), journal_file))
+
+    def get(self, key):
+        """
+        :return: the merged state of a job or None
+        """
+        with self._lock:
+            state = self._jobs.get(key)
+            return None if state is None else dict(state)
+
+    def states(self):
+        """
+        :return: dict of {key: merged state} of all jobs
+        """
+        with self._lock:
+            return {key: dict(state) for key, state in self._jobs.items()}
+
+    def record(self, key, status, **fields):
+        """
+        Appends a record and flushes it to disk
+        :param key: the job key, see job_key
+        :param status: SEARCHED, NO_MATCHES, DONE, or FAILED
+        :param fields: additional json serializable fields
+        """
+        record = dict(fields, key=key, status=status, time=time.time())
+        line = json.dumps(record)
+        with self._lock:
+            with open(self.journal_file, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+            self._jobs.setdefault(key, {}).update(record)
@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import logging
+from pathlib import Path
+
+import bundle_to_html
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def time_bundle(repeats, **kwargs):
+    best = None
+    for _ in range(repeats):
+        # overwriting a file can trigger a flush (e.g., ext4 auto_da_alloc), only time the bundling
+        if os.path.exists(kwargs["output_html"]):
+            os.remove(kwargs["output_html"])
+        start = time.perf_counter()
+        bundle_to_html.build_dist_html(**kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_benchmark(in_html="collapsible_tree_v3.html", in_data="../data/microbe_masst/ncbi.json", repeats=3,
+                  out_dir=None):
+    """
+    Times build_dist_html with compression: minifying the whole html, with a cold and a warm minified assets cache,
+    and with the precompiled template
+    :param in_data: the tree data json that is inserted into the html
+    :return: dict of runtimes in seconds
+    """
+    out_dir = out_dir or tempfile.mkdtemp()
+    out_html = os.path.join(out_dir, "benchmark.html")
+    data_json = json.dumps(json.loads(Path(in_data).read_text()), separators=(",", ":"))
+    cache_dir = tempfile.mkdtemp()
+
+    results = {"data_bytes": len(data_json)}
+    results["no_cache_s"] = time_bundle(repeats, input_html=in_html, output_html=out_html, compress=True,
+                                        data_json=data_json, minify_cache_dir=None)
+    results["cold_cache_s"] = time_bundle(1, input_html=in_html, output_html=out_html, compress=True,
+                                          data_json=data_json, minify_cache_dir=cache_dir)
+    results["warm_cache_s"] = time_bundle(repeats, input_html=in_html, output_html=out_html, compress=True,
+                                          data_json=data_json, minify_cache_dir=cache_dir)
+    results["precompiled_s"] = time_bundle(repeats, input_html=in_html, output_html=out_html, compress=True,
+                                           data_json=data_json, minify_cache_dir=cache_dir, precompiled=True)
+    results["speedup_warm_cache"] = results["no_cache_s"] / results["warm_cache_s"]
+    return results
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Benchmark bundling a compressed html file with and without the '
+                                                 'minified assets cache')
+    parser.add_argument('--in_html', type=str, help='The input html file', default="collapsible_tree_v3.html")
+    parser.add_argument('--in_data', type=str, help='tree data json that is inserted',
+                        default="../data/microbe_masst/ncbi.json")
+    parser.add_argument('--repeats', type=int, help='repeats (best time is reported)', default=3)
+    parser.add_argument('--out_json', type=str, help='export results to this json file', default=None)
+    args = parser.parse_args()
+
+    try:
+        results = run_benchmark(args.in_html, args.in_data, args.repeats)
+        print(json.dumps(results, indent=2))
+        if args.out_json is not None:
+            with open(args.out_json, "w") as file:
+                json.dump(results, file, indent=2)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
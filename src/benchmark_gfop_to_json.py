@@ -0,0 +1,101 @@
+import argparse
+import contextlib
+import filecmp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import logging
+
+import gfop_to_json
+from benchmark_pipeline import write_synthetic_owl
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def measure(function, input_file, output_file, trace_memory=False):
+    """
+    :param trace_memory: measure the peak memory with tracemalloc (slows down the conversion)
+    :return: the runtime in seconds or the peak traced memory in MB. Printed output is discarded
+    """
+    # overwriting a file can trigger a flush (e.g., ext4 auto_da_alloc), only time the conversion
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        function(input_file, output_file)
+        elapsed = time.perf_counter() - start
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return peak / 1024 / 1024
+    return elapsed
+
+
+def compare_converters(input_file, out_dir):
+    """
+    Converts an ontology with convert_to_json (pronto and anytree, debug printing discarded) and convert_to_json_fast.
+    Runtimes are measured without tracemalloc, the peak memory in a separate run
+    :return: dict with the runtimes, peak memory, and whether both outputs are equal
+    """
+    old_json = os.path.join(out_dir, "old.json")
+    fast_json = os.path.join(out_dir, "fast.json")
+    result = {"input": input_file, "input_bytes": os.path.getsize(input_file)}
+    result["old_s"] = measure(gfop_to_json.convert_to_json, input_file, old_json)
+    result["fast_s"] = measure(gfop_to_json.convert_to_json_fast, input_file, fast_json)
+    result["old_peak_mb"] = measure(gfop_to_json.convert_to_json, input_file, old_json, trace_memory=True)
+    result["fast_peak_mb"] = measure(gfop_to_json.convert_to_json_fast, input_file, fast_json, trace_memory=True)
+    result["speedup"] = result["old_s"] / result["fast_s"]
+    result["equal_output"] = filecmp.cmp(old_json, fast_json, shallow=False)
+    logger.info(result)
+    return result
+
+
+def run_benchmark(input_files=("../data/GFOP.owl", "../data/global_foodomics_ontology.obo"), synthetic_depths=(4, 5),
+                  fan_out=8):
+    """
+    Compares both converters on the input files and on synthetic owl ontologies
+    :param synthetic_depths: depths of balanced synthetic ontologies (see benchmark_pipeline.write_synthetic_owl)
+    :return: list of result dicts
+    """
+    out_dir = tempfile.mkdtemp()
+    try:
+        results = [compare_converters(input_file, out_dir) for input_file in input_files]
+        for depth in synthetic_depths:
+            owl_file = os.path.join(out_dir, "synthetic_{}_{}.owl".format(depth, fan_out))
+            write_synthetic_owl(depth, fan_out, owl_file)
+            results.append(compare_converters(owl_file, out_dir))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Compare runtime and memory of the owl/obo to json converters')
+    parser.add_argument('--inputs', type=str, nargs="+", help='owl or obo files',
+                        default=["../data/GFOP.owl", "../data/global_foodomics_ontology.obo"])
+    parser.add_argument('--depths', type=int, nargs="*", help='depths of synthetic ontologies', default=[4, 5])
+    parser.add_argument('--fan_out', type=int, help='children per node of the synthetic ontologies', default=8)
+    parser.add_argument('--out_json', type=str, help='export results to this json file', default=None)
+    args = parser.parse_args()
+
+    try:
+        results = run_benchmark(args.inputs, args.depths, args.fan_out)
+        print(json.dumps(results, indent=2))
+        if args.out_json is not None:
+            with open(args.out_json, "w") as file:
+                json.dump(results, file, indent=2)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
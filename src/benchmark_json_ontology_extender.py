@@ -0,0 +1,237 @@
+import argparse
+import copy
+import json
+import sys
+import time
+import logging
+
+import numpy as np
+import pandas as pd
+
+import json_ontology_extender
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def create_synthetic_tree(depth, fan_out, node_key="NCBI"):
+    """
+    Creates a balanced tree with numbered ids
+    :param depth: number of levels below the root
+    :param fan_out: number of children per node
+    :param node_key: field that holds the id of each node
+    :return: the root node and the number of nodes
+    """
+    root = {"name": "root", node_key: "0"}
+    level = [root]
+    n_nodes = 1
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            parent["children"] = []
+            for _ in range(fan_out):
+                child = {"name": "node_{}".format(n_nodes), node_key: str(n_nodes)}
+                parent["children"].append(child)
+                next_level.append(child)
+                n_nodes += 1
+        level = next_level
+    return root, n_nodes
+
+
+def create_synthetic_data(n_rows, n_nodes, data_key="ncbi", seed=42):
+    """
+    Creates a data table with random node ids (some do not exist in the tree)
+    :param n_rows: number of rows
+    :param n_nodes: number of nodes in the tree, ids are drawn from [0, 2*n_nodes)
+    :param data_key: column with the ids
+    :return: data frame with ids as strings
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        data_key: rng.integers(0, 2 * n_nodes, n_rows).astype(str),
+        "matched_size": rng.integers(1, 100, n_rows),
+        "group_size": rng.integers(100, 200, n_rows),
+    })
+    return df
+
+
+def add_data_to_node_by_scan(node, df, node_field, data_field):
+    """
+    Reference implementation that filters the whole data frame for every node (the former add_data_to_node)
+    """
+    ncbi = node.get(node_field)
+    if ncbi is not None:
+        filtered = df[df[data_field] == str(ncbi)]
+        if len(filtered) > 0:
+            rowi = filtered.index[0]
+            for col, value in df.items():
+                if col != data_field:
+                    node[col] = value[rowi]
+    if "children" in node:
+        for child in node["children"]:
+            add_data_to_node_by_scan(child, df, node_field, data_field)
+
+
+def add_indexed_data_to_node_recursive(node, data_index, node_field):
+    """
+    Reference implementation of the indexed merge with a recursive walk (the former add_indexed_data_to_node)
+    """
+    ncbi = node.get(node_field)
+    if ncbi is None:
+        logger.warning("node has no id {}".format(node.get("name", "NONAME")))
+    else:
+        row = data_index.get(str(ncbi))
+        if row is not None:
+            node.update(row)
+    if "children" in node:
+        for child in node["children"]:
+            add_indexed_data_to_node_recursive(child, data_index, node_field)
+
+
+def accumulate_field_in_parents(node, field):
+    """
+    Reference implementation of FlatTree.accumulate (the former recursive sum)
+    """
+    node_value = node.get(field, 0)
+    if "children" in node:
+        for child in node["children"]:
+            node_value += accumulate_field_in_parents(child, field)
+    node[field] = node_value
+    return node_value
+
+
+def field_missing(node, field, replace_with_field=None):
+    """
+    Reference implementation that counts the nodes without the field (the former recursive check)
+    """
+    missing = 0
+    if node.get(field, None) is None:
+        if replace_with_field is not None:
+            node[field] = node.get(replace_with_field, "")
+        missing = 1
+    if "children" in node:
+        for child in node["children"]:
+            missing += field_missing(child, field)
+    return missing
+
+
+def calc_stats(node):
+    if "children" in node:
+        for child in node["children"]:
+            calc_stats(child)
+    if node["group_size"] == 0:
+        node["occurrence_fraction"] = 0
+    else:
+        node["occurrence_fraction"] = node["matched_size"] / node["group_size"]
+
+
+def add_pie_data_to_node_and_children(node):
+    json_ontology_extender.add_pie_data_to_node(node)
+    if "children" in node:
+        for child in node["children"]:
+            add_pie_data_to_node_and_children(child)
+
+
+def add_data_to_ontology_recursive(treeRoot, df, node_key="name", data_key="group_value"):
+    """
+    Reference implementation with one recursive walk per step (the former add_data_to_ontology)
+    """
+    df = df.assign(**{data_key: df[data_key].astype(str)})
+    add_indexed_data_to_node_recursive(treeRoot, json_ontology_extender.build_data_index(df, data_key), node_key)
+    if field_missing(treeRoot, "NCBI", replace_with_field="name") > 0:
+        logger.debug("NCBI id is missing in a node")
+    if field_missing(treeRoot, "group_size") > 0:
+        accumulate_field_in_parents(treeRoot, "group_size")
+    if field_missing(treeRoot, "matched_size") > 0:
+        accumulate_field_in_parents(treeRoot, "matched_size")
+    calc_stats(treeRoot)
+    json_ontology_extender.calc_root_stats(treeRoot)
+    add_pie_data_to_node_and_children(treeRoot)
+    return treeRoot
+
+
+def time_merge(merge_function, tree, df, repeats):
+    best = None
+    result = None
+    for _ in range(repeats):
+        result = copy.deepcopy(tree)
+        start = time.perf_counter()
+        merge_function(result, df, "NCBI", "ncbi")
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_benchmark(depths=(2, 3, 4), fan_out=8, row_counts=(100, 1000, 10000), repeats=3, include_scan=True):
+    """
+    Times the indexed merge (and the former full scan) for increasing tree and data table sizes
+    :return: list of result dicts with the runtime in seconds
+    """
+    results = []
+    for depth in depths:
+        tree, n_nodes = create_synthetic_tree(depth, fan_out)
+        for n_rows in row_counts:
+            df = create_synthetic_data(n_rows, n_nodes)
+            indexed_time, indexed_tree = time_merge(json_ontology_extender.add_data_to_node, tree, df, repeats)
+            result = {"nodes": n_nodes, "rows": n_rows, "indexed_s": indexed_time}
+            if include_scan:
+                scan_time, scan_tree = time_merge(add_data_to_node_by_scan, tree, df, 1)
+                result["scan_s"] = scan_time
+                result["speedup"] = scan_time / indexed_time
+                result["equal_output"] = json.dumps(scan_tree, cls=json_ontology_extender.NpEncoder) == \
+                                         json.dumps(indexed_tree, cls=json_ontology_extender.NpEncoder)
+            logger.info(result)
+            results.append(result)
+    return results
+
+
+def run_aggregation_benchmark(depths=(2, 3, 4), fan_out=8, n_rows=1000, repeats=3):
+    """
+    Times the full aggregation of add_data_to_ontology (flat iterative passes) against the recursive walks
+    :return: list of result dicts with the runtime in seconds
+    """
+    results = []
+    for depth in depths:
+        tree, n_nodes = create_synthetic_tree(depth, fan_out)
+        # data only for the leaves so that the sizes are accumulated in the parents
+        df = create_synthetic_data(n_rows, n_nodes)
+        flat_time, flat_tree = time_merge(json_ontology_extender.add_data_to_ontology, tree, df, repeats)
+        recursive_time, recursive_tree = time_merge(add_data_to_ontology_recursive, tree, df, repeats)
+        result = {"nodes": n_nodes, "rows": n_rows, "flat_s": flat_time, "recursive_s": recursive_time,
+                  "speedup": recursive_time / flat_time,
+                  "equal_output": json.dumps(flat_tree, cls=json_ontology_extender.NpEncoder) ==
+                                  json.dumps(recursive_tree, cls=json_ontology_extender.NpEncoder)}
+        logger.info(result)
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Benchmark merging data into an ontology tree for increasing tree and '
+                                                 'data table sizes')
+    parser.add_argument('--depths', type=int, nargs="+", help='tree depths to benchmark', default=[2, 3, 4])
+    parser.add_argument('--fan_out', type=int, help='children per node', default=8)
+    parser.add_argument('--rows', type=int, nargs="+", help='data table sizes to benchmark',
+                        default=[100, 1000, 10000])
+    parser.add_argument('--repeats', type=int, help='repeats of the indexed merge (best time is reported)', default=3)
+    parser.add_argument('--skip_scan', action="store_true", help='do not run the slow full scan reference')
+    parser.add_argument('--out_json', type=str, help='export results to this json file', default=None)
+    args = parser.parse_args()
+
+    try:
+        results = run_benchmark(args.depths, args.fan_out, args.rows, args.repeats, not args.skip_scan)
+        print(pd.DataFrame(results).to_string(index=False))
+        aggregation_results = run_aggregation_benchmark(args.depths, args.fan_out, args.rows[-1], args.repeats)
+        print(pd.DataFrame(aggregation_results).to_string(index=False))
+        results = {"merge": results, "aggregation": aggregation_results}
+        if args.out_json is not None:
+            with open(args.out_json, "w") as file:
+                json.dump(results, file, indent=2)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
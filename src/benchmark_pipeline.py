@@ -0,0 +1,318 @@
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import logging
+from datetime import datetime
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+import bundle_to_html
+import gfop_to_json
+import json_ontology_extender
+import masst_utils
+import metadata_store
+import microbe_masst
+import microbe_masst_results
+import minify_cache
+from benchmark_json_ontology_extender import create_synthetic_tree
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+OWL_HEADER = """<?xml version="1.0"?>
+<rdf:RDF xmlns="urn:benchmark:ontology#"
+     xml:base="urn:benchmark:ontology"
+     xmlns:owl="http://www.w3.org/2002/07/owl#"
+     xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:xml="http://www.w3.org/XML/1998/namespace"
+     xmlns:xsd="http://www.w3.org/2001/XMLSchema#"
+     xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#">
+    <owl:Ontology rdf:about="urn:benchmark:ontology"/>
+"""
+OWL_CLASS = """
+    <owl:Class rdf:about="http://benchmark.org/{id}">{parent}
+        <rdfs:label>{name}</rdfs:label>
+    </owl:Class>
+"""
+OWL_PARENT = """
+        <rdfs:subClassOf rdf:resource="http://benchmark.org/{id}"/>"""
+
+
+def write_synthetic_owl(depth, fan_out, out_file):
+    """
+    Writes a balanced ontology as OWL (RDF/XML like the webprotege export of GFOP.owl)
+    :return: the number of classes
+    """
+    root, n_nodes = create_synthetic_tree(depth, fan_out)
+    with open(out_file, "w", encoding="utf-8") as file:
+        file.write(OWL_HEADER)
+        stack = [(root, None)]
+        while stack:
+            node, parent = stack.pop()
+            file.write(OWL_CLASS.format(id=node["NCBI"], name=node["name"],
+                                        parent="" if parent is None else OWL_PARENT.format(id=parent["NCBI"])))
+            stack.extend((child, node) for child in node.get("children", []))
+        file.write("</rdf:RDF>\n")
+    return n_nodes
+
+
+def create_synthetic_metadata(n_rows, n_nodes, n_datasets=100, seed=42):
+    """
+    Creates a microbeMASST metadata table with one file per row. Taxa are drawn from the node ids of a synthetic tree
+    (see create_synthetic_tree), some ids do not exist in the tree
+    :return: data frame with the columns Filepath, MassIVE, Taxa_NCBI
+    """
+    rng = np.random.default_rng(seed)
+    datasets = np.char.add("MSV", np.char.zfill(rng.integers(0, 10 ** 9, n_datasets).astype(str), 9))
+    massive = datasets[rng.integers(0, n_datasets, n_rows)]
+    samples = np.char.add("sample_", np.arange(n_rows).astype(str))
+    filepaths = pd.Series(massive).radd("f.").str.cat(pd.Series(samples), sep="/ccms_peak/").add(".mzML")
+    return pd.DataFrame({"Filepath": filepaths, "MassIVE": massive,
+                         "Taxa_NCBI": rng.integers(1, int(n_nodes * 1.1) + 2, n_rows)})
+
+
+def create_synthetic_usis(metadata_df, n_matches, seed=42):
+    """
+    :return: list of USIs that match random files of the metadata (files can match multiple times)
+    """
+    rng = np.random.default_rng(seed)
+    rows = metadata_df.iloc[rng.integers(0, len(metadata_df), n_matches)]
+    fnames = microbe_masst_results.filenames_from_paths(rows["Filepath"])
+    scans = rng.integers(1, 10000, n_matches).astype(str)
+    return ("mzspec:" + rows["MassIVE"] + ":" + fnames + ":scan:" + scans).tolist()
+
+
+def write_synthetic_masst_file(metadata_df, n_rows, out_file, seed=42):
+    """
+    Writes classical MASST results (tab separated) that match random files of the metadata
+    """
+    rng = np.random.default_rng(seed)
+    rows = metadata_df.iloc[rng.integers(0, len(metadata_df), n_rows)]
+    filenames = rows["Filepath"].to_numpy()
+    pd.DataFrame({
+        "basefilename": [name.rsplit("/", 1)[-1] for name in filenames],
+        "cluster_scan": rng.integers(1, 100000, n_rows),
+        "dataset_id": rows["MassIVE"].to_numpy(),
+        "filename": filenames,
+        "metadata": "|".join(["synthetic"] * 20),
+    }).to_csv(out_file, sep="\t", index=False)
+
+
+def stub_fast_masst(matching_usi_list):
+    """
+    :return: a replacement of masst_utils.fast_masst that returns the matches without a request
+    """
+    matches = [{"USI": usi, "Cosine": 0.9} for usi in matching_usi_list]
+
+    def fast_masst(usi_or_lib_id, precursor_mz_tol=0.05, mz_tol=0.02, min_cos=0.7,
+                   search_url=masst_utils.FAST_MASST_URL, libraries=None, max_retries=0):
+        return list(matches)
+
+    return fast_masst
+
+
+def time_call(repeats, output_files, function, *args, setup=None, **kwargs):
+    """
+    :param output_files: files written by the function, removed before each call because overwriting a file can
+    trigger a flush (e.g., ext4 auto_da_alloc)
+    :param setup: called before each call (not timed), e.g., to clear caches
+    :return: the best runtime in seconds. Printed output is discarded
+    """
+    best = None
+    for _ in range(repeats):
+        for output_file in output_files:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def time_cold_and_warm(timings, name, repeats, output_files, clear_caches, function, *args, **kwargs):
+    """
+    Times a call with empty caches (name_cold) and after a first call filled them (name_warm)
+    :param clear_caches: removes all caches that the function uses
+    """
+    timings[name + "_cold"] = time_call(repeats, output_files, function, *args, setup=clear_caches, **kwargs)
+    clear_caches()
+    time_call(1, output_files, function, *args, **kwargs)
+    timings[name + "_warm"] = time_call(repeats, output_files, function, *args, **kwargs)
+
+
+@contextlib.contextmanager
+def work_dir_caches(store_dir, minify_dir):
+    """
+    Redirects the metadata store from the user cache directory into the work directory. The minify cache is opt-in
+    and passed explicitly (minify_cache_dir)
+    :return: a function that clears both caches and the in-memory template and minify caches
+    """
+    def clear_caches():
+        shutil.rmtree(store_dir, ignore_errors=True)
+        shutil.rmtree(minify_dir, ignore_errors=True)
+        bundle_to_html.precompiled_templates.clear()
+        minify_cache.minify_caches.clear()
+
+    load_metadata = functools.partial(metadata_store.load_metadata, store_dir=store_dir)
+    with mock.patch.object(metadata_store, "load_metadata", load_metadata):
+        clear_caches()
+        try:
+            yield clear_caches
+        finally:
+            clear_caches()
+
+
+def run_benchmark(depth=4, fan_out=8, metadata_rows=100000, matches=5000, masst_rows=50000, repeats=3,
+                  in_html="collapsible_tree_v3.html", work_dir=None, seed=42):
+    """
+    Generates synthetic inputs and times each pipeline stage separately and the whole microbeMASST job end to end (with
+    a stubbed fast_masst, runs offline). Stages that use the metadata store or the minify cache are timed cold (empty
+    caches) and warm. Both caches are kept in the work directory
+    :param depth: levels of the synthetic ontology below the root
+    :param fan_out: children per node
+    :param metadata_rows: rows (files) of the metadata table
+    :param matches: matching USIs of the fastMASST stub
+    :param masst_rows: rows of the classical MASST file
+    :param work_dir: directory of the generated files. None: a temporary directory that is removed
+    :return: dict with the config, the input sizes, and the runtimes in seconds
+    """
+    config = {"depth": depth, "fan_out": fan_out, "metadata_rows": metadata_rows, "matches": matches,
+              "masst_rows": masst_rows, "repeats": repeats, "seed": seed}
+    temp_dir = work_dir is None
+    work_dir = tempfile.mkdtemp() if temp_dir else work_dir
+    os.makedirs(work_dir, exist_ok=True)
+
+    def path(name):
+        return os.path.join(work_dir, name)
+
+    try:
+        # synthetic inputs
+        tree_root, n_nodes = create_synthetic_tree(depth, fan_out)
+        with open(path("ontology.json"), "w") as file:
+            json.dump(tree_root, file)
+        write_synthetic_owl(depth, fan_out, path("ontology.owl"))
+        metadata_df = create_synthetic_metadata(metadata_rows, n_nodes, seed=seed)
+        metadata_df.to_csv(path("metadata.csv"), index=False)
+        usis = create_synthetic_usis(metadata_df, matches, seed)
+        write_synthetic_masst_file(metadata_df, masst_rows, path("masst.tsv"), seed)
+        sizes = {"nodes": n_nodes, "metadata_rows": metadata_rows, "matches": matches, "masst_rows": masst_rows}
+        sizes.update({"{}_bytes".format(name.replace(".", "_")): os.path.getsize(path(name))
+                      for name in ["ontology.json", "ontology.owl", "metadata.csv", "masst.tsv"]})
+
+        timings = {}
+        timings["metadata_store_build"] = time_call(1, [path("metadata.store.npz")], metadata_store.build_store,
+                                                    path("metadata.csv"), path("metadata.store.npz"))
+        timings["gfop_to_json.convert_to_json"] = time_call(1, [path("owl.json")], gfop_to_json.convert_to_json,
+                                                            path("ontology.owl"), path("owl.json"))
+
+        # cold: without the metadata store and the minified assets, warm: reusing them like later jobs of a batch
+        with work_dir_caches(path("metadata_store"), path("minify")) as clear_caches:
+            time_cold_and_warm(timings, "create_counts_file_from_usi", repeats, [path("usi_counts.tsv")],
+                               clear_caches, microbe_masst_results.create_counts_file_from_usi, path("metadata.csv"),
+                               usis, path("usi_counts.tsv"))
+            time_cold_and_warm(timings, "create_counts_file", repeats, [path("masst_counts.tsv")], clear_caches,
+                               microbe_masst_results.create_counts_file, path("metadata.csv"), path("masst.tsv"),
+                               path("masst_counts.tsv"))
+
+            timings["add_data_to_ontology_file"] = time_call(repeats, [path("merged.json")],
+                                                             json_ontology_extender.add_data_to_ontology_file,
+                                                             path("merged.json"), path("ontology.json"),
+                                                             path("usi_counts.tsv"), "NCBI", "ncbi", False)
+
+            data_json = json_ontology_extender.tree_to_compact_json(json_ontology_extender.load_ontology(
+                path("merged.json")))
+            sizes["tree_data_bytes"] = len(data_json)
+            time_cold_and_warm(timings, "build_dist_html", repeats, [path("tree.html")], clear_caches,
+                               bundle_to_html.build_dist_html, in_html, path("tree.html"), compress=True,
+                               data_json=data_json, minify_cache_dir=path("minify"))
+            time_cold_and_warm(timings, "build_dist_html_precompiled", repeats, [path("tree.html")], clear_caches,
+                               bundle_to_html.build_dist_html, in_html, path("tree.html"), compress=True,
+                               data_json=data_json, precompiled=True, minify_cache_dir=path("minify"))
+
+            # end to end with the default options and the optimized batch options
+            batch_options = {"precompiled_html": True, "compact_tree": True, "minify_cache_dir": path("minify")}
+            with mock.patch.object(masst_utils, "fast_masst", stub_fast_masst(usis)):
+                for name, options in [("end_to_end", {}), ("end_to_end_precompiled", batch_options)]:
+                    time_cold_and_warm(timings, name, repeats, [path("end_to_end.html")], clear_caches,
+                                       microbe_masst.run_microbe_masst, "mzspec:BENCHMARK:stub:scan:1",
+                                       in_html=in_html, in_ontology=path("ontology.json"),
+                                       metadata_file=path("metadata.csv"), out_html=path("end_to_end.html"),
+                                       format_out_json=False, **options)
+                    if not os.path.exists(path("end_to_end.html")):
+                        raise RuntimeError("End to end run failed, see the log")
+    finally:
+        if temp_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "numpy": np.__version__, "pandas": pd.__version__},
+        "config": config,
+        "sizes": sizes,
+        "timings_s": timings,
+    }
+
+
+def compare_results(baseline, results):
+    """
+    :param baseline: results of a previous run, see run_benchmark
+    :return: data frame with the runtimes of both runs and the ratio (results / baseline) per stage
+    """
+    rows = []
+    for stage, seconds in results["timings_s"].items():
+        baseline_seconds = baseline["timings_s"].get(stage)
+        rows.append({"stage": stage, "baseline_s": baseline_seconds, "s": seconds,
+                     "ratio": None if not baseline_seconds else seconds / baseline_seconds})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Benchmark the ontology and microbeMASST pipeline stages on synthetic '
+                                                 'inputs of configurable size (offline, fastMASST is stubbed)')
+    parser.add_argument('--depth', type=int, help='levels of the synthetic ontology below the root', default=4)
+    parser.add_argument('--fan_out', type=int, help='children per node', default=8)
+    parser.add_argument('--metadata_rows', type=int, help='rows (files) of the metadata table', default=100000)
+    parser.add_argument('--matches', type=int, help='matching USIs returned by the fastMASST stub', default=5000)
+    parser.add_argument('--masst_rows', type=int, help='rows of the classical MASST file', default=50000)
+    parser.add_argument('--repeats', type=int, help='repeats (best time is reported)', default=3)
+    parser.add_argument('--in_html', type=str, help='The input html file', default="collapsible_tree_v3.html")
+    parser.add_argument('--work_dir', type=str, help='keep the generated files in this directory. Default: temporary '
+                                                     'directory', default=None)
+    parser.add_argument('--seed', type=int, help='random seed of the generators', default=42)
+    parser.add_argument('--out_json', type=str, help='export results to this json file', default=None)
+    parser.add_argument('--compare', type=str, help='results json of a previous run to compare with', default=None)
+    args = parser.parse_args()
+
+    try:
+        results = run_benchmark(args.depth, args.fan_out, args.metadata_rows, args.matches, args.masst_rows,
+                                args.repeats, args.in_html, args.work_dir, args.seed)
+        print(json.dumps(results, indent=2))
+        if args.compare is not None:
+            with open(args.compare) as file:
+                print(compare_results(json.load(file), results).to_string(index=False))
+        if args.out_json is not None:
+            with open(args.out_json, "w") as file:
+                json.dump(results, file, indent=2)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
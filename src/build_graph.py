@@ -0,0 +1,377 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+import batch_journal
+import bundle_to_html
+import json_ontology_extender
+import metadata_store
+import microbe_masst_results
+import ontology_binary
+import pipeline_profile
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# changes invalidate all stages
+BUILD_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+
+
+def hash_values(*values):
+    """
+    :param values: json serializable values
+    :return: sha256 hex digest of the values
+    """
+    return hashlib.sha256(json.dumps(values).encode("utf-8")).hexdigest()
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hash_file(file):
+    """
+    :return: sha256 hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(file, "rb") as input_file:
+        for block in iter(lambda: input_file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass
+class Compound:
+    """
+    Input of one report: the matches of a classical MASST file or a list of matching USIs (fastMASST)
+    """
+    name: str
+    out_html: str
+    masst_file: Optional[str] = None
+    matching_usi_list: Optional[list] = None
+
+    @property
+    def build_id(self):
+        """
+        :return: identifies the stages and build files of this compound: the name and the hash of the report path, so
+        that compounds with the same name (e.g., MASST files with the same file name) do not collide
+        """
+        return "{}_{}".format(pipeline_profile.safe_name(self.name), hash_text(os.path.abspath(self.out_html))[:12])
+
+
+class BuildGraph:
+    """
+    Build state of the pipeline stages (ontology compile -> metadata index -> per compound counts -> merged tree ->
+    html bundle). Each stage is identified by a key and records the hash of its inputs and the hash of its output
+    content. A stage only runs if its input hash changed or its output file is missing. Downstream stages use the
+    output hashes as inputs, so a rebuilt stage with an unchanged output (e.g., equal counts after a metadata update)
+    does not trigger the following stages. The state is kept in a json manifest in the build directory.
+    """
+
+    def __init__(self, build_dir="dist/build"):
+        self.build_dir = Path(build_dir)
+        self.build_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_file = self.build_dir / MANIFEST_FILE
+        self.stages = {}
+        self.files = {}
+        if self.manifest_file.exists():
+            try:
+                with open(self.manifest_file, encoding="utf-8") as file:
+                    manifest = json.load(file)
+                if manifest.get("version") == BUILD_VERSION:
+                    self.stages = manifest["stages"]
+                    self.files = manifest["files"]
+            except ValueError:
+                logger.warning("Ignoring corrupt build manifest {}".format(self.manifest_file))
+        self.built = []
+        self.skipped = []
+
+    def path(self, *parts):
+        """
+        :return: a path in the build directory, parent directories are created
+        """
+        path = self.build_dir.joinpath(*parts)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def file_hash(self, file):
+        """
+        Content hash of a file. Hashes are reused while the size and modification time of a file are unchanged
+        :return: sha256 hex digest
+        """
+        file = os.path.abspath(file)
+        stat = os.stat(file)
+        cached = self.files.get(file)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hash_file(file)
+        self.files[file] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def run(self, key, input_hash, build, output_file=None):
+        """
+        Runs a stage if its inputs changed or its output file is missing
+        :param key: the stage key, e.g., tree:compound
+        :param input_hash: hash of all inputs, see hash_values
+        :param build: function that builds the output and returns the hash of the output content
+        :param output_file: the output file of the stage. None: the stage has no output file
+        :return: the output hash
+        """
+        record = self.stages.get(key)
+        if record is not None and record["input"] == input_hash \
+                and (output_file is None or Path(output_file).exists()):
+            self.skipped.append(key)
+            return record["output"]
+        output_hash = build()
+        self.stages[key] = {"input": input_hash, "output": output_hash,
+                            "file": None if output_file is None else str(output_file)}
+        self.built.append(key)
+        return output_hash
+
+    def save(self):
+        temp_file = "{}.{}.tmp".format(self.manifest_file, os.getpid())
+        with open(temp_file, "w", encoding="utf-8") as file:
+            json.dump({"version": BUILD_VERSION, "stages": self.stages, "files": self.files}, file)
+        os.replace(temp_file, self.manifest_file)
+
+
+def ontology_stage(graph, in_ontology, input_format=None):
+    """
+    Compiles the ontology (json, owl/obo, or ClassyFire) into the binary format in the build directory
+    :return: (output hash, binary ontology file). The output hash only depends on the tree, so that formatting changes
+    of the source do not trigger the following stages
+    """
+    out_file = graph.path("ontology" + ontology_binary.BINARY_SUFFIX)
+
+    def build():
+        tree_root = ontology_binary.read_source_tree(in_ontology, input_format)
+        ontology_binary.compile_tree(tree_root, str(out_file), source=in_ontology)
+        return hash_text(json.dumps(tree_root, sort_keys=True))
+
+    input_hash = hash_values("ontology", ontology_binary.VERSION, graph.file_hash(in_ontology), input_format)
+    return graph.run("ontology", input_hash, build, out_file), str(out_file)
+
+
+def metadata_stage(graph, metadata_file):
+    """
+    Builds the columnar metadata store (see metadata_store) in the build directory
+    :return: (output hash, store file)
+    """
+    store_file = graph.path("metadata" + metadata_store.STORE_SUFFIX)
+    input_hash = hash_values("metadata", metadata_store.STORE_VERSION, graph.file_hash(metadata_file))
+
+    def build():
+        metadata_store.build_store(metadata_file, str(store_file))
+        return input_hash
+
+    return graph.run("metadata", input_hash, build, store_file), str(store_file)
+
+
+def counts_stage(graph, compound, metadata_hash, metadata):
+    """
+    Counts the matches of a compound per taxon and writes them to the build directory
+    :param metadata: function that returns the prepared metadata (only called if the counts are rebuilt)
+    :return: (output hash, counts file)
+    """
+    counts_file = graph.path("counts", compound.build_id + ".tsv")
+    if compound.matching_usi_list is not None:
+        compound_hash = hash_values(sorted(compound.matching_usi_list))
+    else:
+        compound_hash = graph.file_hash(compound.masst_file)
+
+    def build():
+        if compound.matching_usi_list is not None:
+            counts_df = microbe_masst_results.count_matches_from_usi(metadata(), compound.matching_usi_list)
+        else:
+            counts_df = microbe_masst_results.count_matches_in_file(metadata(), compound.masst_file)
+        text = counts_df.to_csv(index=False, sep="\t")
+        counts_file.write_text(text, encoding="utf-8")
+        return hash_text(text)
+
+    input_hash = hash_values("counts", metadata_hash, compound_hash)
+    return graph.run("counts:" + compound.build_id, input_hash, build, counts_file), str(counts_file)
+
+
+def tree_stage(graph, compound, ontology_hash, counts_hash, counts_file, ontology, node_key="NCBI", data_key="ncbi",
+               pruned_tree=False, unmatched_siblings=0):
+    """
+    Merges the counts into the ontology and writes the compact tree json (see
+    json_ontology_extender.tree_to_compact_json) to the build directory
+    :param ontology: function that returns the ontology tree (only called if the tree is rebuilt), is not changed
+    :return: (output hash, tree json file)
+    """
+    tree_file = graph.path("trees", compound.build_id + ".json")
+
+    def build():
+        counts_df = pd.read_csv(counts_file, sep="\t")
+        tree_root = json_ontology_extender.add_data_to_ontology(json_ontology_extender.copy_tree(ontology()),
+                                                                counts_df, node_key, data_key, add_pie_data=False)
+        if pruned_tree:
+            tree_root = json_ontology_extender.prune_tree(tree_root, unmatched_siblings)
+        text = json_ontology_extender.tree_to_compact_json(tree_root)
+        tree_file.write_text(text, encoding="utf-8")
+        return hash_text(text)
+
+    input_hash = hash_values("tree", ontology_hash, counts_hash, node_key, data_key, pruned_tree, unmatched_siblings)
+    return graph.run("tree:" + compound.build_id, input_hash, build, tree_file), str(tree_file)
+
+
+def html_stage(graph, compound, tree_hash, tree_file, template_hash, in_html="collapsible_tree_v3.html",
+               compress_out_html=True, minify_cache_dir=None):
+    """
+    Inserts the tree json into the precompiled html (see bundle_to_html.build_dist_html)
+    :return: the output hash
+    """
+    def build():
+        Path(compound.out_html).parent.mkdir(parents=True, exist_ok=True)
+        bundle_to_html.build_dist_html(in_html, compound.out_html, compress=compress_out_html,
+                                       data_json=Path(tree_file).read_text(encoding="utf-8"), precompiled=True,
+                                       minify_cache_dir=minify_cache_dir)
+        return input_hash
+
+    input_hash = hash_values("html", tree_hash, template_hash, os.path.abspath(compound.out_html))
+    return graph.run("html:" + compound.build_id, input_hash, build, compound.out_html)
+
+
+def template_hash(in_html="collapsible_tree_v3.html", compress_out_html=True, minify_cache_dir=None):
+    """
+    :param minify_cache_dir: see bundle_to_html.get_precompiled_template
+    :return: hash of the precompiled html, changes with the html and all of its local JS and CSS files
+    """
+    template = bundle_to_html.get_precompiled_template(in_html, compress_out_html, minify_cache_dir)
+    return hash_values(template.prefix, template.suffix)
+
+
+def run_build(compounds, in_ontology="../data/microbe_masst/ncbi.json",
+              metadata_file="../data/microbe_masst/microbe_masst_table.csv", in_html="collapsible_tree_v3.html",
+              build_dir="dist/build", ontology_format=None, compress_out_html=True, node_key="NCBI",
+              data_key="ncbi", pruned_tree=False, unmatched_siblings=0):
+    """
+    Incrementally builds the html reports of many compounds. Only the stages with changed inputs run, e.g., an updated
+    metadata table recounts all compounds but only the compounds with changed counts get a new tree and html
+    :param compounds: list of Compound
+    :param build_dir: directory of the intermediate results and the build manifest
+    :param ontology_format: tree_json, owl, or classyfire. None: by file extension
+    :return: the BuildGraph with the built and skipped stages
+    """
+    start = time.perf_counter()
+    graph = BuildGraph(build_dir)
+    ontology_hash, ontology_file = ontology_stage(graph, in_ontology, ontology_format)
+    metadata_hash, store_file = metadata_stage(graph, metadata_file)
+    # the minified JS and CSS are cached with the other intermediate results
+    minify_cache_dir = os.path.join(build_dir, "minify")
+    html_hash = template_hash(in_html, compress_out_html, minify_cache_dir)
+
+    # reference data is only loaded if a stage needs it
+    loaded = {}
+
+    def metadata():
+        if "metadata" not in loaded:
+            loaded["metadata"] = metadata_store.load_store(store_file)
+        return loaded["metadata"]
+
+    def ontology():
+        if "ontology" not in loaded:
+            loaded["ontology"] = json_ontology_extender.load_ontology(ontology_file)
+        return loaded["ontology"]
+
+    try:
+        for compound in compounds:
+            counts_hash, counts_file = counts_stage(graph, compound, metadata_hash, metadata)
+            tree_hash, tree_file = tree_stage(graph, compound, ontology_hash, counts_hash, counts_file, ontology,
+                                              node_key, data_key, pruned_tree, unmatched_siblings)
+            html_stage(graph, compound, tree_hash, tree_file, html_hash, in_html, compress_out_html, minify_cache_dir)
+    finally:
+        graph.save()
+
+    reports = sum(1 for key in graph.built if key.startswith("html:"))
+    logger.info("Built {} stages ({} reports), skipped {} stages in {:.2f} s".format(
+        len(graph.built), reports, len(graph.skipped), time.perf_counter() - start))
+    return graph
+
+
+def compounds_from_masst_files(masst_files, out_dir="dist", prefix="microbeMasst_"):
+    """
+    :param masst_files: classical MASST result files, the compound name is the file name. Files with the same name
+    (in different directories) get a counter
+    :return: list of Compound with the reports out_dir/prefix + name + .html
+    """
+    compounds = []
+    used_names = set()
+    for file in masst_files:
+        name = Path(file).stem
+        unique_name = name
+        counter = 1
+        while unique_name in used_names:
+            counter += 1
+            unique_name = "{}_{}".format(name, counter)
+        used_names.add(unique_name)
+        compounds.append(Compound(unique_name, os.path.join(out_dir, "{}{}.html".format(prefix, unique_name)),
+                                  masst_file=file))
+    return compounds
+
+
+def compounds_from_journal(journal_file):
+    """
+    :param journal_file: batch job journal (see microbe_masst_batch.run_batch)
+    :return: list of Compound for all rendered jobs with their original html files
+    """
+    compounds = []
+    for key, state in batch_journal.JobJournal(journal_file).states().items():
+        if state.get("matches") and state.get("out_html"):
+            compounds.append(Compound(Path(state["out_html"]).stem, state["out_html"],
+                                      matching_usi_list=state["matches"]))
+    return compounds
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Incrementally rebuild the html reports of many compounds. Only '
+                                                 'the stages with changed inputs are run')
+    parser.add_argument('--masst_files', type=str, nargs="+", help='classical MASST result files (one per compound)',
+                        default=None)
+    parser.add_argument('--journal', type=str, help='rebuild all rendered jobs of a batch journal', default=None)
+    parser.add_argument('--out_dir', type=str, help='output directory of the reports of the masst files',
+                        default="dist")
+    parser.add_argument('--prefix', type=str, help='prefix of the reports of the masst files',
+                        default="microbeMasst_")
+    parser.add_argument('--in_html', type=str, help='The input html file', default="collapsible_tree_v3.html")
+    parser.add_argument('--ontology', type=str, help='the ontology file (json, owl/obo, or ClassyFire json)',
+                        default="../data/microbe_masst/ncbi.json")
+    parser.add_argument('--ontology_format', type=str, choices=["tree_json", "owl", "classyfire"],
+                        help='ontology format. Default: by file extension', default=None)
+    parser.add_argument('--metadata_file', type=str, help='microbe masst metadata',
+                        default="../data/microbe_masst/microbe_masst_table.csv")
+    parser.add_argument('--build_dir', type=str, help='directory of the intermediate results and the build state',
+                        default="dist/build")
+    parser.add_argument('--pruned', action="store_true", help='only export the nodes with matches and their '
+                                                              'ancestors')
+    parser.add_argument('--unmatched_siblings', type=int, help='number of unmatched children per node that are kept '
+                                                               'for context in the pruned tree', default=0)
+    args = parser.parse_args()
+
+    try:
+        compounds = []
+        if args.masst_files is not None:
+            compounds += compounds_from_masst_files(args.masst_files, args.out_dir, args.prefix)
+        if args.journal is not None:
+            compounds += compounds_from_journal(args.journal)
+        run_build(compounds, args.ontology, args.metadata_file, args.in_html, args.build_dir, args.ontology_format,
+                  pruned_tree=args.pruned, unmatched_siblings=args.unmatched_siblings)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
@@ -6,6 +6,8 @@ from pathlib import Path
 import bundle_to_html
 import json_ontology_extender
 import microbe_masst_results
+import ontology_dag
+import pipeline_profile
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -14,12 +16,14 @@ logger = logging.getLogger(__name__)
 def create_tree_html(in_html="collapsible_tree_v3.html", in_ontology="../data/microbe_masst/ncbi.json",
                      metadata_file="../data/microbe_masst/microbe_masst_table.csv",
                      masst_file="../examples/phelylglycocholic_acid.tsv", matching_usi_list=None,
-                     out_counts_file="dist/microbe_masst_counts.tsv",
-                     out_json_tree="dist/merged_ncbi_ontology_data.json", format_out_json=True,
-                     out_html="dist/oneindex.html", compress_out_html=True, node_key="NCBI", data_key="ncbi"):
+                     out_counts_file=None, out_json_tree=None, format_out_json=True,
+                     out_html="dist/oneindex.html", compress_out_html=True, node_key="NCBI", data_key="ncbi",
+                     context=None, precompiled_html=False, compact_tree=False, pruned_tree=False,
+                     unmatched_siblings=0, profile_file=None, profile_dir=None, dag_tree=False,
+                     minify_cache_dir=None):
     """
     Merges extra data into an ontology and creates a single distributable html file. Compression reduces the size of
-    the html file.
+    the html file. All stages pass their results in memory, intermediate files are only written for debugging.
 
     :param masst_file: imports masst results from file (classical masst). Is not used if a matching_usi_list is
     provided, e.g., from fastMASST
@@ -27,21 +31,71 @@ def create_tree_html(in_html="collapsible_tree_v3.html", in_ontology="../data/mi
     e.g., from fastMASST
     :param in_html: the base html file with different dependencies
     :param in_ontology: the input ontology
-    :param out_json_tree: the merged tree data is exported to a json file
+    :param out_counts_file: (debug) the counts per taxon are exported to a tsv file. None: no export. automatic: use
+    the masst_file name with suffix: _counts
+    :param out_json_tree: (debug) the merged tree data is exported to a json file. None: no export
     :param out_html: the final distributable html file, merged with all dependencies
     :param compress_out_html: apply compression (reduces readability)
+    :param context: a MicrobeMasstContext with the preloaded ontology and metadata. Replaces in_ontology and
+    metadata_file
+    :param precompiled_html: reuse the bundled html of previous jobs and only insert the tree data (see
+    bundle_to_html.build_dist_html)
+    :param compact_tree: insert the tree in the compact columnar json format (see
+    json_ontology_extender.tree_to_compact_json), which is much smaller. The html rebuilds the tree
+    :param pruned_tree: only export the nodes with matches and their ancestors, other subtrees are replaced by
+    placeholder nodes (see json_ontology_extender.prune_tree)
+    :param unmatched_siblings: number of unmatched children per node that are kept for context in the pruned tree
+    :param profile_file: append the stage timings of the job as a json line to this file. None: only logged (see
+    pipeline_profile.profile_job)
+    :param profile_dir: dump cProfile and tracemalloc results of the job to this directory. None: no dumps
+    :param dag_tree: merge the nodes with the same node_key and the same subtree (e.g., a taxon listed under multiple
+    parents) into one node that is referenced by all its parents (see ontology_dag.OntologyDag). Matches are counted
+    once in every ancestor. The compact tree lists each node once and the html copies the shared subtrees
+    :param minify_cache_dir: cache the minified JS and CSS in this directory (see bundle_to_html.build_dist_html).
+    None: no cache
     """
     if out_counts_file == "auto" or out_counts_file == "automatic":
         out_counts_file = "dist/{}_counts.tsv".format(Path(masst_file).stem)
 
-    if matching_usi_list is not None:
-        microbe_masst_results.create_counts_file_from_usi(metadata_file, matching_usi_list, out_counts_file)
-    else:
-        microbe_masst_results.create_counts_file(metadata_file, masst_file, out_counts_file)
+    with pipeline_profile.profile_job("build_microbe_masst_tree", out_html, profile_file, profile_dir):
+        with pipeline_profile.stage("load_reference"):
+            if context is None:
+                metadata_df = microbe_masst_results.read_metadata(metadata_file)
+                tree_root = json_ontology_extender.load_ontology(in_ontology)
+            else:
+                metadata_df = context.metadata()
+                tree_root = context.ontology()
 
-    json_ontology_extender.add_data_to_ontology_file(out_json_tree, in_ontology, out_counts_file, node_key, data_key,
-                                                     format_out_json)
-    return bundle_to_html.build_dist_html(in_html, out_html, out_json_tree, compress_out_html)
+        with pipeline_profile.stage("count_matches"):
+            if matching_usi_list is not None:
+                counts_df = microbe_masst_results.count_matches_from_usi(metadata_df, matching_usi_list)
+            else:
+                counts_df = microbe_masst_results.count_matches_in_file(metadata_df, masst_file)
+            if out_counts_file is not None:
+                microbe_masst_results.export_counts(counts_df, out_counts_file)
+
+        with pipeline_profile.stage("add_data_to_ontology"):
+            if dag_tree:
+                dag = ontology_dag.OntologyDag.from_tree(tree_root, node_key)
+                ontology_dag.add_data_to_dag(dag, counts_df, node_key, data_key, add_pie_data=not compact_tree)
+                # shared subtrees are only copied for the nested or pruned tree
+                tree_root = None if compact_tree and not pruned_tree else dag.to_tree()
+            else:
+                tree_root = json_ontology_extender.add_data_to_ontology(tree_root, counts_df, node_key, data_key,
+                                                                        add_pie_data=not compact_tree)
+            if pruned_tree:
+                tree_root = json_ontology_extender.prune_tree(tree_root, unmatched_siblings)
+        with pipeline_profile.stage("tree_to_json"):
+            if tree_root is None:
+                tree_json = dag.to_compact_json()
+            else:
+                tree_json = json_ontology_extender.tree_to_json(tree_root, format_out_json, compact_tree)
+            if out_json_tree is not None:
+                json_ontology_extender.export_tree_json(tree_json, out_json_tree)
+
+        with pipeline_profile.stage("build_dist_html"):
+            return bundle_to_html.build_dist_html(in_html, out_html, compress=compress_out_html, data_json=tree_json,
+                                                  precompiled=precompiled_html, minify_cache_dir=minify_cache_dir)
 
 
 if __name__ == '__main__':
@@ -58,13 +112,14 @@ if __name__ == '__main__':
     parser.add_argument('--masst_file', type=str, help='a tab separated file with additional data that is added to '
                                                        'metadata file',
                         default="../examples/coprogen_b.tsv")
-    parser.add_argument('--out_counts_file', type=str, help='the intermediate counts (matches) file. automatic: use '
-                                                            'the masst_file name with suffix: _counts',
-                        default="dist/microbe_masst_counts.tsv")
+    parser.add_argument('--out_counts_file', type=str, help='(debug) export the intermediate counts (matches) file. '
+                                                            'automatic: use the masst_file name with suffix: _counts',
+                        default=None)
     parser.add_argument('--out_html', type=str, help='output html file', default="dist/microbeMasst_coprogen_b.html")
     parser.add_argument('--compress', type=bool, help='Compress output file (needs minify_html)',
                         default=True)
-    parser.add_argument('--out_tree', type=str, help='output file', default="dist/merged_ncbi_ontology_data.json")
+    parser.add_argument('--out_tree', type=str, help='(debug) export the merged tree data to this json file',
+                        default=None)
     parser.add_argument('--format', type=bool, help='Format the json output False or True',
                         default=True)
     parser.add_argument('--node_key', type=str, help='the field in the ontology to be compare to the field in the '
@@ -72,14 +127,30 @@ if __name__ == '__main__':
     parser.add_argument('--data_key', type=str,
                         help='the field in the data file to be compared to the field in the ontology',
                         default="ncbi")
+    parser.add_argument('--compact', action="store_true", help='insert the tree data in a compact columnar format '
+                                                               'that is rebuilt in the html')
+    parser.add_argument('--pruned', action="store_true", help='only export the nodes with matches and their '
+                                                              'ancestors')
+    parser.add_argument('--unmatched_siblings', type=int, help='number of unmatched children per node that are kept '
+                                                               'for context in the pruned tree', default=0)
+    parser.add_argument('--dag', action="store_true", help='merge nodes with the same node_key and subtree that are '
+                                                           'listed under multiple parents and count their matches '
+                                                           'once')
+    parser.add_argument('--profile_file', type=str, help='append the stage timings as a json line to this file',
+                        default=None)
+    parser.add_argument('--profile_dir', type=str, help='dump cProfile and tracemalloc results to this directory',
+                        default=None)
     args = parser.parse_args()
 
     # is a url - try to download file
     # something like https://raw.githubusercontent.com/robinschmid/GFOPontology/master/data/GFOP.owl
     # important use raw file on github!
     try:
-        create_tree_html(args.in_html, args.ontology, args.metadata_file, args.masst_file, args.out_counts_file,
-                         args.out_tree, args.format, args.out_html, args.compress, args.node_key, args.data_key)
+        create_tree_html(args.in_html, args.ontology, args.metadata_file, args.masst_file, None, args.out_counts_file,
+                         args.out_tree, args.format, args.out_html, args.compress, args.node_key, args.data_key,
+                         compact_tree=args.compact, pruned_tree=args.pruned,
+                         unmatched_siblings=args.unmatched_siblings, profile_file=args.profile_file,
+                         profile_dir=args.profile_dir, dag_tree=args.dag)
     except Exception as e:
         # exit with error
         logger.exception(e)
@@ -1,16 +1,18 @@
 import sys
 import argparse
 import logging
+import pandas as pd
 
 import bundle_to_html
 import json_ontology_extender
+import pipeline_profile
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
 def create_tree_html(in_html, in_ontology, in_data, out_json_tree, format_out_json, out_html, compress_out_html,
-                     node_key, data_key):
+                     node_key, data_key, profile_file=None, profile_dir=None):
     """
     Merges extra data into an ontology and creates a single distributable html file. Compression reduces the size of
     the html file.
@@ -18,13 +20,26 @@ def create_tree_html(in_html, in_ontology, in_data, out_json_tree, format_out_js
     :param in_html: the base html file with different dependencies
     :param in_ontology: the input ontology
     :param in_data: extra data (in tab-separated tsv) is merged into the ontology
-    :param out_json_tree: the merged tree data is exported to a json file
+    :param out_json_tree: (debug) the merged tree data is exported to a json file. None: no export
     :param out_html: the final distributable html file, merged with all dependencies
     :param compress_out_html: apply compression (reduces readability)
+    :param profile_file: append the stage timings as a json line to this file. None: only logged (see
+    pipeline_profile.profile_job)
+    :param profile_dir: dump cProfile and tracemalloc results to this directory. None: no dumps
     """
-    json_ontology_extender.add_data_to_ontology_file(out_json_tree, in_ontology, in_data, node_key, data_key,
-                                                     format_out_json)
-    bundle_to_html.build_dist_html(in_html, out_html, out_json_tree, compress_out_html)
+    with pipeline_profile.profile_job("build_tree", out_html, profile_file, profile_dir):
+        with pipeline_profile.stage("load_reference"):
+            tree_root = json_ontology_extender.load_ontology(in_ontology)
+            df = pd.read_csv(in_data, sep='\t')
+        with pipeline_profile.stage("add_data_to_ontology"):
+            tree_root = json_ontology_extender.add_data_to_ontology(tree_root, df, node_key, data_key)
+        with pipeline_profile.stage("tree_to_json"):
+            tree_json = json_ontology_extender.tree_to_json(tree_root, format_out_json)
+            if out_json_tree is not None:
+                json_ontology_extender.export_tree_json(tree_json, out_json_tree)
+
+        with pipeline_profile.stage("build_dist_html"):
+            bundle_to_html.build_dist_html(in_html, out_html, compress=compress_out_html, data_json=tree_json)
 
 
 if __name__ == '__main__':
@@ -41,7 +56,8 @@ if __name__ == '__main__':
     parser.add_argument('--out_html', type=str, help='output html file', default="dist/oneindex.html")
     parser.add_argument('--compress', type=bool, help='Compress output file (needs minify_html)',
                         default=True)
-    parser.add_argument('--out_tree', type=str, help='output file', default="dist/merged_ontology_data.json")
+    parser.add_argument('--out_tree', type=str, help='(debug) export the merged tree data to this json file',
+                        default=None)
     parser.add_argument('--format', type=bool, help='Format the json output False or True',
                         default=True)
     parser.add_argument('--node_key', type=str, help='the field in the ontology to be compare to the field in the '
@@ -49,6 +65,10 @@ if __name__ == '__main__':
     parser.add_argument('--data_key', type=str,
                         help='the field in the data file to be compared to the field in the ontology',
                         default="group_value")
+    parser.add_argument('--profile_file', type=str, help='append the stage timings as a json line to this file',
+                        default=None)
+    parser.add_argument('--profile_dir', type=str, help='dump cProfile and tracemalloc results to this directory',
+                        default=None)
     args = parser.parse_args()
 
     # is a url - try to download file
@@ -58,7 +78,7 @@ if __name__ == '__main__':
         # tmp test microbe masst
         create_tree_html("collapsible_tree_v3.html", "../data/microbe_masst/ncbi.json",
                          "dist/microbe_masst_counts.tsv", args.out_tree, args.format, args.out_html, args.compress,
-                         "NCBI", "ncbi")
+                         "NCBI", "ncbi", args.profile_file, args.profile_dir)
         # create_tree_html(args.in_html, args.ontology, args.in_data, args.out_tree, args.format, args.out_html,
         #                  args.compress, args.node_key, args.data_key)
     except Exception as e:
@@ -1,11 +1,19 @@
 from bs4 import BeautifulSoup
 from pathlib import Path
+from dataclasses import dataclass
+from typing import Optional
 import base64
+import re
 import requests
+import os
 import sys
+import threading
 import argparse
 import logging
 
+import pipeline_profile
+from minify_cache import get_minify_cache, minify_json_data
+
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
@@ -27,31 +35,60 @@ def replace_by_local_file(path):
 
 def replace_data_in_file(data_json_file, text):
     tree_data = Path(data_json_file).read_text()
-    text = text.replace("PLACEHOLDER_JSON_DATA", tree_data, 1)
+    return replace_data(tree_data, text)
+
+
+def replace_data(tree_data, text):
+    return text.replace("PLACEHOLDER_JSON_DATA", tree_data, 1)
 
-    return text
 
+ASSET_TOKEN_PATTERN = re.compile(r"GFOP_INLINE_ASSET_(\d+)__")
 
-def build_dist_html(input_html, output_html, data_json_file=None, compress=False):
+
+def asset_token(index):
+    # the trailing delimiter keeps GFOP_INLINE_ASSET_1__ from matching inside GFOP_INLINE_ASSET_10__
+    return "GFOP_INLINE_ASSET_{}__".format(index)
+
+
+def bundle_html(input_html, data_json_file=None, data_json=None, sources=None, assets=None):
     """
-    Creates a single distributable HTML file.
-    Reads the input_html and internalizes all CSS, JS, and data files into the output html. For web ressources: First
-    try to load a local file, else try to download file.
+    Reads the input_html and internalizes all CSS, JS, and data files. For web ressources: First try to load a local
+    file, else try to download file.
     :param input_html: the input html file that defines all dependencies
-    :param output_html: the bundled HTML file
-    :return: None
+    :param data_json_file: the tree data json file that replaces PLACEHOLDER_JSON_DATA
+    :param data_json: the tree data as a json string, used instead of data_json_file
+    :param sources: optional list that collects all local files that were read
+    :param assets: optional list that collects all CSS and JS texts as (kind, text). The html then contains
+    asset_token(index) instead of the texts
+    :return: the bundled html text
     """
+    if sources is not None:
+        sources.append(input_html)
     original_html_text = Path(input_html).read_text(encoding="utf-8")
     soup = BeautifulSoup(original_html_text)
 
+    if assets is not None:
+        # static inline styles and scripts of the input html
+        for tag in soup.find_all(['style', 'script']):
+            is_js = tag.name == 'script' and tag.get('type', 'text/javascript') == 'text/javascript'
+            if tag.string and not tag.has_attr('src') and (tag.name == 'style' or is_js):
+                assets.append(("css" if tag.name == 'style' else "js", str(tag.string)))
+                tag.string = asset_token(len(assets) - 1)
+
     # Find link tags. example: <link rel="stylesheet" href="css/somestyle.css">
     for tag in soup.find_all('link', href=True):
         if tag.has_attr('href'):
+            if sources is not None:
+                sources.append(tag['href'])
             file_text = Path(tag['href']).read_text(encoding="utf-8")
 
             # remove the tag from soup
             tag.extract()
 
+            if assets is not None:
+                assets.append(("css", file_text))
+                file_text = asset_token(len(assets) - 1)
+
             # insert style element
             new_style = soup.new_tag('style')
             new_style.string = file_text
@@ -67,15 +104,24 @@ def build_dist_html(input_html, output_html, data_json_file=None, compress=False
                 response.raise_for_status()
                 file_text = response.text
             else:
+                if sources is not None:
+                    sources.append(path)
                 file_text = Path(path).read_text()
 
             # try to replace data with PLACEHOLDER_JSON_DATA
-            if data_json_file is not None and "collapsible_tree" in path:
-                file_text = replace_data_in_file(data_json_file, file_text)
+            if "collapsible_tree" in path:
+                if data_json is not None:
+                    file_text = replace_data(data_json, file_text)
+                elif data_json_file is not None:
+                    file_text = replace_data_in_file(data_json_file, file_text)
 
             # remove the tag from soup
             tag.extract()
 
+            if assets is not None:
+                assets.append(("js", file_text))
+                file_text = asset_token(len(assets) - 1)
+
             # insert script element
             new_script = soup.new_tag('script')
             new_script.string = file_text
@@ -84,26 +130,163 @@ def build_dist_html(input_html, output_html, data_json_file=None, compress=False
     # Find image tags.
     for tag in soup.find_all('img', src=True):
         if tag.has_attr('src'):
+            if sources is not None:
+                sources.append(tag['src'])
             file_content = Path(tag['src']).read_bytes()
 
             # replace filename with base64 of the content of the file
             base64_file_content = base64.b64encode(file_content)
             tag['src'] = "data:image/png;base64, {}".format(base64_file_content.decode('ascii'))
 
-    out_text = str(soup)
+    return str(soup)
 
-    if compress:
-        try:
-            import minify_html
-            out_text = minify_html.minify(out_text, minify_js=True, minify_css=True)
 
-        except Exception as e:
-            logger.warning("Error during output compression.")
-            logger.exception(e)
+def compress_html(text, minify_assets=True):
+    """
+    :param minify_assets: minify the JS and CSS, otherwise only the markup
+    """
+    try:
+        import minify_html
+        with pipeline_profile.stage("minify_html"):
+            return minify_html.minify(text, minify_js=minify_assets, minify_css=minify_assets)
 
-    # Save onefile
+    except Exception as e:
+        logger.warning("Error during output compression.")
+        logger.exception(e)
+        return text
+
+
+def bundle_compressed_html(input_html, minify_cache, sources=None):
+    """
+    Bundles and compresses the html. The static JS and CSS assets are minified separately and cached, only the markup
+    is minified on every call. PLACEHOLDER_JSON_DATA is kept
+    :param minify_cache: a minify_cache.MinifyCache
+    :param sources: optional list that collects all local files that were read
+    :return: the compressed html text
+    """
+    assets = []
+    with pipeline_profile.stage("bundle_html"):
+        text = bundle_html(input_html, sources=sources, assets=assets)
+    text = compress_html(text, minify_assets=False)
+    with pipeline_profile.stage("minify_assets"):
+        minified = []
+        for kind, asset_text in assets:
+            try:
+                asset_text = minify_cache.minify(asset_text, kind)
+            except Exception as e:
+                logger.warning("Error during {} compression.".format(kind))
+                logger.exception(e)
+            minified.append(asset_text)
+        # tokens are numbered in discovery order, not document order: replace each by its own index in a single pass
+        # (the inserted assets are not searched for tokens again)
+        text = ASSET_TOKEN_PATTERN.sub(lambda match: minified[int(match.group(1))], text)
+    return text
+
+
+@dataclass
+class HtmlTemplate:
+    """
+    Bundled (and compressed) html split at the data slot (PLACEHOLDER_JSON_DATA). suffix is None if there is no slot
+    """
+    prefix: str
+    suffix: Optional[str]
+    source_mtimes: dict
+
+
+# precompiled templates by (input_html, compress, working directory)
+precompiled_templates = {}
+precompiled_templates_lock = threading.Lock()
+
+
+def source_mtimes(sources):
+    return {source: os.stat(source).st_mtime_ns for source in sources}
+
+
+def get_precompiled_template(input_html, compress=False, minify_cache_dir=None):
+    """
+    Bundles and compresses the input_html once and caches the result until one of the source files changes
+    :param input_html: the input html file that defines all dependencies
+    :param compress: apply compression to the static parts
+    :param minify_cache_dir: directory of the minified assets cache. None: no cache
+    :return: HtmlTemplate
+    """
+    key = (os.path.abspath(input_html), compress, os.getcwd(), minify_cache_dir)
+    with precompiled_templates_lock:
+        template = precompiled_templates.get(key)
+        if template is not None:
+            try:
+                if source_mtimes(template.source_mtimes.keys()) == template.source_mtimes:
+                    return template
+            except OSError:
+                pass
+
+        sources = []
+        if compress and minify_cache_dir is not None:
+            text = bundle_compressed_html(input_html, get_minify_cache(minify_cache_dir), sources)
+        else:
+            with pipeline_profile.stage("bundle_html"):
+                text = bundle_html(input_html, sources=sources)
+            if compress:
+                text = compress_html(text)
+        prefix, placeholder, suffix = text.partition("PLACEHOLDER_JSON_DATA")
+        template = HtmlTemplate(prefix, suffix if placeholder else None, source_mtimes(sources))
+        precompiled_templates[key] = template
+        return template
+
+
+def write_from_template(template, output_html, data_json=None):
+    """
+    Writes prefix + data + suffix of a precompiled template
+    :param template: HtmlTemplate
+    :param data_json: the tree data as a json string. Is inserted without further compression
+    """
     with open(output_html, "w", encoding="utf-8") as outfile:
-        outfile.write(out_text)
+        outfile.write(template.prefix)
+        if template.suffix is not None:
+            outfile.write("PLACEHOLDER_JSON_DATA" if data_json is None else data_json)
+            outfile.write(template.suffix)
+
+
+def build_dist_html(input_html, output_html, data_json_file=None, compress=False, data_json=None,
+                    precompiled=False, minify_cache_dir=None):
+    """
+    Creates a single distributable HTML file.
+    Reads the input_html and internalizes all CSS, JS, and data files into the output html. For web ressources: First
+    try to load a local file, else try to download file.
+    :param input_html: the input html file that defines all dependencies
+    :param output_html: the bundled HTML file
+    :param data_json_file: the tree data json file that replaces PLACEHOLDER_JSON_DATA
+    :param data_json: the tree data as a json string, used instead of data_json_file
+    :param precompiled: reuse the bundled and compressed html of previous calls and only insert the data. The data is
+    not compressed, use compact json
+    :param minify_cache_dir: compression minifies the static JS and CSS only once and caches them in this directory
+    (e.g., minify_cache.DEFAULT_MINIFY_CACHE_DIR for batches). None: minify the whole html on every call
+    :return: None
+    """
+    if data_json is None and data_json_file is not None and (precompiled or (compress and minify_cache_dir)):
+        data_json = Path(data_json_file).read_text()
+
+    if precompiled:
+        with pipeline_profile.stage("precompiled_template"):
+            template = get_precompiled_template(input_html, compress, minify_cache_dir)
+        with pipeline_profile.stage("write_html"):
+            write_from_template(template, output_html, data_json)
+        return True
+
+    if compress and minify_cache_dir is not None:
+        out_text = bundle_compressed_html(input_html, get_minify_cache(minify_cache_dir))
+        if data_json is not None:
+            out_text = replace_data(minify_json_data(data_json), out_text)
+    else:
+        with pipeline_profile.stage("bundle_html"):
+            out_text = bundle_html(input_html, data_json_file, data_json)
+        if compress:
+            out_text = compress_html(out_text)
+
+    # Save onefile
+    with pipeline_profile.stage("write_html"):
+        with open(output_html, "w", encoding="utf-8") as outfile:
+            outfile.write(out_text)
 
     return True
 
@@ -120,13 +303,15 @@ if __name__ == '__main__':
     parser.add_argument('--out_html', type=str, help='output html file', default="dist/oneindex.html")
     parser.add_argument('--compress', type=bool, help='Compress output file (needs minify_html)',
                         default=True)
+    parser.add_argument('--precompiled', action="store_true", help='insert the data into the precompiled html without '
+                                                                   'compressing the data')
     args = parser.parse_args()
 
     # is a url - try to download file
     # something like https://raw.githubusercontent.com/robinschmid/GFOPontology/master/data/GFOP.owl
     # important use raw file on github!
     try:
-        build_dist_html(args.in_html, args.out_html, args.in_data, args.compress)
+        build_dist_html(args.in_html, args.out_html, args.in_data, args.compress, precompiled=args.precompiled)
     except Exception as e:
         # exit with error
         logger.exception(e)
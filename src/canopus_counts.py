@@ -0,0 +1,245 @@
+import sys
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+import bundle_to_html
+import flat_tree
+import json_ontology_extender
+import pipeline_profile
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# the canopus summary lists all ClassyFire classes of a feature (including all ancestors) in one column
+CLASSIFICATION_COLUMN = "all classifications"
+CLASSIFICATION_SEPARATOR = "; "
+# columns of the canopus summary, all other numeric columns are samples (e.g., feature intensities)
+CANOPUS_COLUMNS = ["name", "molecularFormula", "adduct", "precursorFormula", "most specific class", "level 5",
+                   "subclass", "class", "superclass", CLASSIFICATION_COLUMN]
+# distinct classification strings that are split at once
+PARSE_CHUNK_SIZE = 50000
+# incidences (classification string, class) that are summed per sample at once
+SAMPLE_CHUNK_SIZE = 1000000
+
+
+def build_class_index(tree_root):
+    """
+    :param tree_root: the ClassyFire ontology tree (see classyfire_to_json_ontology.py) with name and id per node
+    :return: data frame with the id and name of each class in pre-order, indexed by the unique class names
+    """
+    nodes = flat_tree.FlatTree(tree_root).nodes
+    index_df = pd.DataFrame({"id": [node.get("id") for node in nodes], "name": [node.get("name") for node in nodes]})
+    duplicated = index_df["name"].duplicated(keep="first")
+    if duplicated.any():
+        logger.warning("{} class names are used multiple times, the first class is used".format(duplicated.sum()))
+        index_df = index_df[~duplicated]
+    return index_df.set_index(pd.Index(index_df["name"].astype(object), name=None))
+
+
+def sample_columns(summary_df):
+    """
+    :return: the numeric columns that are not part of the canopus summary format
+    """
+    return [column for column in summary_df.columns
+            if column not in CANOPUS_COLUMNS and pd.api.types.is_numeric_dtype(summary_df[column])]
+
+
+def parse_classifications(classifications, class_index, chunksize=PARSE_CHUNK_SIZE):
+    """
+    Parses the classification column without splitting the string of every feature: equal strings are parsed once
+    and the class names are looked up in the class index for many strings at once
+    :param classifications: Series with the classification string per feature, see CLASSIFICATION_COLUMN
+    :param class_index: see build_class_index
+    :param chunksize: number of distinct strings that are split at once (limits the memory of the exploded names)
+    :return: (feature_codes, string_codes, class_codes): the distinct classification string of each feature (-1 for
+    missing values) and the pairs of distinct strings and classes (row in the class index), each pair listed once
+    """
+    feature_codes, strings = pd.factorize(classifications)
+    strings = pd.Series(np.asarray(strings, dtype=object))
+    pairs = []
+    unknown = {}
+    for start in range(0, len(strings), chunksize):
+        chunk = strings[start:start + chunksize]
+        # split all strings of the chunk at once, the number of separators assigns the names to their strings
+        names = np.array(CLASSIFICATION_SEPARATOR.join(chunk).split(CLASSIFICATION_SEPARATOR), dtype=object)
+        string_codes = np.repeat(np.arange(start, start + len(chunk), dtype=np.int64),
+                                 chunk.str.count(CLASSIFICATION_SEPARATOR).to_numpy() + 1)
+        codes = class_index.index.get_indexer(names)
+        known = codes >= 0
+        for name, count in pd.Series(names[~known]).value_counts().items():
+            unknown[name] = unknown.get(name, 0) + count
+        # a class that is listed twice in a string is counted once
+        chunk_pairs = np.sort(string_codes[known] * len(class_index) + codes[known])
+        pairs.append(chunk_pairs[np.r_[True, chunk_pairs[1:] != chunk_pairs[:-1]]] if len(chunk_pairs) > 0
+                     else chunk_pairs)
+    pairs = np.concatenate(pairs) if pairs else np.zeros(0, dtype=np.int64)
+    if unknown:
+        logger.warning("{} class names are not in the ontology, e.g., {}".format(len(unknown),
+                                                                                 list(unknown)[:5]))
+    logger.info("Parsed {} features with {} distinct classifications".format(len(feature_codes), len(strings)))
+    return feature_codes, pairs // len(class_index), pairs % len(class_index)
+
+
+def count_sample_classes(present, feature_codes, string_codes, class_codes, n_classes, chunksize=SAMPLE_CHUNK_SIZE):
+    """
+    :param present: boolean array (features x samples) of the features that were detected in each sample
+    :return: int64 array (classes x samples) with the number of detected features per class
+    """
+    valid = feature_codes >= 0
+    string_present = np.zeros((int(feature_codes.max(initial=-1)) + 1, present.shape[1]), dtype=np.int64)
+    np.add.at(string_present, feature_codes[valid], present[valid])
+
+    counts = np.zeros((n_classes, present.shape[1]), dtype=np.int64)
+    order = np.argsort(class_codes, kind="stable")
+    for start in range(0, len(order), chunksize):
+        chunk = order[start:start + chunksize]
+        classes = class_codes[chunk]
+        starts = np.flatnonzero(np.r_[True, classes[1:] != classes[:-1]])
+        counts[classes[starts]] += np.add.reduceat(string_present[string_codes[chunk]], starts, axis=0)
+    return counts
+
+
+def count_classes(summary_df, class_index, samples=None, chunksize=PARSE_CHUNK_SIZE):
+    """
+    Counts the features of every ClassyFire class. A feature is counted in all classes of its classification (which
+    includes the ancestors)
+    :param summary_df: the canopus summary with the classification column and optional sample columns
+    :param class_index: see build_class_index
+    :param samples: the sample columns, a feature is detected in a sample if its value is > 0. None: all numeric
+    columns that are not part of the summary format (see sample_columns)
+    :return: data frame with id, name, feature_count, and the feature count per sample for all classes of the index
+    """
+    if samples is None:
+        samples = sample_columns(summary_df)
+    feature_codes, string_codes, class_codes = parse_classifications(summary_df[CLASSIFICATION_COLUMN], class_index,
+                                                                     chunksize)
+    string_counts = np.bincount(feature_codes[feature_codes >= 0], minlength=int(feature_codes.max(initial=-1)) + 1)
+    counts_df = class_index[["id", "name"]].reset_index(drop=True)
+    counts_df["feature_count"] = np.bincount(class_codes, weights=string_counts[string_codes],
+                                             minlength=len(class_index)).astype(np.int64)
+    if len(samples) > 0:
+        present = (summary_df[samples].fillna(0).to_numpy() > 0)
+        sample_counts = count_sample_classes(present, feature_codes, string_codes, class_codes, len(class_index))
+        counts_df = pd.concat([counts_df, pd.DataFrame(sample_counts, columns=samples)], axis=1)
+    return counts_df
+
+
+def read_summary(in_summary, samples=None):
+    """
+    Reads only the classification column and the sample columns of a canopus summary
+    :param samples: the sample columns. None: all columns that are not part of the summary format
+    """
+    columns = pd.read_csv(in_summary, sep="\t", nrows=0).columns
+    if samples is None:
+        samples = [column for column in columns if column not in CANOPUS_COLUMNS]
+    return pd.read_csv(in_summary, sep="\t", usecols=[CLASSIFICATION_COLUMN] + list(samples))
+
+
+def create_counts_file(in_ontology, in_summary, out_tsv_file, samples=None):
+    """
+    Exports the feature counts per class (and per sample) to a tab separated file, see count_classes
+    """
+    class_index = build_class_index(json_ontology_extender.load_ontology(in_ontology))
+    counts_df = count_classes(read_summary(in_summary, samples), class_index, samples)
+    counts_df.to_csv(out_tsv_file, sep="\t", index=False)
+    return counts_df
+
+
+def tree_data(counts_df, sample=None):
+    """
+    :param sample: the sample column that is shown as matches. None: all features are matched
+    :return: data frame with id, group_size (features per class), and matched_size (features per class in the sample)
+    for json_ontology_extender.add_data_to_ontology. All classes have both values so that the counts (which already
+    include all descendants) are not accumulated again
+    """
+    matched = counts_df["feature_count"] if sample is None else counts_df[sample]
+    return pd.DataFrame({"id": counts_df["id"], "group_size": counts_df["feature_count"], "matched_size": matched})
+
+
+def create_tree_html(in_html="collapsible_tree_v3.html", in_ontology="canopus_classyfire/classyfire_ontology.json",
+                     in_summary="canopus_classyfire/canopus_summary_adducts.tsv", out_counts_file=None,
+                     out_json_tree=None, format_out_json=True, out_html="dist/canopus_classyfire.html",
+                     compress_out_html=True, sample=None, compact_tree=False, profile_file=None, profile_dir=None):
+    """
+    Counts the canopus features per ClassyFire class, merges the counts into the ontology, and creates a single
+    distributable html file. Classes without features have a matched_size and group_size of 0
+
+    :param in_html: the base html file with different dependencies
+    :param in_ontology: the ClassyFire json ontology, see classyfire_to_json_ontology.py
+    :param in_summary: the canopus summary (tsv) with the classification column and optional sample columns
+    :param out_counts_file: (debug) export the counts per class and sample to a tsv file. None: no export
+    :param out_json_tree: (debug) the merged tree data is exported to a json file. None: no export
+    :param out_html: the final distributable html file, merged with all dependencies
+    :param compress_out_html: apply compression (reduces readability)
+    :param sample: show the features detected in this sample column as matches. None: all features
+    :param compact_tree: insert the tree in the compact columnar json format (see
+    json_ontology_extender.tree_to_compact_json)
+    :param profile_file: append the stage timings as a json line to this file. None: only logged (see
+    pipeline_profile.profile_job)
+    :param profile_dir: dump cProfile and tracemalloc results to this directory. None: no dumps
+    """
+    with pipeline_profile.profile_job("canopus_counts", out_html, profile_file, profile_dir):
+        with pipeline_profile.stage("load_reference"):
+            tree_root = json_ontology_extender.load_ontology(in_ontology)
+            class_index = build_class_index(tree_root)
+            summary_df = read_summary(in_summary, None if sample is None else [sample])
+
+        with pipeline_profile.stage("count_classes"):
+            counts_df = count_classes(summary_df, class_index)
+            if out_counts_file is not None:
+                counts_df.to_csv(out_counts_file, sep="\t", index=False)
+
+        with pipeline_profile.stage("add_data_to_ontology"):
+            # ClassyFire classes are identified by their id, not by an NCBI id
+            tree_root = json_ontology_extender.add_data_to_ontology(tree_root, tree_data(counts_df, sample), "id",
+                                                                    "id", add_pie_data=not compact_tree, id_field="id")
+        with pipeline_profile.stage("tree_to_json"):
+            tree_json = json_ontology_extender.tree_to_json(tree_root, format_out_json, compact_tree)
+            if out_json_tree is not None:
+                json_ontology_extender.export_tree_json(tree_json, out_json_tree)
+
+        with pipeline_profile.stage("build_dist_html"):
+            return bundle_to_html.build_dist_html(in_html, out_html, compress=compress_out_html, data_json=tree_json)
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Count the canopus features per ClassyFire class (and per sample) '
+                                                 'and create the tree html')
+    parser.add_argument('--in_html', type=str, help='The input html file', default="collapsible_tree_v3.html")
+    parser.add_argument('--ontology', type=str, help='the ClassyFire json ontology file with children',
+                        default="canopus_classyfire/classyfire_ontology.json")
+    parser.add_argument('--in_summary', type=str, help='canopus summary with the all classifications column and '
+                                                       'optional sample columns',
+                        default="canopus_classyfire/canopus_summary_adducts.tsv")
+    parser.add_argument('--out_counts_file', type=str, help='export the counts per class and sample to this tsv file',
+                        default=None)
+    parser.add_argument('--out_html', type=str, help='output html file', default="dist/canopus_classyfire.html")
+    parser.add_argument('--compress', type=bool, help='Compress output file (needs minify_html)', default=True)
+    parser.add_argument('--out_tree', type=str, help='(debug) export the merged tree data to this json file',
+                        default=None)
+    parser.add_argument('--format', type=bool, help='Format the json output False or True', default=True)
+    parser.add_argument('--sample', type=str, help='show the features detected in this sample column as matches. '
+                                                   'Default: all features', default=None)
+    parser.add_argument('--compact', action="store_true", help='insert the tree data in a compact columnar format '
+                                                               'that is rebuilt in the html')
+    parser.add_argument('--profile_file', type=str, help='append the stage timings as a json line to this file',
+                        default=None)
+    parser.add_argument('--profile_dir', type=str, help='dump cProfile and tracemalloc results to this directory',
+                        default=None)
+    args = parser.parse_args()
+
+    try:
+        create_tree_html(args.in_html, args.ontology, args.in_summary, args.out_counts_file, args.out_tree,
+                         args.format, args.out_html, args.compress, args.sample, args.compact, args.profile_file,
+                         args.profile_dir)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
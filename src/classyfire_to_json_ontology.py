@@ -6,7 +6,11 @@ from anytree import Node, RenderTree
 from anytree.exporter import JsonExporter
 
 
-def convert_to_json(input="canopus_classyfire/classyfire.json", output="canopus_classyfire/classyfire_ontology.json"):
+def create_tree(input="canopus_classyfire/classyfire.json"):
+    """
+    :param input: ClassyFire json file with all terms
+    :return: the anytree root node
+    """
     import json
     # create a root to bundle everything
     root: Node
@@ -37,22 +41,26 @@ def convert_to_json(input="canopus_classyfire/classyfire.json", output="canopus_
                 except AttributeError as ex:
                     print(ex)
                     raise ex
+    return root
+
 
+def convert_to_json(input="canopus_classyfire/classyfire.json", output="canopus_classyfire/classyfire_ontology.json"):
+    root = create_tree(input)
 
-        # generate json string
-        exporter = JsonExporter(indent=2, sort_keys=True)
-        json = exporter.export(root)
+    # generate json string
+    exporter = JsonExporter(indent=2, sort_keys=True)
+    json = exporter.export(root)
 
-        # print json and tree for debugging
-        print(json)
+    # print json and tree for debugging
+    print(json)
 
-        for pre, _, node in RenderTree(root):
-            print("%s%s" % (pre, node.name))
+    for pre, _, node in RenderTree(root):
+        print("%s%s" % (pre, node.name))
 
-        # export to json file
-        print("Writing to {}".format(output))
-        with open(output, "w") as file:
-            print(json, file=file)
+    # export to json file
+    print("Writing to {}".format(output))
+    with open(output, "w") as file:
+        print(json, file=file)
 
 
 def convert_from_url(url, output, username, password):
@@ -32,7 +32,7 @@ EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.*/
 // tree data internalized
 // const treeData = [];
 
-const root = PLACEHOLDER_JSON_DATA;
+const root = inflateTree(PLACEHOLDER_JSON_DATA);
 
 visitAll(root, node => node.originalChildren = node.children);
 
@@ -578,6 +578,7 @@ function update(source) {
                 + (d.matched_size > 0 ? "<br/>Matches: " + d.matched_size : "")
                 + (d.occurrence_fraction > 0 ? "<br/>Occurance fraction: " + formatDecimals(d.occurrence_fraction, 3) : "")
                 + (d.group_size > 0 ? "<br/>Group size: " + d.group_size : "")
+                + (d.pruned_nodes > 0 ? "<br/>Pruned nodes: " + d.pruned_nodes : "")
             )
                 .style("left", (d3.event.pageX) + "px")
                 .style("top", (d3.event.pageY - 28) + "px");
@@ -800,6 +801,77 @@ function collapseAll() {
     visitAll(root, collapse);
 }
 
+/**
+ * Rebuilds the nested tree from the compact columnar format (json_ontology_extender.tree_to_compact_json):
+ * {"parent": [parent index per node], "columns": {field: [value per node]}} with nodes in pre-order.
+ * The pie data is derived for every node. Nested trees are returned as they are.
+ * @param data the compact or nested tree data
+ * @returns the root node
+ */
+function inflateTree(data) {
+    if (!data.parent || !data.columns) {
+        return data;
+    }
+    var fields = Object.keys(data.columns);
+    var nodes = new Array(data.parent.length);
+    for (var n = 0; n < nodes.length; n++) {
+        var node = {};
+        for (var f = 0; f < fields.length; f++) {
+            var value = data.columns[fields[f]][n];
+            if (value !== null) {
+                node[fields[f]] = value;
+            }
+        }
+        if (node.occurrence_fraction != null) {
+            node.pie_data = createPieData(node);
+        }
+        nodes[n] = node;
+
+        var parent = data.parent[n];
+        if (parent >= 0) {
+            if (!nodes[parent].children) {
+                nodes[parent].children = [];
+            }
+            nodes[parent].children.push(node);
+        }
+    }
+    if (!data.shared || data.shared.length === 0) {
+        return nodes[0];
+    }
+    // nodes with multiple parents (see ontology_dag.py) are exported once: link them at their position under the
+    // other parents and copy the shared subtrees as the layout needs a tree
+    for (var s = 0; s < data.shared.length; s++) {
+        var edge = data.shared[s];
+        if (!nodes[edge[1]].children) {
+            nodes[edge[1]].children = [];
+        }
+        nodes[edge[1]].children.splice(edge[2], 0, nodes[edge[0]]);
+    }
+    return copySubtree(nodes[0]);
+}
+
+function copySubtree(node) {
+    var copy = Object.assign({}, node);
+    if (node.children) {
+        copy.children = node.children.map(copySubtree);
+    }
+    return copy;
+}
+
+// the pie data needs an array with multiple entries - therefore use fraction and 1-fraction
+function createPieData(node) {
+    return [
+        {
+            occurrence_fraction: node.occurrence_fraction, index: 0,
+            group_size: node.group_size, matched_size: node.matched_size
+        },
+        {
+            occurrence_fraction: 1.0 - node.occurrence_fraction, index: 1,
+            group_size: node.group_size, matched_size: node.matched_size
+        }
+    ];
+}
+
 // A recursive helper function for performing some setup by walking through all nodes
 
 function visit(parent, visitFn, childrenFn) {
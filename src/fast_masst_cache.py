@@ -0,0 +1,108 @@
+import json
+import time
+import zlib
+import sqlite3
+import threading
+import logging
+from datetime import timedelta
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class FastMasstCache:
+    """
+    Cache of parsed fastMASST results keyed by the normalized search parameters. Results are stored compressed in
+    sqlite. Entries expire after expire_after and the least recently used entries are evicted when the cache exceeds
+    max_size_bytes. Thread safe.
+    """
+
+    def __init__(self, cache_file="fastmasst_cache.sqlite", max_size_bytes=200 * 1024 * 1024,
+                 expire_after=timedelta(days=2)):
+        """
+        :param cache_file: the sqlite file. None: in memory cache
+        :param max_size_bytes: maximum size of all compressed results
+        :param expire_after: time to live of an entry
+        """
+        self.cache_file = cache_file
+        self.max_size_bytes = max_size_bytes
+        self.expire_after_s = expire_after.total_seconds()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_file or ":memory:", check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, "
+                                 "size INTEGER, created REAL, last_access REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    @staticmethod
+    def cache_key(usi, library, pm_tolerance, fragment_tolerance, cosine_threshold):
+        """
+        :param usi: the full universal spectrum identifier (library IDs already converted)
+        :return: normalized key so that equal searches share an entry, e.g., 0.05 and 0.050
+        """
+        return json.dumps([str(usi).strip(), str(library), round(float(pm_tolerance), 6),
+                           round(float(fragment_tolerance), 6), round(float(cosine_threshold), 6)])
+
+    def get(self, key):
+        """
+        :return: the list of matches or None if the key is missing or expired
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, created FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.expire_after_s:
+                if row is not None:
+                    self._delete(key)
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, matches):
+        """
+        Stores the matches and evicts the least recently used entries if the cache is too large
+        """
+        value = zlib.compress(json.dumps(matches, separators=(",", ":")).encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            self._delete(key)
+            self._connection.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?)", (key, value, len(value), now, now))
+            self._size += len(value)
+            while self._size > self.max_size_bytes:
+                oldest = self._connection.execute("SELECT key FROM results ORDER BY last_access LIMIT 1").fetchone()
+                if oldest is None:
+                    break
+                self._delete(oldest[0])
+                self.evictions += 1
+            self._connection.commit()
+
+    def _delete(self, key):
+        row = self._connection.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._connection.execute("DELETE FROM results WHERE key = ?", (key,))
+            self._size -= row[0]
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM results")
+            self._connection.commit()
+            self._size = 0
+
+    def stats(self):
+        """
+        :return: dict with hits, misses, evictions, entries, and size_bytes
+        """
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": entries,
+                    "size_bytes": self._size}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
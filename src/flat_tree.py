@@ -0,0 +1,165 @@
+import numpy as np
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class FlatTree:
+    """
+    Flat view of a nested tree (nodes with ["children"]) for iterative aggregations without recursion. Nodes are
+    stored in pre-order with parent indices (-1 for the root) so that all children follow their parents. Field values
+    are read into numpy arrays, aggregated level by level, and written back into the node dicts.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: the root node of the tree, the nodes are shared (not copied)
+        """
+        nodes = []
+        parents = []
+        depths = []
+        stack = [(root, -1, 0)]
+        while stack:
+            node, parent, depth = stack.pop()
+            index = len(nodes)
+            nodes.append(node)
+            parents.append(parent)
+            depths.append(depth)
+            for child in reversed(node.get("children", [])):
+                stack.append((child, index, depth + 1))
+
+        self.nodes = nodes
+        self.compiled = None
+        self._init_arrays(np.array(parents, dtype=np.int64), np.array(depths, dtype=np.int64))
+
+    @classmethod
+    def from_compiled(cls, ontology):
+        """
+        Flat view of a compiled ontology (ontology_binary.CompiledOntology) that reads the columns directly without
+        creating the nested nodes. nodes is None, merge is not supported
+        """
+        tree = cls.__new__(cls)
+        tree.nodes = None
+        tree.compiled = ontology
+        tree._init_arrays(ontology.parent.astype(np.int64), ontology.depth.astype(np.int64))
+        return tree
+
+    def _init_arrays(self, parent, depth):
+        self.parent = parent
+        self.depth = depth
+        # node indices of each level below the root, deepest level first
+        order = np.argsort(self.depth, kind="stable")
+        splits = np.flatnonzero(np.diff(self.depth[order])) + 1
+        self.levels = [level for level in reversed(np.split(order, splits)) if self.depth[level[0]] > 0]
+
+    def __len__(self):
+        return len(self.parent)
+
+    def merge(self, data_index, node_field):
+        """
+        Merges indexed data into all nodes, see json_ontology_extender.add_indexed_data_to_node
+        :param data_index: dict of {str(key): {column: value}}, see json_ontology_extender.build_data_index
+        :param node_field: node[field] determines the key to align tree and additional data
+        """
+        for node in self.nodes:
+            key = node.get(node_field)
+            if key is None:
+                logger.warning("node has no id {}".format(node.get("name", "NONAME")))
+            else:
+                row = data_index.get(str(key))
+                if row is not None:
+                    node.update(row)
+
+    def columns(self, fields):
+        """
+        Reads multiple fields in one pass over all nodes
+        :return: dict of {field: [value per node]} with None for missing values
+        """
+        if self.nodes is None:
+            compiled_fields = self.compiled.fields()
+            return {field: self.compiled.column(field) if field in compiled_fields else [None] * len(self)
+                    for field in fields}
+        columns = {field: [] for field in fields}
+        for node in self.nodes:
+            for field, values in columns.items():
+                values.append(node.get(field))
+        return columns
+
+    def set_columns(self, columns):
+        """
+        Writes multiple fields in one pass over all nodes (in the order of columns)
+        :param columns: dict of {field: [value per node]}
+        """
+        items = list(columns.items())
+        for index, node in enumerate(self.nodes):
+            for field, values in items:
+                node[field] = values[index]
+
+    def missing(self, field):
+        """
+        :return: True if any node lacks the field (or it is None)
+        """
+        return any(node.get(field) is None for node in self.nodes)
+
+    @staticmethod
+    def numeric_array(values, default=0):
+        """
+        :param values: list of numbers or None
+        :return: int64 array if all values are integers, otherwise float64. None is replaced by default
+        """
+        values = np.array([default if value is None else value for value in values])
+        if values.dtype.kind not in "iu":
+            values = values.astype(np.float64)
+        return values
+
+    def accumulate_array(self, values):
+        """
+        :param values: array of the values per node
+        :return: array of each node's value plus the sum over all its descendants
+        """
+        values = values.copy()
+        for level in self.levels:
+            np.add.at(values, self.parent[level], values[level])
+        return values
+
+    def accumulate_values(self, values):
+        """
+        Accumulates a column like a recursive sum over the nodes: only nodes with a float in their subtree get a float
+        sum, all others keep an int sum
+        :param values: list of numbers or None (counts as 0)
+        :return: list of each node's value plus the sum over all its descendants
+        """
+        array = self.numeric_array(values)
+        if array.dtype.kind in "iu":
+            return self.accumulate_array(array).tolist()
+        is_float = np.array([isinstance(value, float) for value in values], dtype=bool)
+        int_sums = self.accumulate_array(np.where(is_float, 0, array).astype(np.int64)).tolist()
+        float_sums = self.accumulate_array(np.where(is_float, array, 0.0)).tolist()
+        has_float = (self.accumulate_array(is_float.astype(np.int64)) > 0).tolist()
+        return [int_sum + float_sum if floats else int_sum
+                for int_sum, float_sum, floats in zip(int_sums, float_sums, has_float)]
+
+    def accumulate(self, field):
+        """
+        Sets each node's field to its own value plus the sum over all descendants (missing values count as 0), see
+        accumulate_values
+        :return: the list of accumulated values
+        """
+        values = self.accumulate_values(self.columns([field])[field])
+        self.set_columns({field: values})
+        return values
+
+    @staticmethod
+    def ratio_values(numerator, denominator):
+        """
+        :param numerator: list of numbers
+        :param denominator: list of numbers
+        :return: list of numerator / denominator, or 0 if the denominator is 0
+        """
+        numerator = FlatTree.numeric_array(numerator)
+        denominator = FlatTree.numeric_array(denominator)
+        valid = denominator != 0
+        ratios = np.zeros(len(denominator), dtype=np.float64)
+        np.divide(numerator, denominator, out=ratios, where=valid)
+        return [ratio if is_valid else 0 for ratio, is_valid in zip(ratios.tolist(), valid.tolist())]
@@ -1,17 +1,35 @@
 import argparse
+import json
 import os
 import sys
+import logging
+import xml.etree.ElementTree as ElementTree
+from pathlib import Path
+import numpy as np
 import requests
 from anytree import Node, RenderTree
 from anytree.exporter import JsonExporter
 from pronto import Ontology
 
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+OWL_CLASS = "{http://www.w3.org/2002/07/owl#}Class"
+RDF_ABOUT = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about"
+RDF_RESOURCE = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource"
+RDFS_LABEL = "{http://www.w3.org/2000/01/rdf-schema#}label"
+RDFS_SUBCLASS_OF = "{http://www.w3.org/2000/01/rdf-schema#}subClassOf"
+
 
 # this script was tested on .owl --> .json
 # it somehow failed on .obo --> .json
 # from https://webprotege.stanford.edu/ choose download as RDF/XML
 
-def convert_to_json(input="GFOP.owl", output="GFOP.json"):
+def create_tree(input="GFOP.owl"):
+    """
+    :param input: owl (or obo) ontology file
+    :return: the anytree root node that bundles all terms
+    """
     # create a root to bundle everything
     root: Node = Node("GFOP")
     nodes = {}
@@ -40,6 +58,11 @@ def convert_to_json(input="GFOP.owl", output="GFOP.json"):
             except AttributeError:
                 # no parent - add to root
                 node.parent = root
+    return root
+
+
+def convert_to_json(input="GFOP.owl", output="GFOP.json"):
+    root = create_tree(input)
 
     # generate json string
     exporter = JsonExporter(indent=2, sort_keys=True)
@@ -57,7 +80,218 @@ def convert_to_json(input="GFOP.owl", output="GFOP.json"):
         print(json, file=file)
 
 
-def convert_from_url(url, output, username, password):
+def read_owl_terms(input):
+    """
+    Streams the classes of an owl file (RDF/XML) in one pass
+    :return: generator of (id, name, list of parent ids) in file order
+    """
+    for event, element in ElementTree.iterparse(input, events=("end",)):
+        if element.tag != OWL_CLASS:
+            continue
+        id = element.get(RDF_ABOUT)
+        if id is not None:
+            label = element.find(RDFS_LABEL)
+            parents = [parent.get(RDF_RESOURCE) for parent in element.findall(RDFS_SUBCLASS_OF)
+                       if parent.get(RDF_RESOURCE) is not None]
+            yield id, None if label is None else label.text, parents
+        element.clear()
+
+
+def read_obo_terms(input):
+    """
+    Streams the [Term] stanzas of an obo file in one pass
+    :return: generator of (id, name, list of parent ids (is_a)) in file order
+    """
+    term = None
+    with open(input, encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith("["):
+                if term is not None and term[0] is not None:
+                    yield term
+                term = [None, None, []] if line == "[Term]" else None
+            elif term is not None and ": " in line:
+                tag, value = line.split(": ", 1)
+                if tag == "id":
+                    term[0] = value
+                elif tag == "name":
+                    term[1] = value
+                elif tag == "is_a":
+                    # remove trailing modifiers and comments: is_a: ID {modifiers} ! name
+                    term[2].append(value.split(" ! ", 1)[0].split(" {", 1)[0].strip())
+    if term is not None and term[0] is not None:
+        yield term
+
+
+def read_terms(input):
+    """
+    :param input: owl (RDF/XML) or obo file
+    :return: generator of (id, name, list of parent ids)
+    """
+    if Path(input).suffix.lower() == ".obo":
+        return read_obo_terms(input)
+    return read_owl_terms(input)
+
+
+class Hierarchy:
+    """
+    Ontology tree in plain arrays. Terms are indexed in file order, index 0 is the root that bundles all terms without
+    (known) parents. children_offsets and children list the children of each term in file order (like create_tree).
+    """
+
+    def __init__(self, terms, root_name="GFOP"):
+        """
+        Like create_tree, terms are identified by name (a later term replaces an earlier term with the same name) and
+        only the first parent is used
+        :param terms: iterable of (id, name, list of parent ids), see read_terms
+        """
+        self.ids = [None]
+        self.names = [root_name]
+        parent_ids = [None]
+        index_by_id = {}
+        index_by_name = {}
+        for id, name, parents in terms:
+            index = index_by_id.get(id)
+            if index is not None:
+                # the same class defined again
+                if self.names[index] is None:
+                    self.names[index] = name
+                if parent_ids[index] is None and parents:
+                    parent_ids[index] = parents[0]
+                continue
+            index = len(self.ids)
+            index_by_id[id] = index
+            self.ids.append(id)
+            self.names.append(name)
+            parent_ids.append(parents[0] if parents else None)
+
+        # the last term of each name is kept
+        for index in range(1, len(self.names)):
+            index_by_name[self.names[index]] = index
+        kept = np.zeros(len(self.names), dtype=bool)
+        kept[0] = True
+        kept[list(index_by_name.values())] = True
+        replaced = len(self.names) - 1 - (int(kept.sum()) - 1)
+        if replaced > 0:
+            logger.warning("{} terms were replaced by later terms with the same name".format(replaced))
+
+        self.parent = np.full(len(self.names), -1, dtype=np.int64)
+        self.parent_names = [None] * len(self.names)
+        missing = 0
+        for index in range(1, len(self.names)):
+            parent_id = parent_ids[index]
+            if parent_id is None:
+                self.parent[index] = 0
+                continue
+            parent_index = index_by_id.get(parent_id)
+            if parent_index is None:
+                # e.g., owl:Thing or an external class
+                missing += parent_id != "http://www.w3.org/2002/07/owl#Thing"
+                self.parent[index] = 0
+                parent_ids[index] = None
+                continue
+            self.parent_names[index] = self.names[parent_index]
+            self.parent[index] = index_by_name[self.names[parent_index]]
+        if missing > 0:
+            logger.warning("{} terms have unknown parents and were added to the root".format(missing))
+        self.parent_ids = parent_ids
+        self.parent[~kept] = -2
+
+        # children in file order (stable sort by parent)
+        order = np.argsort(self.parent, kind="stable")
+        order = order[self.parent[order] >= 0]
+        self.children = order
+        self.children_offsets = np.zeros(len(self.names) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.parent[order], minlength=len(self.names)), out=self.children_offsets[1:])
+
+        # terms in cycles are not connected to the root
+        reachable = np.zeros(len(self.names), dtype=bool)
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            reachable[index] = True
+            stack.extend(self.children[self.children_offsets[index]:self.children_offsets[index + 1]].tolist())
+        if not reachable[kept].all():
+            raise ValueError("{} terms are in cycles".format(int((kept & ~reachable).sum())))
+
+    def __len__(self):
+        return len(self.names)
+
+    def node_fields(self, index):
+        """
+        :return: the sorted fields of a term like the anytree json export of create_tree (without children)
+        """
+        if index == 0:
+            return [("name", self.names[0])]
+        if self.parent_ids[index] is None:
+            return [("id", self.ids[index]), ("name", self.names[index])]
+        return [("id", self.ids[index]), ("name", self.names[index]), ("parent_id", self.parent_ids[index]),
+                ("parent_name", self.parent_names[index])]
+
+    def child_list(self, index):
+        return self.children[self.children_offsets[index]:self.children_offsets[index + 1]].tolist()
+
+    def write_json(self, file, indent=2):
+        """
+        Writes the tree incrementally in the same format as convert_to_json (anytree JsonExporter with sort_keys)
+        """
+        def pad(level):
+            return " " * (indent * level)
+
+        def open_node(index, level):
+            file.write("{\n")
+            children = self.child_list(index)
+            if children:
+                file.write(pad(level + 1) + '"children": [\n')
+            return [index, level, children, 0]
+
+        stack = [open_node(0, 0)]
+        while stack:
+            top = stack[-1]
+            index, level, children, position = top
+            if position < len(children):
+                if position > 0:
+                    file.write(",\n")
+                top[3] += 1
+                file.write(pad(level + 2))
+                stack.append(open_node(children[position], level + 2))
+                continue
+            stack.pop()
+            fields = self.node_fields(index)
+            if children:
+                file.write("\n" + pad(level + 1) + "]" + (",\n" if fields else "\n"))
+            file.write(",\n".join("{}{}: {}".format(pad(level + 1), json.dumps(key), json.dumps(value))
+                                   for key, value in fields))
+            file.write("\n" + pad(level) + "}")
+        file.write("\n")
+
+    def print_tree(self):
+        stack = [(0, 0)]
+        while stack:
+            index, level = stack.pop()
+            print("{}{}".format("    " * level, self.names[index]))
+            stack.extend((child, level + 1) for child in reversed(self.child_list(index)))
+
+
+def convert_to_json_fast(input="GFOP.owl", output="GFOP.json", verbose=False):
+    """
+    Streaming version of convert_to_json for large ontologies. Reads the parent edges in one pass, builds the tree in
+    arrays, and writes the json incrementally. The output is equal to convert_to_json for ontologies with one parent per
+    term (with multiple parents, convert_to_json picks any parent and this the first)
+    :param input: owl (RDF/XML) or obo file
+    :param verbose: print the tree for debugging
+    :return: the Hierarchy
+    """
+    hierarchy = Hierarchy(read_terms(input))
+    if verbose:
+        hierarchy.print_tree()
+    with open(output, "w", encoding="utf-8") as file:
+        hierarchy.write_json(file)
+    logger.info("Wrote {} terms to {}".format(len(hierarchy) - 1, output))
+    return hierarchy
+
+
+def convert_from_url(url, output, username, password, fast=False):
     try:
         print("Downloading from {}".format(url))
         if username is None or len(username) == 0:
@@ -70,7 +304,10 @@ def convert_from_url(url, output, username, password):
             with open(temp, 'w') as f:
                 f.write(response.text)
 
-            convert_to_json(input=temp, output=output)
+            if fast:
+                convert_to_json_fast(input=temp, output=output)
+            else:
+                convert_to_json(input=temp, output=output)
             os.remove(temp)
         else:
             raise AttributeError("Get failed. Response: {} from {}".format(response.status_code, url))
@@ -89,6 +326,8 @@ if __name__ == '__main__':
                         default="")
     parser.add_argument('--password', type=str, help='password for authentication if a url was passed to input',
                         default="")
+    parser.add_argument('--fast', action="store_true", help='streaming conversion for large ontologies (owl or obo)')
+    parser.add_argument('--verbose', action="store_true", help='print the tree (only used with --fast)')
     args = parser.parse_args()
 
     # is a url - try to download file
@@ -96,7 +335,10 @@ if __name__ == '__main__':
     # important use raw file on github!
     try:
         if args.input.startswith("http"):
-            convert_from_url(url=args.input, output=args.output, username=args.username, password=args.password)
+            convert_from_url(url=args.input, output=args.output, username=args.username, password=args.password,
+                             fast=args.fast)
+        elif args.fast:
+            convert_to_json_fast(input=args.input, output=args.output, verbose=args.verbose)
         else:
             convert_to_json(input=args.input, output=args.output)
     except Exception as e:
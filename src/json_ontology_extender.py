@@ -5,6 +5,9 @@ import json
 import numpy as np
 import logging
 
+import flat_tree
+import ontology_binary
+
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
@@ -21,136 +24,267 @@ class NpEncoder(json.JSONEncoder):
             return super(NpEncoder, self).default(obj)
 
 
-def add_data_to_node(node, df, node_field, data_field):
+def build_data_index(df, data_field):
+    """
+    Index the additional data by the alignment key. Only the first row of each key is used, like in a filter of the
+    data frame for each node.
+    :param df: the data frame with additional data
+    :param data_field: data[field] determines the key to align tree and additional data
+    :return: dict of {str(key): {column: value}} for all columns except the data_field
+    """
+    # use string for comparison of IDs
+    keys = df[data_field].astype(str)
+    first_rows = (~keys.duplicated(keep="first")).to_numpy()
+    values = df[first_rows].drop(columns=[data_field])
+    return dict(zip(keys[first_rows], values.to_dict(orient="records")))
+
+
+def add_data_to_node(node, df, node_field, data_field, data_index=None):
     """
-    Merge data into node and apply to all children
+    Merge data into node and apply to all children (iterative, see flat_tree.FlatTree.merge)
     :param node: the current node in a tree structure with ["children"] property
     :param df: the data frame with additional data
     :param node_field: node[field] determines the key to align tree and additional data
     :param data_field: data[field] determines the key to align tree and additional data
+    :param data_index: a prebuilt index from build_data_index. Is created from df if None
     """
-    try:
-        ncbi = node.get(node_field)
-        if ncbi is None:
-            logger.warning("node has no id {}".format(node.get("name", "NONAME")))
-        else:
-            # use string for comparison of IDs
-            filtered = df[df[data_field] == str(ncbi)]
-            if len(filtered) > 0:
-                rowi = filtered.index[0]
-                for col, value in df.iteritems():
-                    if col != data_field:
-                        # print("%s is %s" % (col, value[rowi]))
-                        node[col] = value[rowi]
-    except Exception as ex:
-        logger.exception(ex)
-    # apply to all children
-    if "children" in node:
-        for child in node["children"]:
-            add_data_to_node(child, df, node_field, data_field)
+    if data_index is None:
+        data_index = build_data_index(df, data_field)
+    add_indexed_data_to_node(node, data_index, node_field)
 
 
-def accumulate_field_in_parents(node, field):
+def add_indexed_data_to_node(node, data_index, node_field):
     """
-    check count and group size fields and accumulate over tree
-    :param field: field to propagate
+    Merge indexed data into node and apply to all children in a single pass over the tree
     :param node: the current node in a tree structure with ["children"] property
+    :param data_index: dict of {str(key): {column: value}}, see build_data_index
+    :param node_field: node[field] determines the key to align tree and additional data
     """
-    node_value = node.get(field, 0)
-    # apply to all children
-    if "children" in node:
-        for child in node["children"]:
-            node_value += accumulate_field_in_parents(child, field)
-    node[field] = node_value
-    return node_value
+    flat_tree.FlatTree(node).merge(data_index, node_field)
+
+
+def add_pie_data_to_node(node):
+    # the pie data needs an array with multiple entries - therefore use fraction and 1-fraction
+    fraction = node["occurrence_fraction"]
+    group_size = node["group_size"]
+    matched_size = node["matched_size"]
+    node["pie_data"] = [
+        {"occurrence_fraction": fraction, "index": 0, "group_size": group_size, "matched_size": matched_size},
+        {"occurrence_fraction": 1.0 - fraction, "index": 1, "group_size": group_size, "matched_size": matched_size}
+    ]
 
 
-def field_missing(node, field, report_missing=False, replace_with_field=None):
+def load_ontology(ontology_file):
+    """
+    :param ontology_file: the json ontology file with children or a compiled binary ontology (.ontbin, see
+    ontology_binary.compile_ontology)
+    :return: the root node of the tree
     """
-    check if the node or any children down the tree lacks the field
-    :param field: the field to be searched
+    if str(ontology_file).endswith(ontology_binary.BINARY_SUFFIX):
+        return ontology_binary.load_tree(ontology_file)
+    with open(ontology_file) as json_file:
+        return json.load(json_file)
+
+
+def copy_tree(node):
+    """
+    Copies the tree structure so that data can be merged without changing the original tree. Node values are not
+    copied as they are immutable ids, names, and numbers.
     :param node: the current node in a tree structure with ["children"] property
+    :return: the copied node
     """
-    missing = 0
-    if node.get(field, None) is None:
-        if report_missing:
-            logger.error("Missing: {}".format(node.get("name", "NONAME")))
-        if replace_with_field is not None:
-            node[field] = node.get(replace_with_field, "")
-        missing = 1
+    copied = dict(node)
     if "children" in node:
-        for child in node["children"]:
-            missing += field_missing(child, field)
+        copied["children"] = [copy_tree(child) for child in node["children"]]
+    return copied
 
-    return missing
 
+def add_data_to_ontology(treeRoot, df, node_key="name", data_key="group_value", add_pie_data=True, id_field="NCBI"):
+    """
+    Merges the data into the tree, propagates group_size and matched_size to the parents and calculates the
+    occurrence fraction and pie data for every node
+    :param treeRoot: the root node of the ontology, is changed in place
+    :param df: the data frame with additional data
+    :param node_key: the field in the ontology to be compared to the data_key column
+    :param data_key: the column in the data frame to be compared to the node_key field
+    :param add_pie_data: add the pie_data to every node. Not needed for the compact json (see tree_to_compact_json)
+    :param id_field: the id that every node should have (shown in the html), a root without it is given its name
+    :return: the merged tree root
+    """
+    # ensure that the grouping columns are strings as we usually match string ids
+    df = df.assign(**{data_key: df[data_key].astype(str)})
+
+    # flat view of all nodes for iterative passes without recursion
+    tree = flat_tree.FlatTree(treeRoot)
+    tree.merge(build_data_index(df, data_key), node_key)
+
+    # check if the id (e.g., NCBI) is available, only the root is replaced by its name
+    if tree.missing(id_field):
+        if treeRoot.get(id_field) is None:
+            logger.error("Missing: {}".format(treeRoot.get("name", "NONAME")))
+            treeRoot[id_field] = treeRoot.get("name", "")
+        logger.error("{} id is missing in a node".format(id_field))
+
+    # check if group_size is available otherwise propagate. Read all fields in one pass and write them in one pass
+    columns = tree.columns(["group_size", "matched_size"])
+    updates = {}
+    for field, values in columns.items():
+        if any(value is None for value in values):
+            columns[field] = updates[field] = tree.accumulate_values(values)
+    updates["occurrence_fraction"] = tree.ratio_values(columns["matched_size"], columns["group_size"])
+    tree.set_columns(updates)
+
+    # calc gfop specific data for root
+    calc_root_stats(treeRoot)
+    # add data in format for pie charts
+    if add_pie_data:
+        for node in tree.nodes:
+            add_pie_data_to_node(node)
+    return treeRoot
+
+
+def count_nodes(node):
+    """
+    :return: the number of nodes in the (sub)tree including node
+    """
+    return len(flat_tree.FlatTree(node))
 
-def add_pie_data_to_node_and_children(node):
-    # the pie data needs an array with multiple entries - therefore use fraction and 1-fraction
-    node["pie_data"] = [{}, {}];
-    node["pie_data"][0]["occurrence_fraction"] = node["occurrence_fraction"];
-    node["pie_data"][0]["index"] = 0;
-    node["pie_data"][0]["group_size"] = node["group_size"];
-    node["pie_data"][0]["matched_size"] = node["matched_size"];
-    node["pie_data"][1]["occurrence_fraction"] = 1.0 - node["occurrence_fraction"];
-    node["pie_data"][1]["index"] = 1;
-    node["pie_data"][1]["group_size"] = node["group_size"];
-    node["pie_data"][1]["matched_size"] = node["matched_size"];
-
-    # apply to all children
-    if "children" in node:
-        for child in node["children"]:
-            add_pie_data_to_node_and_children(child)
 
+def create_pruned_placeholder(children, pruned_nodes=None):
+    """
+    :param children: the pruned children of a node
+    :param pruned_nodes: the number of nodes in the pruned subtrees. None: counted
+    :return: a leaf node that represents the pruned subtrees with their summed group_size and node count
+    """
+    if pruned_nodes is None:
+        pruned_nodes = sum(count_nodes(child) for child in children)
+    placeholder = {
+        "name": "{} more (pruned)".format(len(children)),
+        "pruned_nodes": pruned_nodes,
+        "group_size": sum(child.get("group_size", 0) for child in children),
+        "matched_size": 0,
+        "occurrence_fraction": 0
+    }
+    if "pie_data" in children[0]:
+        add_pie_data_to_node(placeholder)
+    return placeholder
+
+
+def prune_tree(node, unmatched_siblings=0, field="matched_size"):
+    """
+    Creates a pruned copy of the tree that only contains nodes with field > 0 and their ancestors. The pruned
+    children of each node are replaced by a single placeholder node (see create_pruned_placeholder). The subtree sizes
+    are computed on the pre-order arrays of FlatTree and the kept nodes are copied without recursion
+    :param node: the root of a tree after add_data_to_ontology
+    :param unmatched_siblings: keep up to this number of unmatched children of each matched node for context. Their
+    subtrees are pruned and counted in their pruned_nodes field
+    :param field: nodes with field > 0 are kept
+    :return: the pruned copy of the tree
+    """
+    tree = flat_tree.FlatTree(node)
+    subtree_sizes = tree.accumulate_array(np.ones(len(tree), dtype=np.int64)).tolist()
+
+    pruned_root = dict(node)
+    stack = [(0, pruned_root)]
+    while stack:
+        index, pruned = stack.pop()
+        original = tree.nodes[index]
+        if "children" not in original:
+            continue
+
+        children = []
+        pruned_children = []
+        pruned_nodes = 0
+        kept_unmatched = 0
+        # in pre-order, the first child follows its parent and each subtree is followed by the next sibling
+        child_index = index + 1
+        for child in original["children"]:
+            if child.get(field, 0) > 0:
+                kept_child = dict(child)
+                children.append(kept_child)
+                stack.append((child_index, kept_child))
+            elif kept_unmatched < unmatched_siblings:
+                kept_unmatched += 1
+                context_child = dict(child)
+                if "children" in child:
+                    del context_child["children"]
+                    context_child["pruned_nodes"] = subtree_sizes[child_index] - 1
+                children.append(context_child)
+            else:
+                pruned_children.append(child)
+                pruned_nodes += subtree_sizes[child_index]
+            child_index += subtree_sizes[child_index]
 
-def add_data_to_ontology_file(output="dist/merged_ontology_data.json", ontology_file="../data/GFOP.json",
-                              in_data="../examples/caffeic_acid.tsv", node_key="name", data_key="group_value",
-                              format_out_json=True):
-    with open(ontology_file) as json_file:
-        treeRoot = json.load(json_file)
+        if len(pruned_children) > 0:
+            children.append(create_pruned_placeholder(pruned_children, pruned_nodes))
+        pruned["children"] = children
+    return pruned_root
 
-        # read the additional data
-        df = pd.read_csv(in_data, sep='\t')
-        # ensure that the grouping columns are strings as we usually match string ids
-        df[data_key] = df[data_key].astype(str)
 
-        # print(df)
+def tree_to_columns(treeRoot, exclude=("children", "pie_data")):
+    """
+    Flattens the tree into columns. Nodes are listed in pre-order so that the children keep their order
+    :param treeRoot: the root node of a tree structure with ["children"] property
+    :param exclude: fields that are not exported
+    :return: (parents, columns) the list of parent indices (-1 for the root) and a dict of {field: [value per node]}
+    with None for missing values
+    """
+    tree = flat_tree.FlatTree(treeRoot)
+    parents = tree.parent.tolist()
 
-        # loop over all children
-        add_data_to_node(treeRoot, df, node_key, data_key)
+    fields = {}
+    for node in tree.nodes:
+        for field in node:
+            if field not in exclude:
+                fields.setdefault(field, None)
+    return parents, tree.columns(fields)
 
-        # check if group_size is available otherwise propagate
-        if field_missing(treeRoot, "NCBI", report_missing=True, replace_with_field="name") > 0:
-            logger.error("NCBI id is missing in a node")
-        if field_missing(treeRoot, "group_size") > 0:
-            accumulate_field_in_parents(treeRoot, "group_size")
-        if field_missing(treeRoot, "matched_size") > 0:
-            accumulate_field_in_parents(treeRoot, "matched_size")
 
-        calc_stats(treeRoot)
+def tree_to_compact_json(treeRoot):
+    """
+    Compact json of the tree: {"parent": [parent index per node], "columns": {field: [value per node]}} without
+    indentation and without pie_data. The html (collapsible_tree_v3_internal_data.js inflateTree) rebuilds the
+    hierarchy and the pie data
+    :return: the json string
+    """
+    parents, columns = tree_to_columns(treeRoot)
+    return json.dumps({"parent": parents, "columns": columns}, separators=(",", ":"), cls=NpEncoder)
 
-        # calc gfop specific data for root
-        calc_root_stats(treeRoot)
-        # add data in format for pie charts
-        add_pie_data_to_node_and_children(treeRoot)
 
-        print("Writing to {}".format(output))
-        with open(output, "w") as file:
-            if format_out_json:
-                out_tree = json.dumps(treeRoot, indent=2, cls=NpEncoder)
-            else:
-                out_tree = json.dumps(treeRoot, cls=NpEncoder)
-            print(out_tree, file=file)
+def tree_to_json(treeRoot, format_out_json=True, compact=False):
+    """
+    :param format_out_json: indent the nested json
+    :param compact: use the columnar format of tree_to_compact_json instead of nested nodes
+    :return: the json string
+    """
+    if compact:
+        return tree_to_compact_json(treeRoot)
+    if format_out_json:
+        return json.dumps(treeRoot, indent=2, cls=NpEncoder)
+    else:
+        return json.dumps(treeRoot, cls=NpEncoder)
 
 
-def calc_stats(node):
-    if "children" in node:
-        for child in node["children"]:
-            calc_stats(child)
-    if node["group_size"] == 0:
-        node["occurrence_fraction"] = 0
-    else:
-        node["occurrence_fraction"] = node["matched_size"] / node["group_size"]
+def export_tree(treeRoot, output, format_out_json=True, compact=False):
+    export_tree_json(tree_to_json(treeRoot, format_out_json, compact), output)
+
+
+def export_tree_json(tree_json, output):
+    print("Writing to {}".format(output))
+    with open(output, "w") as file:
+        print(tree_json, file=file)
+
+
+def add_data_to_ontology_file(output="dist/merged_ontology_data.json", ontology_file="../data/GFOP.json",
+                              in_data="../examples/caffeic_acid.tsv", node_key="name", data_key="group_value",
+                              format_out_json=True):
+    treeRoot = load_ontology(ontology_file)
+
+    # read the additional data
+    df = pd.read_csv(in_data, sep='\t')
+
+    add_data_to_ontology(treeRoot, df, node_key, data_key)
+    export_tree(treeRoot, output, format_out_json)
 
 
 def calc_root_stats(treeRoot):
@@ -0,0 +1,225 @@
+import sys
+import argparse
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import flat_tree
+import gfop_to_json
+import json_ontology_extender
+import ontology_binary
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class LineageIndex:
+    """
+    Ancestor, descendant, and lowest common ancestor (LCA) queries on an ontology tree. Nodes are numbered in pre-order
+    (like FlatTree and the binary ontology) so that the subtree of node i is the interval [i, subtree_end[i]): a is an
+    ancestor of d if a < d < subtree_end[a]. The LCA of two nodes is the parent of the shallowest node between them in
+    pre-order, found in O(1) with a sparse table of range minima over the depths.
+    """
+
+    def __init__(self, tree, keys):
+        """
+        :param tree: flat_tree.FlatTree of the ontology
+        :param keys: the key of each node in pre-order (e.g., the name), used to look up nodes and in the lineage table
+        """
+        self.parent = tree.parent
+        self.depth = tree.depth
+        self.keys = list(keys)
+        if tree.compiled is not None:
+            self.subtree_end = tree.compiled.subtree_end.astype(np.int64)
+        else:
+            self.subtree_end = np.arange(len(tree), dtype=np.int64) + tree.accumulate_array(
+                np.ones(len(tree), dtype=np.int64))
+
+        self.index_by_key = {}
+        for index, key in enumerate(self.keys):
+            self.index_by_key.setdefault(key, index)
+        if len(self.index_by_key) < len(self.keys):
+            logger.warning("{} nodes have the same key as an earlier node, lookups use the first node".format(
+                len(self.keys) - len(self.index_by_key)))
+
+        # minima[k][i] is the node with the minimum depth in [i, i + 2^k)
+        self.minima = [np.arange(len(self.keys), dtype=np.int64)]
+        width = 1
+        while 2 * width <= len(self.keys):
+            previous = self.minima[-1]
+            left = previous[:len(previous) - width]
+            right = previous[width:]
+            self.minima.append(np.where(self.depth[left] <= self.depth[right], left, right))
+            width *= 2
+
+    @classmethod
+    def from_tree(cls, root, node_key="name"):
+        """
+        :param root: the root node of a tree structure with ["children"] property
+        :param node_key: the field that identifies nodes
+        """
+        tree = flat_tree.FlatTree(root)
+        return cls(tree, tree.columns([node_key])[node_key])
+
+    @classmethod
+    def load(cls, ontology_file, node_key="name"):
+        """
+        :param ontology_file: json tree, binary ontology (.ontbin, read without creating the nested tree), or owl/obo
+        file (read like gfop_to_json.convert_to_json_fast)
+        """
+        suffix = Path(ontology_file).suffix.lower()
+        if str(ontology_file).endswith(ontology_binary.BINARY_SUFFIX):
+            tree = flat_tree.FlatTree.from_compiled(ontology_binary.CompiledOntology(ontology_file))
+            return cls(tree, tree.columns([node_key])[node_key])
+        if suffix in (".owl", ".obo"):
+            hierarchy = gfop_to_json.Hierarchy(gfop_to_json.read_terms(ontology_file))
+            nodes = [dict(hierarchy.node_fields(index)) for index in range(len(hierarchy))]
+            for index in range(len(hierarchy)):
+                children = hierarchy.child_list(index)
+                if children:
+                    nodes[index]["children"] = [nodes[child] for child in children]
+            return cls.from_tree(nodes[0], node_key)
+        return cls.from_tree(json_ontology_extender.load_ontology(ontology_file), node_key)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def index(self, key):
+        """
+        :return: the index of the first node with this key
+        :raises KeyError: if no node has the key
+        """
+        return self.index_by_key[key]
+
+    def is_ancestor(self, ancestor, descendant):
+        """
+        :param ancestor: node index or array of node indices
+        :param descendant: node index or array of node indices
+        :return: True (or boolean array) if ancestor is a proper ancestor of descendant
+        """
+        ancestor = np.asarray(ancestor)
+        descendant = np.asarray(descendant)
+        result = (ancestor < descendant) & (descendant < self.subtree_end[ancestor])
+        return bool(result) if result.ndim == 0 else result
+
+    def lca(self, first, second):
+        """
+        :param first: node index or array of node indices
+        :param second: node index or array of node indices
+        :return: the lowest common ancestor (or array of them). The LCA of a node and its descendant is the node itself
+        """
+        scalar = np.ndim(first) == 0 and np.ndim(second) == 0
+        first, second = np.broadcast_arrays(np.atleast_1d(np.asarray(first, dtype=np.int64)),
+                                            np.atleast_1d(np.asarray(second, dtype=np.int64)))
+        low = np.minimum(first, second)
+        high = np.maximum(first, second)
+        # the shallowest node in (low, high] is a child of the LCA
+        start = np.minimum(low + 1, high)
+        level = np.floor(np.log2(high - start + 1)).astype(np.int64)
+        result = low.copy()
+        for k in np.unique(level[low < high]).tolist():
+            selected = (level == k) & (low < high)
+            left = self.minima[k][start[selected]]
+            right = self.minima[k][high[selected] - (1 << k) + 1]
+            result[selected] = self.parent[np.where(self.depth[left] <= self.depth[right], left, right)]
+        return int(result[0]) if scalar else result
+
+    def ancestors(self, index):
+        """
+        :return: list of the ancestors from the parent up to the root
+        """
+        ancestors = []
+        index = self.parent[index]
+        while index >= 0:
+            ancestors.append(int(index))
+            index = self.parent[index]
+        return ancestors
+
+    def descendants(self, index):
+        """
+        :return: array of all descendants in pre-order
+        """
+        return np.arange(index + 1, self.subtree_end[index], dtype=np.int64)
+
+    def lineage(self, key, include_root=False):
+        """
+        :return: list of the keys from the node up to the top level (or the root)
+        """
+        index = self.index(key)
+        ancestors = self.ancestors(index)
+        if not include_root and ancestors:
+            ancestors = ancestors[:-1]
+        return [self.keys[node] for node in [index] + ancestors]
+
+    def subtree_sums(self, values):
+        """
+        Sums over all subtrees with prefix sums over the pre-order intervals, see FlatTree.accumulate_array
+        :param values: array of the values per node
+        :return: array of each node's value plus the sum over all its descendants
+        """
+        sums = np.concatenate([np.zeros(1, dtype=np.asarray(values).dtype), np.cumsum(values)])
+        return sums[self.subtree_end] - sums[:-1]
+
+    def lineage_table(self, leaves_only=True, include_root=False):
+        """
+        Flattened lineages like R/convert_ontology.R convert_onto: one row per node with its key and the keys of its
+        ancestors (parent1 is the direct parent), missing levels are NA (None or NaN depending on the pandas version).
+        The columns are filled level by level for all nodes at once
+        :param leaves_only: only the terminal leaves, otherwise all nodes except the root
+        :param include_root: list the root as the last ancestor
+        :return: data frame with the columns leaf, parent1, ..., parentN
+        """
+        nodes = np.arange(1, len(self), dtype=np.int64)
+        if leaves_only:
+            nodes = nodes[self.subtree_end[nodes] == nodes + 1]
+        keys = np.array(self.keys + [None], dtype=object)
+        last_ancestor = 0 if include_root else 1
+
+        columns = {"leaf": keys[nodes]}
+        current = nodes
+        level = 1
+        while True:
+            current = np.where(current >= 0, self.parent[current], -1)
+            current = np.where(self.depth[current] >= last_ancestor, current, -1)
+            if not (current >= 0).any():
+                break
+            # -1 selects the None key
+            columns["parent{}".format(level)] = keys[current]
+            level += 1
+        return pd.DataFrame(columns)
+
+
+def export_lineage_table(ontology_file, out_table, node_key="name", leaves_only=True, include_root=False):
+    """
+    Exports the lineage table (tab separated, NA for missing levels), see LineageIndex.lineage_table
+    """
+    table = LineageIndex.load(ontology_file, node_key).lineage_table(leaves_only, include_root)
+    table.to_csv(out_table, sep="\t", index=False, na_rep="NA")
+    logger.info("Exported {} lineages with up to {} ancestors to {}".format(len(table), len(table.columns) - 1,
+                                                                            out_table))
+    return table
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Export the flattened lineage of every leaf of an ontology')
+    parser.add_argument('--ontology', type=str, help='json tree, binary ontology (.ontbin), owl, or obo file',
+                        default="../data/GFOP.json")
+    parser.add_argument('--node_key', type=str, help='the field that is exported for each node', default="name")
+    parser.add_argument('--out_table', type=str, help='output tab separated lineage table',
+                        default="dist/gfop_ontology.txt")
+    parser.add_argument('--all_nodes', action="store_true", help='export the lineage of all nodes, not only leaves')
+    parser.add_argument('--include_root', action="store_true", help='list the root as the last ancestor')
+    args = parser.parse_args()
+
+    try:
+        export_lineage_table(args.ontology, args.out_table, args.node_key, not args.all_nodes, args.include_root)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
@@ -1,10 +1,19 @@
+import time
+import random
+import asyncio
+import threading
 import requests
 import logging
-from datetime import timedelta
-import requests_cache
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from requests.adapters import HTTPAdapter
 from enum import Enum, auto
 
-requests_cache.install_cache('fastmasst_cache', expire_after=timedelta(days=2))
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+FAST_MASST_URL = "https://fastlibrarysearch.ucsd.edu/search"
+
 
 class DataBase(Enum):
      gnpsdata_index = auto()
@@ -12,6 +21,286 @@ class DataBase(Enum):
      massivedata_index = auto()
      massivekb_index = auto()
 
+
+class FastMasstError(Exception):
+    """
+    fastMASST search failed (after all retries)
+    """
+
+    def __init__(self, usi, message):
+        super().__init__("fastMASST failed for {}: {}".format(usi, message))
+        self.usi = usi
+
+
+class FastMasstTimeout(FastMasstError):
+    pass
+
+
+class FastMasstConnectionError(FastMasstError):
+    pass
+
+
+class FastMasstHttpError(FastMasstError):
+    def __init__(self, usi, status_code):
+        super().__init__(usi, "HTTP status {}".format(status_code))
+        self.status_code = status_code
+
+
+class FastMasstResponseError(FastMasstError):
+    """
+    The response could not be parsed
+    """
+    pass
+
+
+@dataclass
+class FastMasstResult:
+    """
+    Result of a successful search. matches is empty if the search found no matches. Searches over multiple
+    libraries list the errors of failed libraries
+    """
+    usi: str
+    library: str
+    matches: list = field(default_factory=list)
+    attempts: int = 1
+    from_cache: bool = False
+    errors: list = field(default_factory=list)
+
+
+class RateLimiter:
+    """
+    Token bucket that limits the number of requests per second over all threads
+    """
+
+    def __init__(self, requests_per_second, burst=1):
+        self.interval = 1.0 / requests_per_second
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) / self.interval)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_s = (1 - self._tokens) * self.interval
+            time.sleep(wait_s)
+
+
+def to_usi(usi_or_lib_id):
+    if str(usi_or_lib_id).startswith("CCMS"):
+        # handle library ID
+        return "mzspec:GNPS:GNPS-LIBRARY:accession:{}".format(usi_or_lib_id)
+    return str(usi_or_lib_id)
+
+
+class FastMasstClient:
+    """
+    fastMASST client with a pooled session, retries with jittered exponential backoff, and an optional rate limit.
+    Thread safe. search_many_async fans out many searches with asyncio.
+    """
+
+    def __init__(self, search_url=FAST_MASST_URL, timeout=50, max_retries=2, backoff_s=1.0, max_backoff_s=30.0,
+                 requests_per_second=None, pool_size=10, cache=None):
+        """
+        :param search_url: the fastMASST search endpoint
+        :param timeout: timeout of a single request in seconds
+        :param max_retries: retries after timeouts, connection errors, HTTP 429 and 5xx
+        :param backoff_s: base of the exponential backoff, the wait time is drawn from [0, backoff_s * 2^retry]
+        :param max_backoff_s: maximum wait time between retries
+        :param requests_per_second: client side rate limit. None: no limit
+        :param pool_size: number of pooled connections and of threads for the async searches
+        :param cache: a FastMasstCache for the search results. None: no caching
+        :raises ValueError: if max_retries is negative
+        """
+        if max_retries < 0:
+            raise ValueError("max_retries must be >= 0, got {}".format(max_retries))
+        self.search_url = search_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.rate_limiter = RateLimiter(requests_per_second) if requests_per_second else None
+        self.pool_size = pool_size
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _request(self, usi, params):
+        """
+        :return: the list of matches
+        :raises FastMasstError: on any failure
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        try:
+            response = self.session.get(self.search_url, params=params, timeout=self.timeout)
+        except requests.exceptions.Timeout as e:
+            raise FastMasstTimeout(usi, str(e)) from e
+        except requests.exceptions.RequestException as e:
+            raise FastMasstConnectionError(usi, str(e)) from e
+        if not response.ok:
+            raise FastMasstHttpError(usi, response.status_code)
+        try:
+            return response.json()["results"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise FastMasstResponseError(usi, "invalid response: {}".format(e)) from e
+
+    @staticmethod
+    def _is_retryable(error):
+        if isinstance(error, FastMasstHttpError):
+            return error.status_code == 429 or error.status_code >= 500
+        return isinstance(error, (FastMasstTimeout, FastMasstConnectionError))
+
+    def search(self, usi_or_lib_id, precursor_mz_tol=0.05, mz_tol=0.02, min_cos=0.7,
+               library=DataBase.gnpsdata_index.name):
+        """
+        :return: FastMasstResult
+        :raises FastMasstError: if the search failed after all retries
+        """
+        usi = to_usi(usi_or_lib_id)
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.cache_key(usi, library, precursor_mz_tol, mz_tol, min_cos)
+            matches = self.cache.get(cache_key)
+            if matches is not None:
+                return FastMasstResult(usi, library, matches, 0, True)
+
+        params = {"usi": usi, "library": library, "analog": "No", "pm_tolerance": precursor_mz_tol,
+                  "fragment_tolerance": mz_tol, "cosine_threshold": min_cos}
+        for retry in range(self.max_retries + 1):
+            try:
+                matches = self._request(usi, params)
+                if cache_key is not None:
+                    self.cache.put(cache_key, matches)
+                return FastMasstResult(usi, library, matches, retry + 1)
+            except FastMasstError as e:
+                if retry >= self.max_retries or not self._is_retryable(e):
+                    raise
+                wait_s = random.uniform(0, min(self.max_backoff_s, self.backoff_s * 2 ** retry))
+                logger.warning("{} - retry in {:.1f} s".format(e, wait_s))
+                time.sleep(wait_s)
+
+    def search_libraries(self, usi_or_lib_id, precursor_mz_tol=0.05, mz_tol=0.02, min_cos=0.7,
+                         libraries=(DataBase.gnpsdata_index.name, DataBase.massivekb_index.name)):
+        """
+        Searches multiple libraries concurrently and merges the matches. Matches are deduplicated by USI (the first
+        library in libraries wins) and tagged with their source: match["library"] and all sources in
+        match["libraries"]. Matches without USI are skipped
+        :return: FastMasstResult with the merged matches. Failed libraries are listed in errors
+        :raises FastMasstError: if all libraries failed
+        """
+        libraries = [library.name if isinstance(library, DataBase) else library for library in libraries]
+        with ThreadPoolExecutor(max_workers=len(libraries)) as executor:
+            futures = [executor.submit(self.search, usi_or_lib_id, precursor_mz_tol, mz_tol, min_cos, library)
+                       for library in libraries]
+        results = []
+        errors = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except FastMasstError as e:
+                errors.append(e)
+        if len(results) == 0:
+            raise errors[0]
+
+        merged = {}
+        for result in results:
+            for match in result.matches:
+                usi = match.get("USI")
+                if not usi:
+                    # cannot be deduplicated or mapped to the metadata
+                    continue
+                if usi in merged:
+                    merged[usi]["libraries"].append(result.library)
+                else:
+                    merged[usi] = dict(match, library=result.library, libraries=[result.library])
+        return FastMasstResult(to_usi(usi_or_lib_id), ",".join(libraries), list(merged.values()),
+                               max(result.attempts for result in results),
+                               all(result.from_cache for result in results), errors)
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size)
+            return self._executor
+
+    async def search_async(self, usi_or_lib_id, precursor_mz_tol=0.05, mz_tol=0.02, min_cos=0.7,
+                           library=DataBase.gnpsdata_index.name):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), self.search, usi_or_lib_id, precursor_mz_tol,
+                                          mz_tol, min_cos, library)
+
+    async def search_many_async(self, usi_list, precursor_mz_tol=0.05, mz_tol=0.02, min_cos=0.7,
+                                library=DataBase.gnpsdata_index.name, max_concurrency=None):
+        """
+        :return: list of FastMasstResult or FastMasstError in the order of usi_list
+        """
+        semaphore = asyncio.Semaphore(max_concurrency or self.pool_size)
+
+        async def bounded_search(usi):
+            async with semaphore:
+                return await self.search_async(usi, precursor_mz_tol, mz_tol, min_cos, library)
+
+        return await asyncio.gather(*[bounded_search(usi) for usi in usi_list], return_exceptions=True)
+
+    def search_many(self, usi_list, precursor_mz_tol=0.05, mz_tol=0.02, min_cos=0.7,
+                    library=DataBase.gnpsdata_index.name, max_concurrency=None):
+        """
+        Blocking variant of search_many_async
+        """
+        return asyncio.run(self.search_many_async(usi_list, precursor_mz_tol, mz_tol, min_cos, library,
+                                                  max_concurrency))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# shared clients of fast_masst by search url and number of retries
+default_clients = {}
+default_clients_lock = threading.Lock()
+# result cache of the shared clients, see use_cache
+default_cache = None
+
+
+def get_default_client(search_url=FAST_MASST_URL, max_retries=0):
+    with default_clients_lock:
+        client = default_clients.get((search_url, max_retries))
+        if client is None:
+            client = FastMasstClient(search_url, max_retries=max_retries, cache=default_cache)
+            default_clients[(search_url, max_retries)] = client
+        return client
+
+
+def use_cache(cache):
+    """
+    Activates a result cache for fast_masst
+    :param cache: a FastMasstCache or None to deactivate caching
+    """
+    global default_cache
+    with default_clients_lock:
+        default_cache = cache
+        for client in default_clients.values():
+            client.cache = cache
+
+
 # based on
 # https://github.com/mwang87/GNPS_LCMSDashboard/blob/a9971fa557c735c8e0ccd7681653eebd415a8636/app.py#L1632
 # usi = "mzspec:GNPS:GNPS-LIBRARY:accession:CCMSLIB00000001556"
@@ -19,26 +308,24 @@ class DataBase(Enum):
 
 # http://fastlibrarysearch.ucsd.edu/fastsearch/?usi1=mzspec%3AGNPS%3AGNPS-LIBRARY%3Aaccession%3ACCMSLIB00000001556
 # &precursor_mz=None&charge=None&library_select=gnpsdata_index&analog_select=No&delta_mass_below=130&delta_mass_above=200&pm_tolerance=0.05&fragment_tolerance=0.05&cosine_threshold=0.7&use_peaks=0#%7B%22peaks%22%3A%20null%7D
-def fast_masst(usi_or_lib_id, precursor_mz_tol=0.05, mz_tol=0.02, min_cos=0.7):
-    if str(usi_or_lib_id).startswith("CCMS"):
-        # handle library ID
-        usi_or_lib_id = "mzspec:GNPS:GNPS-LIBRARY:accession:{}".format(usi_or_lib_id)
-
+def fast_masst(usi_or_lib_id, precursor_mz_tol=0.05, mz_tol=0.02, min_cos=0.7, search_url=FAST_MASST_URL,
+               libraries=None, max_retries=0):
+    """
+    :param libraries: list of libraries (DataBase names) to search concurrently. None: gnpsdata_index
+    :param max_retries: retries after timeouts, connection errors, HTTP 429 and 5xx (see FastMasstClient)
+    :return: the list of matches or None if the search failed. Use FastMasstClient to handle the errors
+    """
     try:
-        search_api_url = "https://fastlibrarysearch.ucsd.edu/search?usi={}&library=gnpsdata_index&analog=No&pm_tolerance={}&fragment_tolerance={}&cosine_threshold={}"\
-            .format(usi_or_lib_id, precursor_mz_tol, mz_tol, min_cos)
-        # search_api_url = "https://fastlibrarysearch.ucsd.edu/search?usi={}&library=massivekb_index&analog=No".format(
-        #     usi)
-        search_api_response = requests.get(search_api_url, timeout=50)
-        search_api_response_json = search_api_response.json()
-        matches = search_api_response_json["results"]
-        return matches
-    # except requests.exceptions.Timeout:
-    except Exception:
-        logging.exception("Failed fastMASST.")
+        client = get_default_client(search_url, max_retries)
+        if libraries is None:
+            return client.search(usi_or_lib_id, precursor_mz_tol, mz_tol, min_cos).matches
+        else:
+            return client.search_libraries(usi_or_lib_id, precursor_mz_tol, mz_tol, min_cos, libraries).matches
+    except FastMasstError:
+        logger.exception("Failed fastMASST.")
 
 
 if __name__ == '__main__':
     usi = "mzspec:GNPS:GNPS-LIBRARY:accession:CCMSLIB00005883671"
     matches = fast_masst(usi)
-    print("done")
\ No newline at end of file
+    print("done")
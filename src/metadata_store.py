@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = 1
+STORE_SUFFIX = ".store.npz"
+# stores of load_metadata are kept out of the data directories
+DEFAULT_STORE_DIR = os.environ.get("GFOP_METADATA_STORE_CACHE",
+                                   os.path.join(Path.home(), ".cache", "gfopontology", "metadata_store"))
+# columns of the raw metadata table that are needed for matching
+SOURCE_COLUMNS = ["Filepath", "MassIVE", "Taxa_NCBI"]
+# columns of the prepared metadata, see microbe_masst_results.prepare_metadata
+STORE_COLUMNS = ["Filepath", "MassIVE", "fname", "Taxa_NCBI"]
+# separates the distinct strings of a column in the store
+STRING_SEPARATOR = "\x00"
+
+
+def default_store_file(metadata_file, store_dir=DEFAULT_STORE_DIR):
+    """
+    :return: the store of a metadata file in store_dir, named after the file and the hash of its absolute path
+    """
+    digest = hashlib.sha256(os.path.abspath(metadata_file).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(store_dir, "{}.{}{}".format(Path(metadata_file).stem, digest, STORE_SUFFIX))
+
+
+def source_info(metadata_file):
+    stat = os.stat(metadata_file)
+    return {"version": STORE_VERSION, "source": os.path.abspath(metadata_file), "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns}
+
+
+def encode_column(values):
+    """
+    Dictionary encodes a column
+    :param values: pandas Series
+    :return: dict with the int32 codes (-1 for missing values) and the distinct values as categories or, for text, as
+    strings: one utf-8 byte array separated by STRING_SEPARATOR
+    """
+    codes, categories = pd.factorize(values)
+    categories = np.asarray(categories)
+    if categories.dtype == object or categories.dtype.kind == "U":
+        text = STRING_SEPARATOR.join(str(value) for value in categories)
+        return {"codes": codes.astype(np.int32), "strings": np.frombuffer(text.encode("utf-8"), dtype=np.uint8)}
+    return {"codes": codes.astype(np.int32), "categories": categories}
+
+
+def decode_column(codes, categories=None, strings=None):
+    """
+    :param categories: the distinct values
+    :param strings: the distinct strings (encoded by encode_column), used instead of the categories
+    :return: numpy array with the original values (object array of str for strings). Missing values are NaN
+    """
+    if strings is not None:
+        if strings.size > 0:
+            categories = strings.tobytes().decode("utf-8").split(STRING_SEPARATOR)
+        else:
+            # no strings or only the empty string
+            categories = [""] if (codes >= 0).any() else []
+        # code -1 selects the NaN at the end
+        return np.array(categories + [np.nan], dtype=object)[codes]
+    missing = codes < 0
+    if len(categories) == 0:
+        return np.full(len(codes), np.nan)
+    values = categories[np.where(missing, 0, codes)]
+    if missing.any():
+        if values.dtype.kind in "iub":
+            values = values.astype(np.float64)
+        values[missing] = np.nan
+    return values
+
+
+def build_store(metadata_file, store_file=None):
+    """
+    Converts the metadata table into a columnar store with the prepared (cleaned) matching columns. Each column is
+    dictionary encoded and saved uncompressed in one npz file
+    :param metadata_file: microbe masst metadata (csv)
+    :param store_file: None: the default_store_file in DEFAULT_STORE_DIR
+    :return: the store file
+    """
+    import microbe_masst_results
+    store_file = store_file or default_store_file(metadata_file)
+    Path(store_file).parent.mkdir(parents=True, exist_ok=True)
+    info = source_info(metadata_file)
+    metadata_df = microbe_masst_results.prepare_metadata(pd.read_csv(metadata_file, usecols=SOURCE_COLUMNS))
+
+    arrays = {"info": np.array(json.dumps(info))}
+    for column in STORE_COLUMNS:
+        for name, array in encode_column(metadata_df[column]).items():
+            arrays["{}_{}".format(column, name)] = array
+
+    temp_file = "{}.{}.tmp.npz".format(store_file, os.getpid())
+    np.savez(temp_file, **arrays)
+    os.replace(temp_file, store_file)
+    logger.info("Built metadata store {} with {} rows".format(store_file, len(metadata_df)))
+    return store_file
+
+
+def is_stale(metadata_file, store_file):
+    """
+    :return: True if the store is missing, was built by another version, or the metadata file changed
+    """
+    if not Path(store_file).exists():
+        return True
+    try:
+        with np.load(store_file) as data:
+            return json.loads(str(data["info"])) != source_info(metadata_file)
+    except Exception as e:
+        logger.warning("Cannot read metadata store {}: {}".format(store_file, e))
+        return True
+
+
+def load_store(store_file, columns=None):
+    """
+    Loads only the requested columns of the store
+    :param columns: list of columns (see STORE_COLUMNS). None: all columns
+    :return: data frame with the prepared columns
+    """
+    columns = columns or STORE_COLUMNS
+    with np.load(store_file) as data:
+        return pd.DataFrame({column: decode_column(**{name: data["{}_{}".format(column, name)]
+                                                      for name in ("codes", "categories", "strings")
+                                                      if "{}_{}".format(column, name) in data.files})
+                             for column in columns})
+
+
+def load_metadata(metadata_file, store_file=None, columns=None, store_dir=DEFAULT_STORE_DIR):
+    """
+    Loads the prepared metadata from the columnar store, which is (re)built if it is missing or stale. Falls back to
+    reading the csv if the store cannot be written
+    :param metadata_file: microbe masst metadata (csv)
+    :param store_file: None: the default_store_file in store_dir
+    :param columns: list of columns (see STORE_COLUMNS). None: all columns
+    :param store_dir: cache directory of the stores
+    :return: the prepared metadata (see microbe_masst_results.prepare_metadata)
+    """
+    store_file = store_file or default_store_file(metadata_file, store_dir)
+    if is_stale(metadata_file, store_file):
+        try:
+            build_store(metadata_file, store_file)
+        except OSError as e:
+            logger.warning("Cannot write metadata store {}, reading the csv: {}".format(store_file, e))
+            import microbe_masst_results
+            metadata_df = microbe_masst_results.prepare_metadata(pd.read_csv(metadata_file, usecols=SOURCE_COLUMNS))
+            return metadata_df[columns or STORE_COLUMNS]
+    return load_store(store_file, columns)
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Convert the microbeMASST metadata table into a columnar store')
+    parser.add_argument('--metadata_file', type=str, help='microbe masst metadata',
+                        default="../data/microbe_masst/microbe_masst_table.csv")
+    parser.add_argument('--store_file', type=str, help='output store. Default: in the store cache directory '
+                                                       '(GFOP_METADATA_STORE_CACHE)', default=None)
+    args = parser.parse_args()
+
+    try:
+        build_store(args.metadata_file, args.store_file)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
@@ -4,6 +4,8 @@ import logging
 from pathlib import Path
 
 import masst_utils as masst
+import pipeline_profile
+from fast_masst_cache import FastMasstCache
 import build_microbe_masst_tree as mmtree
 
 logging.basicConfig(level=logging.DEBUG)
@@ -13,17 +15,31 @@ logger = logging.getLogger(__name__)
 def run_microbe_masst(usi_or_lib_id, precursor_mz_tol=0.05, mz_tol=0.02, min_cos=0.7,
                       in_html="collapsible_tree_v3.html", in_ontology="../data/microbe_masst/ncbi.json",
                       metadata_file="../data/microbe_masst/microbe_masst_table.csv",
-                      out_counts_file="dist/microbe_masst_counts.tsv",
-                      out_json_tree="dist/merged_ncbi_ontology_data.json", format_out_json=True,
-                      out_html="dist/oneindex.html", compress_out_html=True, node_key="NCBI", data_key="ncbi"
-                      ):
+                      out_counts_file=None, out_json_tree=None, format_out_json=True,
+                      out_html="dist/oneindex.html", compress_out_html=True, node_key="NCBI", data_key="ncbi",
+                      context=None, search_url=masst.FAST_MASST_URL, libraries=None, precompiled_html=False,
+                      compact_tree=False, pruned_tree=False, unmatched_siblings=0, profile_file=None,
+                      profile_dir=None, dag_tree=False, minify_cache_dir=None):
+    """
+    Searches fastMASST and creates the tree html of the matches, see build_microbe_masst_tree.create_tree_html
+    :param profile_file: append the stage timings of the job as a json line to this file. None: only logged (see
+    pipeline_profile.profile_job)
+    :param profile_dir: dump cProfile and tracemalloc results of the job to this directory. None: no dumps
+    :param dag_tree: count taxa listed under multiple parents once (see build_microbe_masst_tree.create_tree_html)
+    :param minify_cache_dir: cache the minified JS and CSS in this directory. None: no cache
+    :return: the list of matches or None if the search failed or found no matches
+    """
     try:
-        matches = masst.fast_masst(usi_or_lib_id, precursor_mz_tol, mz_tol, min_cos)
-        if (matches is not None) and (len(matches) > 0):
-            match_usi_list = [match["USI"] for match in matches]
-            mmtree.create_tree_html(in_html, in_ontology, metadata_file, None, match_usi_list, out_counts_file,
-                                    out_json_tree, format_out_json, out_html, compress_out_html, node_key, data_key)
-            return matches
+        with pipeline_profile.profile_job("run_microbe_masst", usi_or_lib_id, profile_file, profile_dir):
+            with pipeline_profile.stage("fast_masst"):
+                matches = masst.fast_masst(usi_or_lib_id, precursor_mz_tol, mz_tol, min_cos, search_url, libraries)
+            if (matches is not None) and (len(matches) > 0):
+                match_usi_list = [match["USI"] for match in matches]
+                mmtree.create_tree_html(in_html, in_ontology, metadata_file, None, match_usi_list, out_counts_file,
+                                        out_json_tree, format_out_json, out_html, compress_out_html, node_key,
+                                        data_key, context, precompiled_html, compact_tree, pruned_tree,
+                                        unmatched_siblings, dag_tree=dag_tree, minify_cache_dir=minify_cache_dir)
+                return matches
     except Exception as e:
         # exit with error
         logger.exception(e)
@@ -46,13 +62,13 @@ if __name__ == '__main__':
                         default="../data/microbe_masst/ncbi.json")
     parser.add_argument('--metadata_file', type=str, help='microbe masst metadata',
                         default="../data/microbe_masst/microbe_masst_table.csv")
-    parser.add_argument('--out_counts_file', type=str, help='the intermediate counts (matches) file. automatic: use '
-                                                            'the masst_file name with suffix: _counts',
-                        default="dist/microbe_masst_counts.tsv")
+    parser.add_argument('--out_counts_file', type=str, help='(debug) export the intermediate counts (matches) file',
+                        default=None)
     parser.add_argument('--out_html', type=str, help='output html file', default="dist/microbeMasst.html")
     parser.add_argument('--compress', type=bool, help='Compress output file (needs minify_html)',
                         default=True)
-    parser.add_argument('--out_tree', type=str, help='output file', default="dist/merged_ncbi_ontology_data.json")
+    parser.add_argument('--out_tree', type=str, help='(debug) export the merged tree data to this json file',
+                        default=None)
     parser.add_argument('--format', type=bool, help='Format the json output False or True',
                         default=True)
     parser.add_argument('--node_key', type=str, help='the field in the ontology to be compare to the field in the '
@@ -60,8 +76,29 @@ if __name__ == '__main__':
     parser.add_argument('--data_key', type=str,
                         help='the field in the data file to be compared to the field in the ontology',
                         default="ncbi")
+    parser.add_argument('--cache_file', type=str, help='sqlite file to cache fastMASST results. Default: no cache',
+                        default=None)
+    parser.add_argument('--libraries', type=str, nargs="+", help='search these libraries concurrently and merge the '
+                                                                 'matches, e.g., gnpsdata_index massivekb_index',
+                        default=None)
+    parser.add_argument('--compact', action="store_true", help='insert the tree data in a compact columnar format '
+                                                               'that is rebuilt in the html')
+    parser.add_argument('--pruned', action="store_true", help='only export the nodes with matches and their '
+                                                              'ancestors')
+    parser.add_argument('--unmatched_siblings', type=int, help='number of unmatched children per node that are kept '
+                                                               'for context in the pruned tree', default=0)
+    parser.add_argument('--dag', action="store_true", help='merge nodes with the same node_key and subtree that are '
+                                                           'listed under multiple parents and count their matches '
+                                                           'once')
+    parser.add_argument('--profile_file', type=str, help='append the stage timings as a json line to this file',
+                        default=None)
+    parser.add_argument('--profile_dir', type=str, help='dump cProfile and tracemalloc results to this directory',
+                        default=None)
     args = parser.parse_args()
 
+    if args.cache_file is not None:
+        masst.use_cache(FastMasstCache(args.cache_file))
+
     # is a url - try to download file
     # something like https://raw.githubusercontent.com/robinschmid/GFOPontology/master/data/GFOP.owl
     # important use raw file on github!
@@ -69,7 +106,10 @@ if __name__ == '__main__':
         run_microbe_masst(args.usi_or_lib_id, 0.05, 0.02, 0.7,
                           # tree generation
                           args.in_html, args.ontology, args.metadata_file, args.out_counts_file,
-                          args.out_tree, args.format, args.out_html, args.compress, args.node_key, args.data_key)
+                          args.out_tree, args.format, args.out_html, args.compress, args.node_key, args.data_key,
+                          libraries=args.libraries, compact_tree=args.compact, pruned_tree=args.pruned,
+                          unmatched_siblings=args.unmatched_siblings, profile_file=args.profile_file,
+                          profile_dir=args.profile_dir, dag_tree=args.dag)
     except Exception as e:
         # exit with error
         logger.exception(e)
@@ -1,11 +1,26 @@
 import sys
+import time
+import json
+import argparse
 import logging
 import csv
+from pathlib import Path
+from datetime import timedelta
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
 from urllib import parse
 from tqdm import tqdm
 
+import batch_journal
+import build_graph
+import pipeline_profile
+import masst_utils as masst
+from fast_masst_cache import FastMasstCache
+from minify_cache import DEFAULT_MINIFY_CACHE_DIR
 import microbe_masst as micromasst
+import build_microbe_masst_tree as mmtree
+from microbe_masst_context import MicrobeMasstContext
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -16,17 +31,46 @@ tqdm.pandas()
 example_link = "https://robinschmid.github.io/GFOPontology/{}_{}.html"
 
 
-def run_job(file_name, usi_or_lib_id, compound_name):
-    out_html = "../{}_{}.html".format(file_name, compound_name.replace(" ", "_"))
+def job_output_html(file_name, compound_name):
+    return "../{}_{}.html".format(file_name, compound_name.replace(" ", "_"))
+
+
+def unique_out_names(jobs_df):
+    """
+    Each job gets its own output file, even if compound names are duplicated or missing (the ID with safe characters
+    is used instead). Duplicates get a counter that does not collide with other compound names
+    :param jobs_df: data frame with the ID and Compound columns
+    :return: dict of {index: compound name for job_output_html}
+    """
+    used = set()
+    next_counter = {}
+    out_names = {}
+    for index, usi_or_lib_id, compound in zip(jobs_df.index, jobs_df["ID"], jobs_df["Compound"]):
+        name = pipeline_profile.safe_name(usi_or_lib_id) if pd.isna(compound) else str(compound)
+        out_name = name
+        counter = next_counter.get(name, 1)
+        while out_name.replace(" ", "_") in used:
+            counter += 1
+            out_name = "{}_{}".format(name, counter)
+        next_counter[name] = counter
+        used.add(out_name.replace(" ", "_"))
+        out_names[index] = out_name
+    return out_names
+
+
+def run_job(file_name, usi_or_lib_id, compound_name, context=None, search_url=masst.FAST_MASST_URL,
+            libraries=None, profile_file=None, profile_dir=None):
+    out_html = job_output_html(file_name, compound_name)
 
     result = micromasst.run_microbe_masst(usi_or_lib_id, precursor_mz_tol=0.05, mz_tol=0.02, min_cos=0.7,
                                           in_html="collapsible_tree_v3.html",
                                           in_ontology="../data/microbe_masst/ncbi.json",
                                           metadata_file="../data/microbe_masst/microbe_masst_table.csv",
-                                          out_counts_file="dist/microbe_masst_counts.tsv",
-                                          out_json_tree="dist/merged_ncbi_ontology_data.json", format_out_json=True,
-                                          out_html=out_html, compress_out_html=True, node_key="NCBI", data_key="ncbi"
-                                          )
+                                          out_counts_file=None, out_json_tree=None, format_out_json=False,
+                                          out_html=out_html, compress_out_html=True, node_key="NCBI", data_key="ncbi",
+                                          context=context, search_url=search_url, libraries=libraries,
+                                          precompiled_html=True, compact_tree=True, profile_file=profile_file,
+                                          profile_dir=profile_dir, minify_cache_dir=DEFAULT_MINIFY_CACHE_DIR)
 
     if result is not None:
         return example_link.format(file_name, parse.quote(compound_name))
@@ -74,23 +118,272 @@ def run_job(file_name, usi_or_lib_id, compound_name):
 #         "CCMSLIB00005727552": "Beauvericin_2"
 #     }
 
-if __name__ == '__main__':
-    # jobs = {k: v.replace(" ", "_") for (k, v) in jobs.items()}
-    file_name ="emily/fast_microbeMasst"
-    finished_jobs_tsv = "../emily/example_links.tsv"
+# context of each render worker process, see init_render_worker
+worker_context = None
+
+
+def init_render_worker(in_ontology, metadata_file):
+    global worker_context
+    worker_context = MicrobeMasstContext(in_ontology, metadata_file).preload()
+
+
+def render_inputs_hash(in_ontology, metadata_file, in_html="collapsible_tree_v3.html"):
+    """
+    :return: hash of the reference data and the html template of the rendered trees (see build_graph). Finished jobs
+    are rendered again when it changes
+    """
+    return build_graph.hash_values(build_graph.hash_file(in_ontology), build_graph.hash_file(metadata_file),
+                                   build_graph.template_hash(in_html, True, DEFAULT_MINIFY_CACHE_DIR))
+
+
+def render_job(out_html, match_usi_list, profile_file=None, profile_dir=None):
+    """
+    Builds the tree and html for one job in a render worker process
+    :return: True if the html was written
+    """
+    return mmtree.create_tree_html(in_html="collapsible_tree_v3.html", matching_usi_list=match_usi_list,
+                                   out_counts_file=None, out_json_tree=None, format_out_json=False,
+                                   out_html=out_html, compress_out_html=True, node_key="NCBI", data_key="ncbi",
+                                   context=worker_context, precompiled_html=True, compact_tree=True,
+                                   profile_file=profile_file, profile_dir=profile_dir,
+                                   minify_cache_dir=DEFAULT_MINIFY_CACHE_DIR)
+
+
+def search_job(client, usi_or_lib_id, precursor_mz_tol, mz_tol, min_cos, journal, key, libraries=None,
+               profile_file=None, profile_dir=None):
+    """
+    Runs the fastMASST search (the client retries failed requests). Failures are recorded in the journal. A search
+    over multiple libraries fails if any library failed, otherwise the incomplete matches would be kept on resume
+    :param libraries: search multiple libraries and merge the matches. None: the default library
+    :return: list of matching USIs or None if the search failed
+    """
     try:
-        finsihed_jobs_df = pd.read_csv(finished_jobs_tsv, sep="\t")
-    except:
-        logger.info("No example list or error during read")
-    # TODO check which jobs already finished
+        with pipeline_profile.profile_job("search_job", usi_or_lib_id, profile_file, profile_dir), \
+                pipeline_profile.stage("fast_masst"):
+            if libraries is None:
+                result = client.search(usi_or_lib_id, precursor_mz_tol, mz_tol, min_cos)
+            else:
+                result = client.search_libraries(usi_or_lib_id, precursor_mz_tol, mz_tol, min_cos, libraries)
+        if result.errors:
+            for error in result.errors:
+                logger.warning(error)
+            journal.record(key, batch_journal.FAILED, usi=usi_or_lib_id, stage="search", error="PartialSearch",
+                           message="; ".join(str(error) for error in result.errors))
+            return None
+        return [match["USI"] for match in result.matches if match.get("USI")]
+    except masst.FastMasstError as e:
+        logger.warning(e)
+        journal.record(key, batch_journal.FAILED, usi=usi_or_lib_id, stage="search", error=type(e).__name__,
+                       message=str(e))
+        return None
+
+
+def run_batch(jobs_df, file_name, finished_jobs_tsv, search_workers=4, render_workers=2,
+              in_ontology="../data/microbe_masst/ncbi.json",
+              metadata_file="../data/microbe_masst/microbe_masst_table.csv", search_url=masst.FAST_MASST_URL,
+              precursor_mz_tol=0.05, mz_tol=0.02, min_cos=0.7, journal_file=None, max_attempts=3, backoff_s=5.0,
+              requests_per_second=None, cache_file=None, libraries=None, profile_file=None, profile_dir=None,
+              sequential=False, no_matches_expire_after=None):
+    """
+    Runs all jobs concurrently. The fastMASST searches run in a thread pool and the tree building and html rendering
+    in a process pool. The Tree column is written to finished_jobs_tsv each time a job completes.
+    All job states are recorded in a journal keyed by the USI and the search parameters. On restart, finished jobs are
+    skipped, jobs with finished searches are only rendered, and failed jobs are retried. Finished jobs are rendered
+    again if the ontology, the metadata, or the html template changed (see render_inputs_hash).
+    :param jobs_df: data frame with the ID (USI or library ID) and Compound columns
+    :param file_name: prefix of the output html files
+    :param finished_jobs_tsv: the jobs and their results (link to tree or NO_SUCCESS)
+    :param search_workers: maximum number of concurrent fastMASST searches
+    :param render_workers: number of processes that build the trees and html files
+    :param search_url: the fastMASST search endpoint
+    :param journal_file: the job journal (jsonl). None: finished_jobs_tsv with suffix .journal.jsonl
+    :param max_attempts: maximum fastMASST attempts per job and run
+    :param backoff_s: base wait time of the jittered exponential backoff between retries
+    :param requests_per_second: limits the fastMASST requests. None: no limit
+    :param cache_file: sqlite file to cache the fastMASST results. None: no caching
+    :param libraries: list of libraries that are searched concurrently, the matches are merged. None: the default
+    library
+    :param profile_file: append the stage timings of each search and render job as json lines to this file. The
+    timings of all jobs are summarized at the end. None: no profiling summary
+    :param profile_dir: dump cProfile and tracemalloc results of each job to this directory. None: no dumps
+    :param sequential: run one search or render after the other in a single thread of this process (same output
+    names and journal)
+    :param no_matches_expire_after: timedelta after which searches without matches are repeated. None: never
+    :return: the jobs_df with the Tree column
+    """
+    start = time.time()
+    if journal_file is None:
+        journal_file = str(Path(finished_jobs_tsv).with_suffix(".journal.jsonl"))
+    journal = batch_journal.JobJournal(journal_file)
+
+    jobs_df = jobs_df.copy()
+    jobs_df["Tree"] = None
+
+    out_names = unique_out_names(jobs_df)
+
+    render_hash = render_inputs_hash(in_ontology, metadata_file)
+    keys = {index: batch_journal.job_key(row["ID"], precursor_mz_tol, mz_tol, min_cos, libraries)
+            for index, row in jobs_df.iterrows()}
+
+    cache = FastMasstCache(cache_file) if cache_file is not None else None
+    client = masst.FastMasstClient(search_url, max_retries=max_attempts - 1, backoff_s=backoff_s,
+                                   requests_per_second=requests_per_second, pool_size=search_workers, cache=cache)
+
+    with ExitStack() as stack:
+        stack.enter_context(client)
+        if sequential:
+            # a single thread runs all searches and renders, the render context is loaded in this process
+            init_render_worker(in_ontology, metadata_file)
+            search_pool = render_pool = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+        else:
+            search_pool = stack.enter_context(ThreadPoolExecutor(max_workers=search_workers))
+            render_pool = stack.enter_context(ProcessPoolExecutor(max_workers=render_workers,
+                                                                  initializer=init_render_worker,
+                                                                  initargs=(in_ontology, metadata_file)))
+        progress = stack.enter_context(tqdm(total=len(jobs_df)))
+        search_futures = {}
+        render_futures = {}
+
+        def finish(index, tree):
+            jobs_df.at[index, "Tree"] = tree
+            jobs_df.to_csv(finished_jobs_tsv, sep="\t")
+            progress.update(1)
+
+        def submit_render(index, match_usi_list):
+            out_html = job_output_html(file_name, out_names[index])
+            future = render_pool.submit(render_job, out_html, match_usi_list, profile_file, profile_dir)
+            render_futures[future] = (index, out_html)
+            return future
+
+        for index, row in jobs_df.iterrows():
+            state = journal.get(keys[index]) or {}
+            out_html = job_output_html(file_name, out_names[index])
+            if state.get("status") == batch_journal.DONE and state.get("out_html") == out_html \
+                    and state.get("render_hash") == render_hash and Path(out_html).exists():
+                finish(index, state["tree"])
+            elif state.get("status") == batch_journal.NO_MATCHES and (
+                    no_matches_expire_after is None
+                    or time.time() - state["time"] <= no_matches_expire_after.total_seconds()):
+                finish(index, "NO_SUCCESS")
+            elif state.get("matches"):
+                # search finished in a previous run
+                submit_render(index, state["matches"])
+            else:
+                search_futures[search_pool.submit(search_job, client, row["ID"], precursor_mz_tol, mz_tol, min_cos,
+                                                  journal, keys[index], libraries, profile_file,
+                                                  profile_dir)] = index
+
+        pending = set(search_futures) | set(render_futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in search_futures:
+                    index = search_futures[future]
+                    try:
+                        match_usi_list = future.result()
+                    except Exception as e:
+                        # unexpected errors (fastMASST errors are journaled by search_job) only fail this job
+                        logger.exception(e)
+                        journal.record(keys[index], batch_journal.FAILED, usi=jobs_df.at[index, "ID"],
+                                       stage="search", error=type(e).__name__, message=str(e))
+                        match_usi_list = None
+                    if match_usi_list is None:
+                        finish(index, "NO_SUCCESS")
+                    elif len(match_usi_list) == 0:
+                        journal.record(keys[index], batch_journal.NO_MATCHES, usi=jobs_df.at[index, "ID"])
+                        finish(index, "NO_SUCCESS")
+                    else:
+                        journal.record(keys[index], batch_journal.SEARCHED, usi=jobs_df.at[index, "ID"],
+                                       matches=match_usi_list)
+                        pending.add(submit_render(index, match_usi_list))
+                else:
+                    index, out_html = render_futures.pop(future)
+                    try:
+                        success = future.result()
+                    except Exception as e:
+                        logger.exception(e)
+                        success = False
+                    if success:
+                        tree = example_link.format(file_name, parse.quote(out_names[index]))
+                        journal.record(keys[index], batch_journal.DONE, usi=jobs_df.at[index, "ID"],
+                                       out_html=out_html, tree=tree, render_hash=render_hash)
+                    else:
+                        journal.record(keys[index], batch_journal.FAILED, usi=jobs_df.at[index, "ID"],
+                                       stage="render")
+                        tree = "NO_SUCCESS"
+                    finish(index, tree)
+
+    if cache is not None:
+        logger.info("fastMASST cache: {}".format(cache.stats()))
+        cache.close()
+    if profile_file is not None:
+        summarize_profiles(profile_file, since=start)
+    return jobs_df
+
+
+def summarize_profiles(profile_file, since=None):
+    """
+    Logs the summary of the profiled jobs and writes it to profile_file with suffix .summary.json
+    :param since: only jobs that started at or after this time. None: all jobs
+    :return: the summary, see pipeline_profile.summarize
+    """
+    summary = pipeline_profile.summarize(pipeline_profile.read_records(profile_file, since))
+    pipeline_profile.log_summary(summary)
+    with open(Path(profile_file).with_suffix(".summary.json"), "w", encoding="utf-8") as file:
+        json.dump(summary, file, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Run microbeMASST for a list of jobs')
+    parser.add_argument('--jobs', type=str, help='tab separated file with the jobs (Output USI and COMPOUND_NAME)',
+                        default="../emily/Combinatorial_reactions_USIs - sulfated compounds.tsv")
+    parser.add_argument('--file_name', type=str, help='prefix of the output html files',
+                        default="emily/fast_microbeMasst")
+    parser.add_argument('--finished_jobs_tsv', type=str, help='the jobs and links to the resulting trees',
+                        default="../emily/example_links.tsv")
+    parser.add_argument('--ontology', type=str, help='the json ontology file with children',
+                        default="../data/microbe_masst/ncbi.json")
+    parser.add_argument('--metadata_file', type=str, help='microbe masst metadata',
+                        default="../data/microbe_masst/microbe_masst_table.csv")
+    parser.add_argument('--search_workers', type=int, help='maximum number of concurrent fastMASST searches',
+                        default=4)
+    parser.add_argument('--render_workers', type=int, help='number of processes to build trees and html files',
+                        default=2)
+    parser.add_argument('--search_url', type=str, help='the fastMASST search endpoint',
+                        default=masst.FAST_MASST_URL)
+    parser.add_argument('--journal', type=str, help='job journal to resume a batch. Default: finished_jobs_tsv with '
+                                                    'suffix .journal.jsonl', default=None)
+    parser.add_argument('--max_attempts', type=int, help='maximum fastMASST attempts per job', default=3)
+    parser.add_argument('--requests_per_second', type=float, help='limit the fastMASST requests', default=None)
+    parser.add_argument('--cache_file', type=str, help='sqlite file to cache fastMASST results. Default: no cache',
+                        default=None)
+    parser.add_argument('--libraries', type=str, nargs="+", help='search these libraries concurrently and merge the '
+                                                                 'matches, e.g., gnpsdata_index massivekb_index',
+                        default=None)
+    parser.add_argument('--profile_file', type=str, help='append the stage timings of each job as json lines to this '
+                                                     'file and summarize them at the end', default=None)
+    parser.add_argument('--profile_dir', type=str, help='dump cProfile and tracemalloc results of each job to this '
+                                                    'directory', default=None)
+    parser.add_argument('--no_matches_expire_days', type=float, help='search jobs without matches again after this '
+                                                                     'number of days. Default: never', default=None)
+    parser.add_argument('--sequential', action="store_true", help='run one job after the other in this process')
+    args = parser.parse_args()
+
+    file_name = args.file_name
+    finished_jobs_tsv = args.finished_jobs_tsv
 
     # read list of jobs
     # jobs_df = pd.read_csv("../emily/Combinatorial_reactions_USIs - fatty acid amides.tsv", sep="\t")
-    jobs_df = pd.read_csv("../emily/Combinatorial_reactions_USIs - sulfated compounds.tsv", sep="\t")
+    jobs_df = pd.read_csv(args.jobs, sep="\t")
     jobs_df.rename(columns={'Output USI': 'ID', 'COMPOUND_NAME': 'Compound'}, inplace=True)
 
-    jobs_df["Tree"] = jobs_df.progress_apply(lambda row: run_job(file_name, row["ID"], row["Compound"]), axis=1)
-
-    jobs_df.to_csv(finished_jobs_tsv, sep="\t")
+    run_batch(jobs_df, file_name, finished_jobs_tsv, args.search_workers, args.render_workers, args.ontology,
+              args.metadata_file, args.search_url, journal_file=args.journal, max_attempts=args.max_attempts,
+              requests_per_second=args.requests_per_second, cache_file=args.cache_file, libraries=args.libraries,
+              profile_file=args.profile_file, profile_dir=args.profile_dir, sequential=args.sequential,
+              no_matches_expire_after=None if args.no_matches_expire_days is None
+              else timedelta(days=args.no_matches_expire_days))
 
     sys.exit(0)
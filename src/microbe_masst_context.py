@@ -0,0 +1,65 @@
+import os
+import threading
+import logging
+
+import json_ontology_extender
+import microbe_masst_results
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class MicrobeMasstContext:
+    """
+    Keeps the microbeMASST ontology and the prepared metadata in memory so that many queries can run without reading
+    and preparing the reference files for each job. Files are reloaded when their modification time changes.
+    """
+
+    def __init__(self, in_ontology="../data/microbe_masst/ncbi.json",
+                 metadata_file="../data/microbe_masst/microbe_masst_table.csv"):
+        """
+        :param in_ontology: the json ontology file with children
+        :param metadata_file: microbe masst metadata (csv)
+        """
+        self.in_ontology = in_ontology
+        self.metadata_file = metadata_file
+        self._lock = threading.Lock()
+        self._ontology = None
+        self._ontology_mtime = None
+        self._metadata = None
+        self._metadata_mtime = None
+
+    def ontology(self):
+        """
+        :return: a copy of the ontology tree that can be changed by merging data
+        """
+        with self._lock:
+            mtime = os.stat(self.in_ontology).st_mtime_ns
+            if self._ontology is None or mtime != self._ontology_mtime:
+                logger.info("Loading ontology {}".format(self.in_ontology))
+                self._ontology = json_ontology_extender.load_ontology(self.in_ontology)
+                self._ontology_mtime = mtime
+            ontology = self._ontology
+        return json_ontology_extender.copy_tree(ontology)
+
+    def metadata(self):
+        """
+        :return: the prepared metadata (see microbe_masst_results.prepare_metadata). Shared between queries, do not
+        change in place
+        """
+        with self._lock:
+            mtime = os.stat(self.metadata_file).st_mtime_ns
+            if self._metadata is None or mtime != self._metadata_mtime:
+                logger.info("Loading metadata {}".format(self.metadata_file))
+                self._metadata = microbe_masst_results.read_metadata(self.metadata_file)
+                self._metadata_mtime = mtime
+            return self._metadata
+
+    def preload(self):
+        """
+        Loads all reference files now instead of on the first query
+        :return: self
+        """
+        self.ontology()
+        self.metadata()
+        return self
@@ -1,5 +1,6 @@
 import argparse
 import sys
+import time
 from pathlib import Path
 import pandas as pd
 import numpy as np
@@ -8,6 +9,9 @@ import logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# rows per chunk when MASST result files are streamed, see count_matches_in_file
+MASST_CHUNK_SIZE = 100000
+
 
 def clean_filename(name):
     return name.replace("/peak/", "/ccms_peak/").replace(".mzML", "").replace(".mzXML", "").replace("f.MSV", "MSV")
@@ -34,60 +38,163 @@ def usi_massiveid_filename(usi):
     return split[1], split[2]
 
 
-def create_counts_file(metadata_file, masst_file, out_tsv_file):
-    metadata_df = pd.read_csv(metadata_file)
-    masst_file = pd.read_csv(masst_file, sep="\t")
+def clean_filenames(names):
+    """
+    Vectorized version of clean_filename
+    :param names: pandas Series of file paths
+    :return: Series of cleaned file paths
+    """
+    return names.str.replace("/peak/", "/ccms_peak/", regex=False).str.replace(".mzML", "", regex=False) \
+        .str.replace(".mzXML", "", regex=False).str.replace("f.MSV", "MSV", regex=False)
 
-    metadata_df["Filepath"] = metadata_df["Filepath"].apply(clean_filename)
-    masst_file["filename"] = masst_file["filename"].apply(clean_filename)
 
-    # count matches per ID
-    id_matches_dict = dict()
+def filenames_from_paths(pathnames):
+    """
+    Vectorized version of filename_from_path
+    :param pathnames: pandas Series of file paths
+    :return: Series of file names without directory and extension
+    """
+    names = pathnames.str.rsplit("/", n=1).str[-1]
+    # remove the last extension but keep names like .hidden or name.
+    return names.str.replace(r"(?<=.)\.[^.]+$", "", regex=True)
 
-    for index, match_row in masst_file.iterrows():
-        # might have multiple rows in the metadata table if multiple IDs
-        matching_metadata = metadata_df.loc[metadata_df["Filepath"] == match_row["filename"]]
-        for index2, meta_row in matching_metadata.iterrows():
-            ncbi_ = meta_row["Taxa_NCBI"]
-            id_matches_dict[ncbi_] = id_matches_dict.get(ncbi_, 0) + 1
 
-    export_ncbi_counts(id_matches_dict, out_tsv_file)
+def usi_massiveid_filenames(matching_usi_list):
+    """
+    Vectorized version of usi_massiveid_filename
+    :param matching_usi_list: list of universal spectrum identifiers
+    :return: data frame with the columns MassIVE and fname
+    """
+    split = pd.Series(list(matching_usi_list), dtype=object).str.split(":")
+    return pd.DataFrame({"MassIVE": split.str[1], "fname": split.str[2]})
 
 
-def create_counts_file_from_usi(metadata_file, matching_usi_list, out_tsv_file):
-    metadata_df = pd.read_csv(metadata_file)
+def read_metadata(metadata_file, use_store=True):
+    """
+    Reads the microbeMASST metadata table and prepares it for matching
+    :param metadata_file: microbe masst metadata (csv)
+    :param use_store: load the prepared columns from a columnar store in the store cache directory (see
+    metadata_store.load_metadata, GFOP_METADATA_STORE_CACHE). The store is built on the first call and rebuilt when the
+    metadata file changes
+    :return: the prepared metadata, see prepare_metadata
+    """
+    if use_store:
+        import metadata_store
+        return metadata_store.load_metadata(metadata_file)
+    return prepare_metadata(pd.read_csv(metadata_file))
+
+
+def prepare_metadata(metadata_df):
+    """
+    Adds the matching columns to the metadata: fname (file name without extension, matched to USIs) and a cleaned
+    Filepath (matched to MASST file names)
+    :param metadata_df: microbe masst metadata with Filepath, MassIVE, and Taxa_NCBI columns
+    :return: data frame with the columns Filepath, MassIVE, fname, Taxa_NCBI
+    """
+    filepaths = metadata_df["Filepath"].astype(str)
+    return pd.DataFrame({
+        "Filepath": clean_filenames(filepaths),
+        "MassIVE": metadata_df["MassIVE"],
+        "fname": filenames_from_paths(filepaths),
+        "Taxa_NCBI": metadata_df["Taxa_NCBI"],
+    })
+
+
+def count_taxa(matched_metadata_df):
+    """
+    Counts the matched metadata rows per taxon
+    :param matched_metadata_df: metadata rows (with Taxa_NCBI) that matched, one row per match
+    :return: data frame with the columns ncbi and matched_size
+    """
+    counts = matched_metadata_df["Taxa_NCBI"].value_counts(sort=False)
+    return counts.rename_axis("ncbi").reset_index(name="matched_size")
+
+
+def count_matches(metadata_df, masst_df):
+    """
+    Counts MASST matches per taxon. Each match row is counted for every metadata row with the same file
+    :param metadata_df: prepared metadata, see prepare_metadata
+    :param masst_df: MASST results with a filename column
+    :return: data frame with the columns ncbi and matched_size
+    """
+    filenames = pd.DataFrame({"Filepath": clean_filenames(masst_df["filename"].astype(str))})
+    # might have multiple rows in the metadata table if multiple IDs
+    matched = filenames.merge(metadata_df[["Filepath", "Taxa_NCBI"]], on="Filepath", how="inner")
+    return count_taxa(matched)
+
+
+def count_matches_in_file(metadata_df, masst_file, chunksize=MASST_CHUNK_SIZE):
+    """
+    Streaming version of count_matches for large MASST result files. Only the filename column is parsed, chunk by
+    chunk, and the matches per file are counted incrementally so that the memory stays flat. The counts are joined with
+    the metadata once at the end
+    :param metadata_df: prepared metadata, see prepare_metadata
+    :param masst_file: tab separated MASST results with a filename column
+    :param chunksize: rows per chunk
+    :return: data frame with the columns ncbi and matched_size, equal to count_matches
+    """
+    start = time.perf_counter()
+    file_counts = {}
+    n_rows = 0
+    for chunk in pd.read_csv(masst_file, sep="\t", usecols=["filename"], dtype=object, chunksize=chunksize):
+        n_rows += len(chunk)
+        # dicts keep the order of the first occurrence, like the merge in count_matches
+        for filepath, count in clean_filenames(chunk["filename"].astype(str)).value_counts(sort=False).items():
+            file_counts[filepath] = file_counts.get(filepath, 0) + count
+
+    files_df = pd.DataFrame({"Filepath": pd.Series(list(file_counts.keys()), dtype=object),
+                             "matches": pd.Series(list(file_counts.values()), dtype=np.int64)})
+    # might have multiple rows in the metadata table if multiple IDs
+    matched = files_df.merge(metadata_df[["Filepath", "Taxa_NCBI"]], on="Filepath", how="inner")
+    counts = matched.groupby("Taxa_NCBI", sort=False, observed=True)["matches"].sum()
+    counts_df = counts.rename_axis("ncbi").reset_index(name="matched_size")
+
+    seconds = time.perf_counter() - start
+    logger.info("Counted {} MASST rows of {} in {:.2f} s ({:.0f} rows/s)".format(
+        n_rows, masst_file, seconds, n_rows / seconds if seconds > 0 else 0))
+    return counts_df
+
+
+def count_matches_from_usi(metadata_df, matching_usi_list):
+    """
+    Counts matching USIs per taxon. Each metadata row is counted once, even if multiple USIs point to the same file
+    :param metadata_df: prepared metadata, see prepare_metadata
+    :param matching_usi_list: matching universal spectrum identifier list
+    :return: data frame with the columns ncbi and matched_size
+    """
+    matching_files = usi_massiveid_filenames(matching_usi_list).drop_duplicates()
+    # might have multiple rows in the metadata table if multiple IDs
+    matched = matching_files.merge(metadata_df[["MassIVE", "fname", "Taxa_NCBI"]], on=["MassIVE", "fname"],
+                                   how="inner")
+    return count_taxa(matched)
 
-    metadata_df["fname"] = metadata_df["Filepath"].apply(filename_from_path)
-    matching_massive_file_list = [usi_massiveid_filename(usi) for usi in matching_usi_list]
 
-    massive_to_fnames_dict = {}
-    for (massive_id, fname) in matching_massive_file_list:
-        fnames = massive_to_fnames_dict.get(massive_id)
-        if fnames is None:
-            massive_to_fnames_dict[massive_id] = [fname]
-        else:
-            fnames.append(fname)
+def create_counts_file(metadata_file, masst_file, out_tsv_file, chunksize=MASST_CHUNK_SIZE):
+    metadata_df = read_metadata(metadata_file)
 
-    # count matches per ID
-    id_matches_dict = dict()
+    counts_df = count_matches_in_file(metadata_df, masst_file, chunksize)
+    export_counts(counts_df, out_tsv_file)
+    return counts_df
 
-    for (massive_id, fnames) in massive_to_fnames_dict.items():
-        # might have multiple rows in the metadata table if multiple IDs
-        matching_metadata = metadata_df.loc[(metadata_df["fname"].isin(fnames)) & (metadata_df["MassIVE"] ==
-                                                                                   massive_id)]
-        for index2, meta_row in matching_metadata.iterrows():
-            ncbi_ = meta_row["Taxa_NCBI"]
-            id_matches_dict[ncbi_] = id_matches_dict.get(ncbi_, 0) + 1
 
-    export_ncbi_counts(id_matches_dict, out_tsv_file)
+def create_counts_file_from_usi(metadata_file, matching_usi_list, out_tsv_file):
+    metadata_df = read_metadata(metadata_file)
+
+    counts_df = count_matches_from_usi(metadata_df, matching_usi_list)
+    export_counts(counts_df, out_tsv_file)
+    return counts_df
 
 
 def export_ncbi_counts(id_matches_dict, out_tsv_file):
     df = pd.DataFrame().from_dict(id_matches_dict, orient='index', columns=['matched_size'])
     df.reset_index(inplace=True)
     df = df.rename(columns={'index': 'ncbi'})
-    df.to_csv(out_tsv_file, index=False, sep="\t")
-    print(df)
+    export_counts(df, out_tsv_file)
+
+
+def export_counts(counts_df, out_tsv_file):
+    counts_df.to_csv(out_tsv_file, index=False, sep="\t")
+    print(counts_df)
 
 
 if __name__ == '__main__':
@@ -100,11 +207,14 @@ if __name__ == '__main__':
                         default="../examples/phelylglycocholic_acid.tsv")
     parser.add_argument('--out_tsv_file', type=str, help='output file in .tsv format',
                         default="dist/microbe_masst_counts.tsv")
+    parser.add_argument('--chunksize', type=int, help='rows of the MASST file that are read at once',
+                        default=MASST_CHUNK_SIZE)
 
     args = parser.parse_args()
 
     try:
-        create_counts_file(metadata_file=args.metadata_file, masst_file=args.masst_file, out_tsv_file=args.out_tsv_file)
+        create_counts_file(metadata_file=args.metadata_file, masst_file=args.masst_file, out_tsv_file=args.out_tsv_file,
+                           chunksize=args.chunksize)
     except Exception as e:
         # exit with error
         logger.exception(e)
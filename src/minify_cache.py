@@ -0,0 +1,116 @@
+import os
+import hashlib
+import threading
+import logging
+from pathlib import Path
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+DEFAULT_MINIFY_CACHE_DIR = os.environ.get("GFOP_MINIFY_CACHE",
+                                          os.path.join(Path.home(), ".cache", "gfopontology", "minify"))
+
+
+def minify_fragment(text, kind):
+    """
+    Minifies a single JS or CSS text (needs minify_html)
+    :param kind: js or css
+    :return: the minified text
+    """
+    import minify_html
+    tag = "script" if kind == "js" else "style"
+    minified = minify_html.minify("<{0}>{1}</{0}>".format(tag, text), minify_js=True, minify_css=True)
+    start = "<{}>".format(tag)
+    end = "</{}>".format(tag)
+    if minified.startswith(start) and minified.endswith(end):
+        return minified[len(start):-len(end)]
+    logger.warning("Unexpected minification result, using the original {}".format(kind))
+    return text
+
+
+def minify_json_data(data_json, variable="root"):
+    """
+    Minifies json data like it is minified inside a script, e.g., {"name":"a"} -> {name:`a`}
+    :return: the minified data or the original data if minification failed
+    """
+    try:
+        import minify_html
+        prefix = "<script>const {}=".format(variable)
+        minified = minify_html.minify("<script>const {} = {};</script>".format(variable, data_json), minify_js=True)
+        if minified.startswith(prefix) and minified.endswith(";</script>"):
+            return minified[len(prefix):-len(";</script>")]
+    except Exception as e:
+        logger.exception(e)
+    logger.warning("Data was not minified")
+    return data_json
+
+
+def minifier_version():
+    try:
+        from importlib.metadata import version
+        return version("minify_html")
+    except Exception:
+        return "unknown"
+
+
+class MinifyCache:
+    """
+    On-disk cache of minified JS and CSS assets keyed by the hash of their content and the minifier version. Thread
+    and process safe (files are replaced atomically).
+    """
+
+    def __init__(self, cache_dir=DEFAULT_MINIFY_CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._version = minifier_version()
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    def key(self, text, kind):
+        digest = hashlib.sha256("{}|{}|".format(self._version, kind).encode("utf-8"))
+        digest.update(text.encode("utf-8"))
+        return "{}.{}".format(digest.hexdigest(), kind)
+
+    def minify(self, text, kind):
+        """
+        :param kind: js or css
+        :return: the minified text from the cache or minifies and caches the text
+        """
+        key = self.key(text, kind)
+        with self._lock:
+            minified = self._memory.get(key)
+        hit = minified is not None
+        if not hit:
+            path = self.cache_dir / key
+            if path.exists():
+                minified = path.read_text(encoding="utf-8")
+                hit = True
+            else:
+                minified = minify_fragment(text, kind)
+                temp = path.with_name("{}.{}.{}.tmp".format(key, os.getpid(), threading.get_ident()))
+                temp.write_text(minified, encoding="utf-8")
+                os.replace(temp, path)
+
+        with self._lock:
+            self._memory[key] = minified
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return minified
+
+
+# shared caches by directory
+minify_caches = {}
+minify_caches_lock = threading.Lock()
+
+
+def get_minify_cache(cache_dir=DEFAULT_MINIFY_CACHE_DIR):
+    with minify_caches_lock:
+        cache = minify_caches.get(str(cache_dir))
+        if cache is None:
+            cache = MinifyCache(cache_dir)
+            minify_caches[str(cache_dir)] = cache
+        return cache
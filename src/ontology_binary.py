@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+import logging
+from pathlib import Path
+
+import numpy as np
+
+import flat_tree
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# file layout: MAGIC, header length (uint64), json header, padding, arrays (8 byte aligned)
+MAGIC = b"GFOPONT\x01"
+VERSION = 1
+BINARY_SUFFIX = ".ontbin"
+
+# column kinds
+STRING = "str"
+INT = "int"
+FLOAT = "float"
+# any other json value (bool, nested, mixed types) is stored as a json string
+JSON = "json"
+
+
+def column_kind(values):
+    """
+    :param values: the values of a field over all nodes that have the field
+    :return: STRING, INT, FLOAT, or JSON
+    """
+    kinds = set()
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, str):
+            kinds.add(STRING)
+        elif isinstance(value, int) and not isinstance(value, bool):
+            kinds.add(INT)
+        elif isinstance(value, float):
+            kinds.add(FLOAT)
+        else:
+            kinds.add(JSON)
+    if len(kinds) == 1:
+        return kinds.pop()
+    return JSON if len(kinds) > 0 else STRING
+
+
+class StringTable:
+    """
+    Dictionary of all strings, each distinct string is stored once
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.strings = []
+
+    def code(self, text):
+        code = self.codes.get(text)
+        if code is None:
+            code = len(self.strings)
+            self.codes[text] = code
+            self.strings.append(text)
+        return code
+
+    def to_arrays(self):
+        """
+        :return: (offsets, data) the int64 character offsets (length n+1) and the utf-8 bytes of all concatenated
+        strings, so that all strings are decoded at once
+        """
+        offsets = np.zeros(len(self.strings) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in self.strings], out=offsets[1:])
+        return offsets, np.frombuffer("".join(self.strings).encode("utf-8"), dtype=np.uint8)
+
+
+def compile_tree(tree_root, out_file, source=None):
+    """
+    Compiles a tree (nested nodes with ["children"]) into the binary ontology format. Nodes are stored in pre-order
+    with parent indices and the end of each subtree. Fields are stored as columns, strings in one dictionary encoded
+    table. The key order of each node is kept so that load_tree returns the same tree as the json file
+    :param tree_root: the root node
+    :param out_file: the binary ontology file
+    :param source: the source file that is recorded for staleness checks
+    """
+    tree = flat_tree.FlatTree(tree_root)
+    n_nodes = len(tree)
+    strings = StringTable()
+
+    # key order of each node, also marks which fields are present
+    key_orders = {}
+    key_order_codes = np.zeros(n_nodes, dtype=np.int32)
+    fields = {}
+    for index, node in enumerate(tree.nodes):
+        keys = tuple(node.keys())
+        key_order_codes[index] = key_orders.setdefault(keys, len(key_orders))
+        for key in keys:
+            if key != "children":
+                fields.setdefault(key, None)
+
+    # end of each subtree in pre-order: node i has the descendants i+1 ... subtree_end[i]-1
+    subtree_end = np.arange(1, n_nodes + 1, dtype=np.int64)
+    for level in tree.levels:
+        np.maximum.at(subtree_end, tree.parent[level], subtree_end[level])
+
+    arrays = {"parent": tree.parent.astype(np.int32), "depth": tree.depth.astype(np.int32),
+              "subtree_end": subtree_end.astype(np.int32), "key_order": key_order_codes}
+    columns = {}
+    for field, values in tree.columns(list(fields)).items():
+        kind = column_kind(values)
+        columns[field] = kind
+        if kind == STRING:
+            arrays["col:" + field] = np.array([-1 if value is None else strings.code(value) for value in values],
+                                              dtype=np.int32)
+        elif kind == JSON:
+            arrays["col:" + field] = np.array([-1 if value is None else strings.code(json.dumps(value))
+                                               for value in values], dtype=np.int32)
+        else:
+            arrays["null:" + field] = np.array([value is None for value in values], dtype=np.uint8)
+            dtype = np.int64 if kind == INT else np.float64
+            arrays["col:" + field] = np.array([0 if value is None else value for value in values], dtype=dtype)
+
+    arrays["strings_offsets"], arrays["strings_data"] = strings.to_arrays()
+
+    # the header lists the arrays with their offsets relative to the data section
+    array_headers = {}
+    offset = 0
+    for name, array in arrays.items():
+        array_headers[name] = [array.dtype.str, offset, int(array.size)]
+        offset += (array.nbytes + 7) // 8 * 8
+    header = {
+        "version": VERSION,
+        "n_nodes": n_nodes,
+        "columns": columns,
+        "key_orders": [list(keys) for keys in key_orders],
+        "arrays": array_headers,
+        "source": None if source is None else os.path.abspath(source),
+        "source_mtime_ns": None if source is None else os.stat(source).st_mtime_ns,
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_end = len(MAGIC) + 8 + len(header_bytes)
+    padding = (8 - header_end % 8) % 8
+
+    temp_file = "{}.{}.tmp".format(out_file, os.getpid())
+    with open(temp_file, "wb") as file:
+        file.write(MAGIC)
+        file.write(struct.pack("<Q", len(header_bytes)))
+        file.write(header_bytes)
+        file.write(b"\0" * padding)
+        for array in arrays.values():
+            file.write(array.tobytes())
+            file.write(b"\0" * ((8 - array.nbytes % 8) % 8))
+    os.replace(temp_file, out_file)
+    logger.info("Compiled {} nodes to {}".format(n_nodes, out_file))
+
+
+class CompiledOntology:
+    """
+    Memory mapped binary ontology, see compile_tree. The arrays are read only views into the file.
+    """
+
+    def __init__(self, ontology_file):
+        self.ontology_file = ontology_file
+        with open(ontology_file, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a binary ontology file: {}".format(ontology_file))
+        header_length = struct.unpack("<Q", self._mmap[len(MAGIC):len(MAGIC) + 8])[0]
+        header_end = len(MAGIC) + 8 + header_length
+        self.header = json.loads(self._mmap[len(MAGIC) + 8:header_end].decode("utf-8"))
+        if self.header["version"] != VERSION:
+            raise ValueError("Unsupported binary ontology version {}".format(self.header["version"]))
+        data_start = header_end + (8 - header_end % 8) % 8
+        self.arrays = {name: np.frombuffer(self._mmap, dtype=np.dtype(dtype), count=count,
+                                           offset=data_start + offset)
+                       for name, (dtype, offset, count) in self.header["arrays"].items()}
+        self._strings = None
+
+    def __len__(self):
+        return self.header["n_nodes"]
+
+    @property
+    def parent(self):
+        return self.arrays["parent"]
+
+    @property
+    def depth(self):
+        return self.arrays["depth"]
+
+    @property
+    def subtree_end(self):
+        return self.arrays["subtree_end"]
+
+    def fields(self):
+        return list(self.header["columns"])
+
+    def strings(self):
+        """
+        :return: list of all strings of the dictionary
+        """
+        if self._strings is None:
+            offsets = self.arrays["strings_offsets"].tolist()
+            text = self.arrays["strings_data"].tobytes().decode("utf-8")
+            self._strings = [text[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        return self._strings
+
+    def column(self, field):
+        """
+        :return: list of the values of a field for all nodes in pre-order, None if missing
+        """
+        kind = self.header["columns"][field]
+        values = self.arrays["col:" + field].tolist()
+        if kind == STRING or kind == JSON:
+            strings = self.strings()
+            if kind == JSON:
+                return [None if code < 0 else json.loads(strings[code]) for code in values]
+            return [None if code < 0 else strings[code] for code in values]
+        nulls = self.arrays["null:" + field].tolist()
+        return [None if null else value for value, null in zip(values, nulls)]
+
+    def is_stale(self):
+        """
+        :return: True if the recorded source file changed after compilation
+        """
+        source = self.header.get("source")
+        if source is None or not os.path.exists(source):
+            return False
+        return os.stat(source).st_mtime_ns != self.header.get("source_mtime_ns")
+
+    def to_tree(self):
+        """
+        :return: the nested tree, equal to loading the source json
+        """
+        columns = {field: self.column(field) for field in self.header["columns"]}
+        # per key order: the keys with their columns (None for children)
+        key_orders = [[(key, None if key == "children" else columns[key]) for key in keys]
+                      for keys in self.header["key_orders"]]
+        nodes = []
+        for index, (parent, key_order) in enumerate(zip(self.parent.tolist(), self.arrays["key_order"].tolist())):
+            node = {key: [] if values is None else values[index] for key, values in key_orders[key_order]}
+            nodes.append(node)
+            # pre-order: parents precede their children
+            if parent >= 0:
+                nodes[parent]["children"].append(node)
+        return nodes[0]
+
+    def close(self):
+        self.arrays = {}
+        try:
+            self._mmap.close()
+        except BufferError:
+            # arrays are still referenced outside, the file is closed when they are released
+            pass
+
+
+def load_tree(ontology_file):
+    """
+    :param ontology_file: binary ontology file
+    :return: the nested tree
+    """
+    ontology = CompiledOntology(ontology_file)
+    if ontology.is_stale():
+        logger.warning("Binary ontology {} is older than its source {}".format(ontology_file,
+                                                                              ontology.header["source"]))
+    tree = ontology.to_tree()
+    ontology.close()
+    return tree
+
+
+def read_source_tree(input_file, input_format=None):
+    """
+    Reads an ontology as a nested tree
+    :param input_file: json tree, owl/obo (pronto), or ClassyFire json
+    :param input_format: tree_json, owl, or classyfire. None: by file extension (json: tree_json)
+    :return: the root node
+    """
+    if input_format is None:
+        input_format = "owl" if Path(input_file).suffix.lower() in (".owl", ".obo") else "tree_json"
+    if input_format == "tree_json":
+        with open(input_file) as json_file:
+            return json.load(json_file)
+    # export like the json converters to get the same tree
+    from anytree.exporter import JsonExporter
+    if input_format == "owl":
+        import gfop_to_json
+        root = gfop_to_json.create_tree(input_file)
+    elif input_format == "classyfire":
+        import classyfire_to_json_ontology
+        root = classyfire_to_json_ontology.create_tree(input_file)
+    else:
+        raise ValueError("Unknown ontology format {}".format(input_format))
+    return json.loads(JsonExporter(indent=2, sort_keys=True).export(root))
+
+
+def compile_ontology(input_file, output_file=None, input_format=None):
+    """
+    Compiles an ontology file into the binary format
+    :param output_file: None: the input file with suffix .ontbin
+    :return: the output file
+    """
+    if output_file is None:
+        output_file = str(Path(input_file).with_suffix(BINARY_SUFFIX))
+    compile_tree(read_source_tree(input_file, input_format), output_file, source=input_file)
+    return output_file
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Compile an ontology into a binary file that is memory mapped and '
+                                                 'loads fast')
+    parser.add_argument('--input', type=str, help='json tree, owl/obo, or ClassyFire json file',
+                        default="../data/microbe_masst/ncbi.json")
+    parser.add_argument('--output', type=str, help='output file. Default: input with suffix .ontbin',
+                        default=None)
+    parser.add_argument('--format', type=str, choices=["tree_json", "owl", "classyfire"],
+                        help='input format. Default: by file extension', default=None)
+    args = parser.parse_args()
+
+    try:
+        compile_ontology(args.input, args.output, args.format)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
@@ -0,0 +1,393 @@
+import argparse
+import json
+import sys
+import logging
+from pathlib import Path
+
+import numpy as np
+
+import flat_tree
+import gfop_to_json
+import json_ontology_extender
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class OntologyDag(flat_tree.FlatTree):
+    """
+    Ontology with multiple parents per node (directed acyclic graph). Each node is stored once and referenced by all
+    its parents instead of copying its subtree under every parent. Nodes are listed in pre-order of the depth-first
+    traversal from the root (index 0): parent and depth refer to the parent that reaches a node first (primary parent)
+    so that the FlatTree passes work on this spanning tree. All edges are kept in child_lists and parent_lists (primary
+    parent first) as python lists, which are faster to traverse node by node than array slices. Trees with copied
+    subtrees are only materialized for rendering (see to_tree and to_compact_json).
+    """
+
+    def __init__(self, nodes, children):
+        """
+        :param nodes: list of field dicts (without children), index 0 is the root. Unreachable nodes are dropped
+        :param children: list of ordered child indices per node
+        """
+        # depth-first pre-order, a node is placed when it is reached the first time
+        order = []
+        index_of = np.full(len(nodes), -1, dtype=np.int64)
+        primary = np.full(len(nodes), -1, dtype=np.int64)
+        stack = [(0, -1)]
+        while stack:
+            node, parent = stack.pop()
+            if index_of[node] >= 0:
+                continue
+            index_of[node] = len(order)
+            primary[node] = parent
+            order.append(node)
+            stack.extend((child, node) for child in reversed(children[node]) if index_of[child] < 0)
+        if len(order) < len(nodes):
+            logger.warning("{} nodes are not connected to the root".format(len(nodes) - len(order)))
+
+        edges = [(int(index_of[node]), int(index_of[child])) for node in order for child in children[node]]
+        parents = np.array([-1] + [index_of[primary[node]] for node in order[1:]], dtype=np.int64)
+        self.nodes = [nodes[node] for node in order]
+        self.compiled = None
+
+        # parents of each node, the primary parent first
+        primary_parents = parents.tolist()
+        self.child_lists = [[] for _ in order]
+        self.parent_lists = [[] for _ in order]
+        for node, child in edges:
+            self.child_lists[node].append(child)
+            if node == primary_parents[child]:
+                self.parent_lists[child].insert(0, node)
+            else:
+                self.parent_lists[child].append(node)
+        self.parent_counts = np.array([len(parent_list) for parent_list in self.parent_lists], dtype=np.int64)
+
+        self.topological_order = self._topological_order()
+        depth = [0] * len(order)
+        for node in range(1, len(order)):
+            depth[node] = depth[primary_parents[node]] + 1
+        self._init_arrays(parents, np.array(depth, dtype=np.int64))
+        # nodes below a node with multiple parents need the exact ancestor sets in accumulate_array
+        self.shared_descendants = self.descendant_mask(np.flatnonzero(self.parent_counts > 1))
+
+    @classmethod
+    def from_tree(cls, root, node_key="NCBI"):
+        """
+        Merges the nodes of a nested tree that have the same node_key value and the same subtree (e.g., a taxon with
+        all its descendants copied under multiple parents) into one node with the fields of its first occurrence.
+        Occurrences with different children (e.g., a genus with other species under another parent) are kept as
+        separate nodes, so that no node gains children it does not have in the tree. Nodes without node_key are never
+        merged
+        :param root: the root node of a tree structure with ["children"] property, is not changed
+        :param node_key: the field that identifies equal nodes
+        """
+        tree = flat_tree.FlatTree(root)
+        keys = tree.columns([node_key])[node_key]
+        tree_children = [[] for _ in range(len(tree))]
+        for child, parent in enumerate(tree.parent.tolist()):
+            if parent >= 0:
+                tree_children[parent].append(child)
+
+        # subtree signatures from the leaves up: equal keys and equal child signatures
+        signature_ids = {}
+        signatures = [0] * len(tree)
+        for index in range(len(tree) - 1, -1, -1):
+            key = keys[index]
+            if key is None:
+                signature = (None, index)
+            else:
+                signature = (str(key), tuple(signatures[child] for child in tree_children[index]))
+            signatures[index] = signature_ids.setdefault(signature, len(signature_ids))
+
+        nodes = []
+        first_occurrences = []
+        index_by_signature = {}
+        for index, node in enumerate(tree.nodes):
+            if signatures[index] not in index_by_signature:
+                index_by_signature[signatures[index]] = len(nodes)
+                nodes.append({field: value for field, value in node.items() if field != "children"})
+                first_occurrences.append(index)
+        children = []
+        for index in first_occurrences:
+            node_children = []
+            for child in tree_children[index]:
+                child = index_by_signature[signatures[child]]
+                if child not in node_children:
+                    node_children.append(child)
+            children.append(node_children)
+
+        signatures_by_key = {}
+        for key, _ in signature_ids:
+            if key is not None:
+                signatures_by_key[key] = signatures_by_key.get(key, 0) + 1
+        different = sum(1 for count in signatures_by_key.values() if count > 1)
+        if different > 0:
+            logger.warning("{} {} values have occurrences with different children, these occurrences are kept as "
+                           "separate nodes".format(different, node_key))
+        merged = sum(len(node_children) for node_children in children) - (len(nodes) - 1)
+        if merged > 0:
+            logger.info("{} nodes are referenced by multiple parents".format(merged))
+        return cls(nodes, children)
+
+    @classmethod
+    def from_terms(cls, terms, root_name="GFOP"):
+        """
+        Ontology with all parents of each term, unlike gfop_to_json.create_tree which only keeps one. Terms are
+        identified by their id, terms without (known) parents are added to the root
+        :param terms: iterable of (id, name, list of parent ids), see gfop_to_json.read_terms
+        """
+        nodes = [{"name": root_name}]
+        parent_ids = [[]]
+        index_by_id = {}
+        for id, name, parents in terms:
+            index = index_by_id.get(id)
+            if index is None:
+                index_by_id[id] = len(nodes)
+                nodes.append({"id": id, "name": name})
+                parent_ids.append(list(parents))
+            else:
+                # the same class defined again
+                if nodes[index]["name"] is None:
+                    nodes[index]["name"] = name
+                parent_ids[index].extend(parent for parent in parents if parent not in parent_ids[index])
+
+        children = [[] for _ in nodes]
+        for index in range(1, len(nodes)):
+            known = [index_by_id[parent] for parent in parent_ids[index] if parent in index_by_id]
+            for parent in (known or [0]):
+                children[parent].append(index)
+        dag = cls(nodes, children)
+        if len(dag) < len(nodes):
+            raise ValueError("{} terms are in cycles".format(len(nodes) - len(dag)))
+        return dag
+
+    @classmethod
+    def from_compact(cls, data):
+        """
+        :param data: dict in the format of to_compact_json
+        """
+        columns = data["columns"]
+        nodes = [{field: values[index] for field, values in columns.items() if values[index] is not None}
+                 for index in range(len(data["parent"]))]
+        children = [[] for _ in nodes]
+        for index, parent in enumerate(data["parent"]):
+            if parent >= 0:
+                children[parent].append(index)
+        for child, parent, position in data.get("shared", []):
+            children[parent].insert(position, child)
+        return cls(nodes, children)
+
+    def _topological_order(self):
+        """
+        :return: array of node indices where all parents come before their children
+        :raises ValueError: if the graph has a cycle
+        """
+        remaining = self.parent_counts.tolist()
+        order = [0]
+        position = 0
+        while position < len(order):
+            node = order[position]
+            position += 1
+            for child in self.child_lists[node]:
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    order.append(child)
+        if len(order) < len(self.nodes):
+            raise ValueError("{} nodes are in cycles".format(len(self.nodes) - len(order)))
+        return np.array(order, dtype=np.int64)
+
+    def descendant_mask(self, nodes):
+        """
+        :param nodes: node indices
+        :return: boolean array that marks the nodes and all their descendants
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if not mask[node]:
+                mask[node] = True
+                stack.extend(self.child_lists[node])
+        return mask
+
+    def ancestors(self, index):
+        """
+        :return: array of the node and all its ancestors over all parents, each listed once
+        """
+        seen = {index}
+        stack = [index]
+        while stack:
+            for parent in self.parent_lists[stack.pop()]:
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+        return np.fromiter(seen, dtype=np.int64, count=len(seen))
+
+    def accumulate_array(self, values):
+        """
+        Each value is added once to every ancestor, even if the ancestor reaches the node over multiple paths. Nodes
+        that are not below a shared node are accumulated level by level on the spanning tree, the others over their
+        ancestor sets
+        :param values: array of the values per node
+        :return: array of each node's value plus the sum over all its distinct descendants
+        """
+        shared = self.shared_descendants
+        if not shared.any():
+            return super().accumulate_array(values)
+        accumulated = super().accumulate_array(np.where(shared, 0, values))
+        for node in np.flatnonzero(shared & (values != 0)).tolist():
+            accumulated[self.ancestors(node)] += values[node]
+        return accumulated
+
+    def path_counts(self):
+        """
+        :return: list of the number of copies of each node in the materialized tree (paths from the root)
+        """
+        # python ints as the number of paths can grow exponentially
+        counts = [0] * len(self)
+        counts[0] = 1
+        for node in self.topological_order.tolist():
+            for child in self.child_lists[node]:
+                counts[child] += counts[node]
+        return counts
+
+    def materialized_size(self):
+        """
+        :return: the number of nodes in the materialized tree (see to_tree)
+        """
+        return sum(self.path_counts())
+
+    def shared_edges(self):
+        """
+        :return: list of [child, parent, position] of all edges that are not on the spanning tree. position is the
+        index of the child in all children of the parent
+        """
+        shared = []
+        for parent in range(len(self)):
+            for position, child in enumerate(self.child_lists[parent]):
+                if self.parent[child] != parent:
+                    shared.append([child, parent, position])
+        return shared
+
+    def to_tree(self, copy_shared=True, max_nodes=None):
+        """
+        Materializes the nested tree for rendering. Nodes are shallow copies, the field values are shared
+        :param copy_shared: place a copy of each shared node and its subtree under every parent. False: only under
+        the primary parent (spanning tree), the values still count each descendant once
+        :param max_nodes: raise a ValueError if the materialized tree would have more nodes. None: no limit
+        :return: the root node of a tree structure with ["children"] property
+        """
+        if copy_shared and max_nodes is not None and self.materialized_size() > max_nodes:
+            raise ValueError("The materialized tree has more than {} nodes".format(max_nodes))
+        root = dict(self.nodes[0])
+        stack = [(0, root)]
+        while stack:
+            index, node = stack.pop()
+            children = [child for child in self.child_lists[index] if copy_shared or self.parent[child] == index]
+            if children:
+                node["children"] = [dict(self.nodes[child]) for child in children]
+                stack.extend(zip(children, node["children"]))
+        return root
+
+    def to_compact_dict(self, exclude=("children", "pie_data")):
+        """
+        :return: dict of {"parent": [primary parent per node], "columns": {field: [value per node]}, "shared":
+        [[child, parent, position]]}, see json_ontology_extender.tree_to_columns and shared_edges
+        """
+        fields = {}
+        for node in self.nodes:
+            for field in node:
+                if field not in exclude:
+                    fields.setdefault(field, None)
+        return {"parent": self.parent.tolist(), "columns": self.columns(fields), "shared": self.shared_edges()}
+
+    def to_compact_json(self):
+        """
+        Compact json like json_ontology_extender.tree_to_compact_json with the additional shared edges. Each node is
+        exported once, the html (collapsible_tree_v3_internal_data.js inflateTree) copies the shared subtrees
+        :return: the json string
+        """
+        return json.dumps(self.to_compact_dict(), separators=(",", ":"), cls=json_ontology_extender.NpEncoder)
+
+
+def add_data_to_dag(dag, df, node_key="NCBI", data_key="ncbi", add_pie_data=True, id_field="NCBI"):
+    """
+    Like json_ontology_extender.add_data_to_ontology but each node is counted once in every ancestor, also if the
+    ancestor reaches it over multiple parents. The root counts all its descendants once (without its own data)
+    :param dag: the OntologyDag, its nodes are changed in place
+    :param df: the data frame with additional data
+    :param node_key: the field in the ontology to be compared to the data_key column
+    :param data_key: the column in the data frame to be compared to the node_key field
+    :param add_pie_data: add the pie_data to every node. Not needed for the compact json
+    :param id_field: the id that every node should have, a root without it is given its name
+    :return: the dag
+    """
+    df = df.assign(**{data_key: df[data_key].astype(str)})
+    dag.merge(json_ontology_extender.build_data_index(df, data_key), node_key)
+
+    root = dag.nodes[0]
+    if dag.missing(id_field):
+        if root.get(id_field) is None:
+            logger.error("Missing: {}".format(root.get("name", "NONAME")))
+            root[id_field] = root.get("name", "")
+        logger.error("{} id is missing in a node".format(id_field))
+
+    columns = dag.columns(["group_size", "matched_size"])
+    root_children = dag.child_lists[0]
+    for field, values in columns.items():
+        values = list(values)
+        if any(value is None for value in values):
+            values[0] = 0
+            values = dag.accumulate_values(values)
+        else:
+            values[0] = sum(values[child] for child in root_children)
+        columns[field] = values
+    columns["occurrence_fraction"] = dag.ratio_values(columns["matched_size"], columns["group_size"])
+    dag.set_columns(columns)
+
+    if add_pie_data:
+        for node in dag.nodes:
+            json_ontology_extender.add_pie_data_to_node(node)
+    return dag
+
+
+def load_dag(input, node_key="NCBI"):
+    """
+    :param input: owl (RDF/XML) or obo file, json ontology file with children (nodes with the same node_key and the
+    same subtree are merged, see OntologyDag.from_tree), or a compact dag json (see OntologyDag.to_compact_json)
+    :return: the OntologyDag
+    """
+    suffix = Path(input).suffix.lower()
+    if suffix in (".owl", ".obo"):
+        return OntologyDag.from_terms(gfop_to_json.read_terms(input))
+    with open(input, encoding="utf-8") as file:
+        data = json.load(file)
+    if "parent" in data and "columns" in data:
+        return OntologyDag.from_compact(data)
+    return OntologyDag.from_tree(data, node_key)
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Convert an ontology with multiple parents per node into a compact '
+                                                 'json that lists every node once')
+    parser.add_argument('--input', type=str, help='owl, obo, or json ontology file',
+                        default="../data/microbe_masst/ncbi.json")
+    parser.add_argument('--node_key', type=str,
+                        help='nodes of a json tree with the same value and subtree are merged', default="NCBI")
+    parser.add_argument('--output', type=str, help='output compact dag json', default="dist/ontology_dag.json")
+    args = parser.parse_args()
+
+    try:
+        dag = load_dag(args.input, args.node_key)
+        logger.info("{} nodes, {} with multiple parents, {} nodes in the materialized tree".format(
+            len(dag), int((dag.parent_counts > 1).sum()), dag.materialized_size()))
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(dag.to_compact_json())
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
@@ -0,0 +1,274 @@
+import os
+import sys
+import argparse
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import bundle_to_html
+import flat_tree
+import json_ontology_extender
+import microbe_masst_results
+import ontology_binary
+import pipeline_profile
+from minify_cache import DEFAULT_MINIFY_CACHE_DIR
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class OntologyMatrix:
+    """
+    Accumulated counts of many compounds (columns) over all nodes of an ontology (rows in pre-order, see
+    flat_tree.FlatTree). present marks the nodes that were matched directly by a compound's count table.
+    """
+    compounds: np.ndarray
+    node_ids: np.ndarray
+    names: np.ndarray
+    parent: np.ndarray
+    group_size: np.ndarray
+    matched_size: np.ndarray
+    present: np.ndarray
+    accumulated_group_size: bool
+    accumulated_matched_size: np.ndarray
+
+    @property
+    def occurrence_fraction(self):
+        """
+        :return: matrix of matched_size / group_size, 0 if the group is empty
+        """
+        group_size = self.group_size.astype(np.float64)[:, None]
+        fractions = np.zeros(self.matched_size.shape, dtype=np.float64)
+        np.divide(self.matched_size, group_size, out=fractions, where=group_size != 0)
+        return fractions
+
+    def compound_index(self, compound):
+        return int(np.flatnonzero(self.compounds == compound)[0])
+
+
+def compute_matrix(tree_root, counts_by_compound, node_key="NCBI", data_key="ncbi", count_field="matched_size"):
+    """
+    Aligns many count tables into a nodes x compounds matrix and accumulates all compounds at once. The results are
+    equal to add_data_to_ontology for each compound, but only the count_field is merged
+    :param tree_root: the root node of the ontology (is not changed) or an ontology_binary.CompiledOntology
+    :param counts_by_compound: dict of {compound: data frame with the data_key and count_field columns}
+    :param node_key: the field in the ontology to be compared to the data_key column
+    :param data_key: the column in the count tables to be compared to the node_key field
+    :param count_field: the column with the counts
+    :return: OntologyMatrix
+    """
+    if isinstance(tree_root, ontology_binary.CompiledOntology):
+        tree = flat_tree.FlatTree.from_compiled(tree_root)
+    else:
+        tree = flat_tree.FlatTree(tree_root)
+    compounds = list(counts_by_compound.keys())
+    node_keys = pd.Index([None if key is None else str(key) for key in tree.columns([node_key])[node_key]],
+                         dtype=object)
+
+    # nodes that are not matched keep the count_field of the ontology (None counts as 0), like in add_data_to_ontology
+    node_values = tree.columns([count_field])[count_field]
+    node_missing = np.array([value is None for value in node_values], dtype=bool)
+    node_counts = tree.numeric_array(node_values)
+    matched_size = np.repeat(node_counts[:, None], len(compounds), axis=1)
+    present = np.zeros((len(tree), len(compounds)), dtype=bool)
+    for column, compound in enumerate(compounds):
+        counts_df = counts_by_compound[compound]
+        # only the first row of each key is used, like in add_data_to_node
+        keys = counts_df[data_key].astype(str)
+        first_rows = (~keys.duplicated(keep="first")).to_numpy()
+        positions = pd.Index(keys[first_rows]).get_indexer(node_keys)
+        values = counts_df[count_field].to_numpy()[first_rows]
+        if values.dtype.kind not in "iu" and matched_size.dtype.kind != "f":
+            matched_size = matched_size.astype(np.float64)
+        present[:, column] = positions >= 0
+        matched_size[present[:, column], column] = values[positions[present[:, column]]]
+
+    # sizes are only accumulated if a node lacks them, like in add_data_to_ontology
+    group_values = tree.columns(["group_size"])["group_size"]
+    accumulated_group_size = any(value is None for value in group_values)
+    group_size = tree.numeric_array(group_values)
+    if accumulated_group_size:
+        group_size = tree.accumulate_array(group_size)
+    # accumulated if any node lacks the count after the merge
+    accumulated_matched_size = (node_missing[:, None] & ~present).any(axis=0)
+    matched_size = np.where(accumulated_matched_size, tree.accumulate_array(matched_size), matched_size)
+
+    # root sums over its children, like calc_root_stats
+    root_children = tree.parent == 0
+    group_size[0] = group_size[root_children].sum()
+    matched_size[0] = matched_size[root_children].sum(axis=0)
+
+    names = tree.columns(["name"])["name"]
+    return OntologyMatrix(np.array(compounds, dtype=str), np.array(node_keys, dtype=str),
+                          np.array(names, dtype=str), tree.parent, group_size, matched_size, present,
+                          accumulated_group_size, accumulated_matched_size)
+
+
+def save_matrix(matrix, out_file):
+    """
+    Saves the matrix as a compressed numpy archive (npz)
+    """
+    np.savez_compressed(out_file, compounds=matrix.compounds, node_ids=matrix.node_ids, names=matrix.names,
+                        parent=matrix.parent, group_size=matrix.group_size, matched_size=matrix.matched_size,
+                        present=matrix.present, accumulated_group_size=matrix.accumulated_group_size,
+                        accumulated_matched_size=matrix.accumulated_matched_size)
+
+
+def load_matrix(matrix_file):
+    """
+    :param matrix_file: npz file, see save_matrix
+    :return: OntologyMatrix
+    """
+    with np.load(matrix_file) as data:
+        return OntologyMatrix(data["compounds"], data["node_ids"], data["names"], data["parent"],
+                              data["group_size"], data["matched_size"], data["present"],
+                              bool(data["accumulated_group_size"]), data["accumulated_matched_size"])
+
+
+def compound_tree(matrix, tree_root, compound, add_pie_data=True, id_field="NCBI"):
+    """
+    Creates the merged tree of one compound, equal to the result of add_data_to_ontology for its count table
+    :param tree_root: the root node of the ontology that was used to compute the matrix, is not changed
+    :param id_field: see add_data_to_ontology, a root without it is given its name
+    :return: the merged tree root
+    """
+    column = matrix.compound_index(compound)
+    tree_root = json_ontology_extender.copy_tree(tree_root)
+    tree = flat_tree.FlatTree(tree_root)
+    matched_size = matrix.matched_size[:, column].tolist()
+    # directly matched nodes receive their counts before the accumulation (keeps the field order)
+    for index in np.flatnonzero(matrix.present[:, column]).tolist():
+        tree.nodes[index]["matched_size"] = matched_size[index]
+    if tree_root.get(id_field) is None:
+        tree_root[id_field] = tree_root.get("name", "")
+
+    columns = {}
+    if matrix.accumulated_group_size:
+        columns["group_size"] = matrix.group_size.tolist()
+    if matrix.accumulated_matched_size[column]:
+        columns["matched_size"] = matched_size
+    columns["occurrence_fraction"] = tree.ratio_values(matched_size, matrix.group_size.tolist())
+    tree.set_columns(columns)
+    json_ontology_extender.calc_root_stats(tree_root)
+    if add_pie_data:
+        for node in tree.nodes:
+            json_ontology_extender.add_pie_data_to_node(node)
+    return tree_root
+
+
+def export_reports(matrix, tree_root, out_dir, in_html="collapsible_tree_v3.html", compress_out_html=True,
+                   minify_cache_dir=None):
+    """
+    Writes one html report per compound with matches (compact tree data in the precompiled html). The file names are
+    the compound names with all characters except letters, digits, -, _, and . replaced by _
+    :param minify_cache_dir: cache the minified JS and CSS in this directory. None: no cache
+    :return: dict of {compound: html file}
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    reports = {}
+    used_names = set()
+    for column, compound in enumerate(matrix.compounds.tolist()):
+        if matrix.matched_size[0, column] <= 0:
+            continue
+        compound_root = compound_tree(matrix, tree_root, compound, add_pie_data=False)
+        # compounds with the same safe name get a counter
+        name = pipeline_profile.safe_name(compound)
+        unique_name = name
+        counter = 1
+        while unique_name.lower() in used_names:
+            counter += 1
+            unique_name = "{}_{}".format(name, counter)
+        used_names.add(unique_name.lower())
+        out_html = os.path.join(out_dir, "{}.html".format(unique_name))
+        bundle_to_html.build_dist_html(in_html, out_html, compress=compress_out_html,
+                                       data_json=json_ontology_extender.tree_to_compact_json(compound_root),
+                                       precompiled=True, minify_cache_dir=minify_cache_dir)
+        reports[compound] = out_html
+    return reports
+
+
+def read_counts_files(counts_files):
+    """
+    :param counts_files: tab separated count tables, the compound name is the file name
+    :return: dict of {compound: data frame}
+    """
+    return {Path(file).stem: pd.read_csv(file, sep="\t") for file in counts_files}
+
+
+def count_masst_files(metadata_file, masst_files):
+    """
+    Counts the matches per taxon of many MASST result files with one metadata table
+    :return: dict of {compound: counts data frame}, the compound name is the file name
+    """
+    metadata_df = microbe_masst_results.read_metadata(metadata_file)
+    return {Path(file).stem: microbe_masst_results.count_matches_in_file(metadata_df, file) for file in masst_files}
+
+
+def run_matrix(counts_by_compound, in_ontology="../data/microbe_masst/ncbi.json", out_matrix="dist/matrix.npz",
+               out_html_dir=None, node_key="NCBI", data_key="ncbi", in_html="collapsible_tree_v3.html",
+               compress_out_html=True):
+    """
+    Computes and saves the matrix of many compounds and optionally writes the html reports
+    :param out_html_dir: directory of the per compound reports. None: no reports
+    :return: OntologyMatrix
+    """
+    if str(in_ontology).endswith(ontology_binary.BINARY_SUFFIX):
+        # read the columns directly from the binary ontology
+        compiled = ontology_binary.CompiledOntology(in_ontology)
+        matrix = compute_matrix(compiled, counts_by_compound, node_key, data_key)
+        tree_root = compiled.to_tree() if out_html_dir is not None else None
+        compiled.close()
+    else:
+        tree_root = json_ontology_extender.load_ontology(in_ontology)
+        matrix = compute_matrix(tree_root, counts_by_compound, node_key, data_key)
+    save_matrix(matrix, out_matrix)
+    logger.info("Saved {} nodes x {} compounds to {}".format(len(matrix.node_ids), len(matrix.compounds), out_matrix))
+    if out_html_dir is not None:
+        reports = export_reports(matrix, tree_root, out_html_dir, in_html, compress_out_html,
+                                 DEFAULT_MINIFY_CACHE_DIR)
+        logger.info("Exported {} reports to {}".format(len(reports), out_html_dir))
+    return matrix
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Merge the counts of many compounds into an ontology at once and '
+                                                 'save a nodes x compounds matrix')
+    parser.add_argument('--ontology', type=str, help='the json ontology file with children or a compiled binary '
+                                                     'ontology (.ontbin)',
+                        default="../data/microbe_masst/ncbi.json")
+    parser.add_argument('--counts_files', type=str, nargs="+", help='tab separated count tables (one per compound)',
+                        default=None)
+    parser.add_argument('--masst_files', type=str, nargs="+", help='MASST result files (one per compound) that are '
+                                                                   'counted with the metadata file', default=None)
+    parser.add_argument('--metadata_file', type=str, help='microbe masst metadata',
+                        default="../data/microbe_masst/microbe_masst_table.csv")
+    parser.add_argument('--out_matrix', type=str, help='output npz file', default="dist/matrix.npz")
+    parser.add_argument('--out_html_dir', type=str, help='export one html report per compound to this directory',
+                        default=None)
+    parser.add_argument('--node_key', type=str, help='the field in the ontology to be compare to the field in the '
+                                                     'data file', default="NCBI")
+    parser.add_argument('--data_key', type=str,
+                        help='the field in the data file to be compared to the field in the ontology',
+                        default="ncbi")
+    args = parser.parse_args()
+
+    try:
+        counts_by_compound = {}
+        if args.counts_files is not None:
+            counts_by_compound.update(read_counts_files(args.counts_files))
+        if args.masst_files is not None:
+            counts_by_compound.update(count_masst_files(args.metadata_file, args.masst_files))
+        run_matrix(counts_by_compound, args.ontology, args.out_matrix, args.out_html_dir, args.node_key,
+                   args.data_key)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import argparse
+import threading
+import tracemalloc
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# the JobProfile of the running job (per thread or task)
+current_profile = ContextVar("current_profile", default=None)
+
+# appends of multiple threads to the same json lines file
+profile_file_lock = threading.Lock()
+
+# jobs that need tracemalloc, it is stopped when the last job finishes
+tracing_jobs = 0
+tracing_lock = threading.Lock()
+# profiled jobs running in this process and the number of started jobs. The tracemalloc peak is process wide, so the
+# traced peak of a stage is only recorded if no other job ran during the stage
+running_jobs = 0
+started_jobs = 0
+# only one cProfile profiler can be active per process (Python 3.12+ raises a ValueError for a second one), jobs that
+# start while another job is profiled skip the cProfile dump
+profiler_active = False
+
+
+def max_rss_mb():
+    """
+    :return: the peak resident memory of this process in MB or None if unknown (the resource module is Unix only)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return max_rss / 1024 / 1024 if sys.platform == "darwin" else max_rss / 1024
+
+
+def rounded_max_rss_mb():
+    max_rss = max_rss_mb()
+    return None if max_rss is None else round(max_rss, 1)
+
+
+def single_job_run():
+    """
+    :return: the number of started jobs if only one profiled job runs in this process, otherwise None
+    """
+    with tracing_lock:
+        return started_jobs if running_jobs == 1 else None
+
+
+def safe_name(name):
+    """
+    :return: the name with all characters except letters, digits, -, _, and . replaced by _ (for file names)
+    """
+    return "".join(char if char.isalnum() or char in "-_." else "_" for char in str(name))
+
+
+def start_profiler():
+    """
+    :return: an enabled cProfile.Profile or None if another job or profiling tool is active
+    """
+    global profiler_active
+    with tracing_lock:
+        if profiler_active:
+            return None
+        profiler_active = True
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        return profiler
+    except ValueError as e:
+        logger.warning("Skipping cProfile: {}".format(e))
+        with tracing_lock:
+            profiler_active = False
+        return None
+
+
+def stop_profiler(profiler):
+    global profiler_active
+    profiler.disable()
+    with tracing_lock:
+        profiler_active = False
+
+
+class JobProfile:
+    """
+    Timing and peak memory of the stages of one pipeline job. Stages are nested (depth 0 is the entry point) and listed
+    in the order they finished. max_rss_mb is None where the resource module is missing (Windows). peak_traced_mb is
+    only recorded while tracemalloc is tracing and no other profiled job runs in this process (e.g., in sequential
+    runs or in render worker processes), as the tracemalloc peak is process wide.
+    """
+
+    def __init__(self, entry, job):
+        self.entry = entry
+        self.job = str(job)
+        self.start = time.time()
+        self.stages = []
+        # running maxima of the traced memory of the open stages, see stage
+        self._traced_peaks = []
+
+    def to_record(self, seconds, status):
+        return {"entry": self.entry, "job": self.job, "status": status, "start": self.start,
+                "seconds": round(seconds, 6), "max_rss_mb": rounded_max_rss_mb(), "stages": self.stages}
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a stage of the running job. Does nothing if no job is profiled
+    :param name: the stage name, e.g., fast_masst
+    """
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+
+    run = single_job_run()
+    tracing = run is not None and tracemalloc.is_tracing()
+    if tracing:
+        # the peak of the enclosing stage is kept before the peak is reset for this stage
+        if profile._traced_peaks:
+            profile._traced_peaks[-1] = max(profile._traced_peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    profile._traced_peaks.append(0)
+    depth = len(profile._traced_peaks) - 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = {"stage": name, "depth": depth, "seconds": round(time.perf_counter() - start, 6),
+                  "max_rss_mb": rounded_max_rss_mb()}
+        peak = profile._traced_peaks.pop()
+        if tracing and tracemalloc.is_tracing() and single_job_run() == run:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            if profile._traced_peaks:
+                profile._traced_peaks[-1] = max(profile._traced_peaks[-1], peak)
+            record["peak_traced_mb"] = round(peak / 1024 / 1024, 2)
+        profile.stages.append(record)
+
+
+@contextmanager
+def profile_job(entry, job, profile_file=None, profile_dir=None):
+    """
+    Profiles a pipeline job and writes its stage timings as one json line. A job inside another profiled job (e.g.,
+    create_tree_html inside run_microbe_masst) becomes a stage of the outer job
+    :param entry: the pipeline entry point, e.g., run_microbe_masst
+    :param job: the job name, e.g., the USI or the output file
+    :param profile_file: json lines file that the job record is appended to. None: only logged
+    :param profile_dir: dump the cProfile stats (.prof) and a tracemalloc snapshot (.tracemalloc) of the job to this
+    directory. Also records the traced peak memory per stage. Only one job at a time is profiled with cProfile,
+    concurrent jobs only dump the snapshot. None: no dumps
+    """
+    global tracing_jobs, running_jobs, started_jobs
+    if current_profile.get() is not None:
+        with stage(entry):
+            yield
+        return
+
+    profile = JobProfile(entry, job)
+    token = None
+    running = False
+    traced = False
+    profiler = None
+    dump_name = None
+    start = time.perf_counter()
+    status = "error"
+    try:
+        with tracing_lock:
+            running_jobs += 1
+            started_jobs += 1
+            running = True
+        token = current_profile.set(profile)
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+            dump_name = os.path.join(profile_dir, "{}_{}".format(safe_name(entry), safe_name(job)))
+            with tracing_lock:
+                if tracing_jobs == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                tracing_jobs += 1
+                traced = True
+            profiler = start_profiler()
+
+        with stage(entry):
+            yield profile
+        status = "ok"
+    finally:
+        seconds = time.perf_counter() - start
+        if token is not None:
+            current_profile.reset(token)
+        if running:
+            with tracing_lock:
+                running_jobs -= 1
+        if profiler is not None:
+            stop_profiler(profiler)
+            profiler.dump_stats(dump_name + ".prof")
+        if traced:
+            with tracing_lock:
+                if tracemalloc.is_tracing():
+                    tracemalloc.take_snapshot().dump(dump_name + ".tracemalloc")
+                tracing_jobs -= 1
+                if tracing_jobs == 0:
+                    tracemalloc.stop()
+        write_record(profile.to_record(seconds, status), profile_file)
+
+
+def write_record(record, profile_file=None):
+    line = json.dumps(record)
+    logger.info(line)
+    if profile_file is not None:
+        with profile_file_lock:
+            with open(profile_file, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+
+
+def read_records(profile_file, since=None):
+    """
+    :param since: only records of jobs that started at or after this time (seconds since the epoch). None: all
+    :return: list of job records
+    """
+    records = []
+    with open(profile_file, encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning("Skipping corrupt profile line in {}".format(profile_file))
+                continue
+            if since is None or record["start"] >= since:
+                records.append(record)
+    return records
+
+
+def summarize(records):
+    """
+    Aggregates the stage timings of many jobs
+    :param records: job records, see read_records
+    :return: dict of {entry: {"jobs", "failed", "seconds", "stages": {stage: {"count", "total_s", "mean_s",
+    "max_s", "max_rss_mb"}}}}. max_rss_mb is None if it was not recorded
+    """
+    summary = {}
+    for record in records:
+        entry = summary.setdefault(record["entry"], {"jobs": 0, "failed": 0, "seconds": 0.0, "stages": {}})
+        entry["jobs"] += 1
+        entry["failed"] += record["status"] != "ok"
+        entry["seconds"] += record["seconds"]
+        for stage_record in record["stages"]:
+            stats = entry["stages"].setdefault(stage_record["stage"], {"count": 0, "total_s": 0.0, "max_s": 0.0,
+                                                                       "max_rss_mb": None})
+            stats["count"] += 1
+            stats["total_s"] += stage_record["seconds"]
+            stats["max_s"] = max(stats["max_s"], stage_record["seconds"])
+            if stage_record.get("max_rss_mb") is not None:
+                stats["max_rss_mb"] = max(stats["max_rss_mb"] or 0.0, stage_record["max_rss_mb"])
+    for entry in summary.values():
+        entry["seconds"] = round(entry["seconds"], 6)
+        for stats in entry["stages"].values():
+            stats["mean_s"] = round(stats["total_s"] / stats["count"], 6)
+            stats["total_s"] = round(stats["total_s"], 6)
+    return summary
+
+
+def log_summary(summary):
+    for entry, entry_summary in summary.items():
+        logger.info("{}: {} jobs ({} failed) in {:.2f} s".format(entry, entry_summary["jobs"],
+                                                                 entry_summary["failed"], entry_summary["seconds"]))
+        stages = sorted(entry_summary["stages"].items(), key=lambda item: item[1]["total_s"], reverse=True)
+        for name, stats in stages:
+            max_rss = "n/a" if stats["max_rss_mb"] is None else "{:.0f} MB".format(stats["max_rss_mb"])
+            logger.info("  {:<28} n={:<6} total={:.3f} s mean={:.3f} s max={:.3f} s max_rss={}".format(
+                name, stats["count"], stats["total_s"], stats["mean_s"], stats["max_s"], max_rss))
+
+
+if __name__ == '__main__':
+    # parsing the arguments (all optional)
+    parser = argparse.ArgumentParser(description='Summarize the stage timings of profiled pipeline jobs')
+    parser.add_argument('--profile_file', type=str, help='json lines file with the job profiles',
+                        default="dist/profile.jsonl")
+    parser.add_argument('--out_summary', type=str, help='export the summary to this json file', default=None)
+    args = parser.parse_args()
+
+    try:
+        summary = summarize(read_records(args.profile_file))
+        log_summary(summary)
+        if args.out_summary is not None:
+            with open(args.out_summary, "w", encoding="utf-8") as file:
+                json.dump(summary, file, indent=2)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
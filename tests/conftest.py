@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import tempfile
+import threading
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+# the modules in src import each other by their bare names
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(SRC_DIR))
+
+# keep the default caches out of the home directory (read when the modules are imported)
+CACHE_DIR = tempfile.mkdtemp(prefix="gfopontology_tests_")
+os.environ["GFOP_MINIFY_CACHE"] = os.path.join(CACHE_DIR, "minify")
+os.environ["GFOP_METADATA_STORE_CACHE"] = os.path.join(CACHE_DIR, "metadata_store")
+
+
+@pytest.fixture
+def src_dir(monkeypatch):
+    """
+    Runs the test in src, the html templates and resources are referenced relative to it
+    """
+    monkeypatch.chdir(SRC_DIR)
+    return SRC_DIR
+
+
+class FastMasstStub(BaseHTTPRequestHandler):
+    """
+    fastMASST endpoint that returns the matches encoded in the usi parameter: "query/usi1+usi2" matches usi1 and usi2,
+    "query/usi1++usi2" adds a match without USI. USIs with FAIL return HTTP 500. The server records all requested USIs in its requests list
+    """
+
+    def do_GET(self):
+        usi = parse_qs(urlparse(self.path).query)["usi"][0]
+        self.server.requests.append(usi)
+        if "FAIL" in usi:
+            self.send_response(500)
+            self.end_headers()
+            return
+        matches = usi.split("/", 1)[1] if "/" in usi else ""
+        # empty entries are matches without USI
+        results = [{"USI": match, "Cosine": 0.9} if match else {"Cosine": 0.9}
+                   for match in (matches.split("+") if matches else [])]
+        body = json.dumps({"results": results}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fast_masst_server():
+    """
+    Local fastMASST stub, see FastMasstStub. Use server.url as search_url
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FastMasstStub)
+    server.requests = []
+    server.url = "http://127.0.0.1:{}/search".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,22 @@
+import os
+
+import benchmark_pipeline
+from conftest import CACHE_DIR
+
+
+def list_files(folder):
+    return {os.path.join(root, name) for root, _, names in os.walk(folder) for name in names}
+
+
+def test_caches_stay_in_the_work_dir_and_are_timed_cold_and_warm(src_dir, tmp_path):
+    user_caches = list_files(CACHE_DIR)
+    results = benchmark_pipeline.run_benchmark(depth=2, fan_out=3, metadata_rows=200, matches=20, masst_rows=50,
+                                               repeats=1, work_dir=str(tmp_path))
+
+    assert list_files(CACHE_DIR) == user_caches
+    timings = results["timings_s"]
+    for stage in ["create_counts_file", "create_counts_file_from_usi", "build_dist_html", "build_dist_html_precompiled",
+                  "end_to_end", "end_to_end_precompiled"]:
+        assert stage + "_cold" in timings and stage + "_warm" in timings
+    # the caches are removed with the benchmark
+    assert not (tmp_path / "metadata_store").exists() and not (tmp_path / "minify").exists()
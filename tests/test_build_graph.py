@@ -0,0 +1,50 @@
+import json
+
+import pandas as pd
+
+import build_graph
+
+
+def write_inputs(folder):
+    ontology = {"name": "root", "NCBI": "0", "children": [
+        {"name": "genus", "NCBI": "1", "children": [{"name": "species a", "NCBI": "2"}]},
+        {"name": "other", "NCBI": "3"},
+    ]}
+    in_ontology = folder / "ontology.json"
+    in_ontology.write_text(json.dumps(ontology))
+    metadata_file = folder / "metadata.csv"
+    pd.DataFrame({"Filepath": ["MSV1/f1.mzML", "MSV1/f2.mzML"], "MassIVE": ["MSV1", "MSV1"],
+                  "Taxa_NCBI": [2, 3]}).to_csv(metadata_file, index=False)
+    masst_files = []
+    for directory, filename in (("a", "MSV1/f1.mzML"), ("b", "MSV1/f2.mzML")):
+        (folder / directory).mkdir()
+        masst_file = folder / directory / "compound.tsv"
+        pd.DataFrame({"filename": [filename]}).to_csv(masst_file, sep="\t", index=False)
+        masst_files.append(str(masst_file))
+    return str(in_ontology), str(metadata_file), masst_files
+
+
+def test_compounds_with_the_same_name_do_not_collide(src_dir, tmp_path):
+    in_ontology, metadata_file, masst_files = write_inputs(tmp_path)
+    compounds = [build_graph.Compound("compound", str(tmp_path / directory / "report.html"), masst_file=masst_file)
+                 for directory, masst_file in zip(("a", "b"), masst_files)]
+    build_dir = str(tmp_path / "build")
+
+    graph = build_graph.run_build(compounds, in_ontology, metadata_file, build_dir=build_dir,
+                                  compress_out_html=False)
+    assert sum(1 for key in graph.built if key.startswith("tree:")) == 2
+    trees = sorted((tmp_path / "build" / "trees").glob("*.json"))
+    assert len(trees) == 2
+    matched = [json.loads(tree.read_text())["columns"]["matched_size"] for tree in trees]
+    assert sorted(matched) == sorted([[1, 1, 1, 0], [1, 0, 0, 1]])
+
+    graph = build_graph.run_build(compounds, in_ontology, metadata_file, build_dir=build_dir,
+                                  compress_out_html=False)
+    assert len(graph.built) == 0
+
+
+def test_masst_files_with_the_same_name_get_separate_reports(tmp_path):
+    compounds = build_graph.compounds_from_masst_files([str(tmp_path / "a" / "x.tsv"), str(tmp_path / "b" / "x.tsv")],
+                                                       str(tmp_path))
+    assert [compound.name for compound in compounds] == ["x", "x_2"]
+    assert len({compound.out_html for compound in compounds}) == 2
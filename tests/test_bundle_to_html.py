@@ -0,0 +1,55 @@
+import bundle_to_html
+from minify_cache import MinifyCache
+
+
+def write_many_assets_html(folder, count=12):
+    # more than 10 assets (GFOP_INLINE_ASSET_1 is a prefix of GFOP_INLINE_ASSET_10) and linked files that are appended
+    # after the inline assets, so that the token order differs from the document order
+    (folder / "style.css").write_text("body  {  color : red ; }\n")
+    (folder / "script.js").write_text("function linked ( a ) {\n  return a + 1 ;\n}\n")
+    scripts = "\n".join("<script>\nvar value_{0} = {0} ;\nconsole.log( value_{0} );\n</script>".format(i)
+                        for i in range(count))
+    html = ('<html><head><link rel="stylesheet" href="style.css"><style>\np  {  margin : 0px ; }\n</style></head>'
+            '<body><div id="tree">PLACEHOLDER_JSON_DATA</div>\n' + scripts +
+            '\n<script src="script.js"></script></body></html>')
+    (folder / "input.html").write_text(html)
+    return "input.html"
+
+
+def test_asset_tokens_are_not_prefixes():
+    assert bundle_to_html.asset_token(10).find(bundle_to_html.asset_token(1)) < 0
+
+
+def test_bundle_compressed_html_equals_whole_document_minification(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    input_html = write_many_assets_html(tmp_path)
+    expected = bundle_to_html.compress_html(bundle_to_html.bundle_html(input_html))
+
+    cache = MinifyCache(tmp_path / "minify_cache")
+    assert bundle_to_html.bundle_compressed_html(input_html, cache) == expected
+    # second call from the cache
+    assert bundle_to_html.bundle_compressed_html(input_html, cache) == expected
+    assert cache.hits > 0
+    assert "GFOP_INLINE_ASSET" not in expected
+
+
+def test_bundle_compressed_html_of_the_tree_template(src_dir, tmp_path):
+    input_html = "collapsible_tree_v3.html"
+    expected = bundle_to_html.compress_html(bundle_to_html.bundle_html(input_html))
+    actual = bundle_to_html.bundle_compressed_html(input_html, MinifyCache(tmp_path / "minify_cache"))
+    assert actual == expected
+
+
+def test_minify_cache_is_opt_in(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    input_html = write_many_assets_html(tmp_path)
+    cache_dirs = []
+    monkeypatch.setattr(bundle_to_html, "get_minify_cache",
+                        lambda cache_dir: cache_dirs.append(cache_dir) or MinifyCache(cache_dir))
+    for precompiled in [False, True]:
+        bundle_to_html.build_dist_html(input_html, "out.html", compress=True, data_json="{}", precompiled=precompiled)
+    assert cache_dirs == []
+
+    bundle_to_html.build_dist_html(input_html, "out.html", compress=True, data_json="{}",
+                                   minify_cache_dir=str(tmp_path / "minify"))
+    assert cache_dirs == [str(tmp_path / "minify")] and any((tmp_path / "minify").iterdir())
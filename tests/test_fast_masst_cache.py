@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+import pytest
+
+import fast_masst_cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # controls time.time in the cache, each call advances the clock by one second
+    now = [1000.0]
+
+    def time():
+        now[0] += 1
+        return now[0]
+
+    monkeypatch.setattr(fast_masst_cache.time, "time", time)
+    return now
+
+
+def matches(n):
+    return [{"USI": "mzspec:MSV1:file_{}:scan:{}".format(i, i), "Cosine": 0.9} for i in range(n)]
+
+
+def test_cache_key_is_normalized():
+    assert fast_masst_cache.FastMasstCache.cache_key(" usi ", "gnpsdata_index", 0.05, 0.02, 0.7) == \
+           fast_masst_cache.FastMasstCache.cache_key("usi", "gnpsdata_index", "0.050", 0.020, 0.70)
+
+
+def test_entries_expire(tmp_path, clock):
+    cache = fast_masst_cache.FastMasstCache(str(tmp_path / "cache.sqlite"), expire_after=timedelta(seconds=10))
+    cache.put("a", matches(2))
+    assert cache.get("a") == matches(2)
+    clock[0] += 10
+    assert cache.get("a") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "entries": 0, "size_bytes": 0}
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = fast_masst_cache.FastMasstCache(str(tmp_path / "cache.sqlite"))
+    cache.put("a", matches(3))
+    size = cache.stats()["size_bytes"]
+    cache.max_size_bytes = 2 * size
+    cache.put("b", matches(3))
+    # a was used more recently than b
+    assert cache.get("a") is not None
+    cache.put("c", matches(3))
+
+    assert cache.get("b") is None
+    assert cache.get("a") == matches(3) and cache.get("c") == matches(3)
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["entries"] == 2 and stats["size_bytes"] <= 2 * size
+    cache.close()
+
+    # the size and the entries are restored from the file
+    reopened = fast_masst_cache.FastMasstCache(str(tmp_path / "cache.sqlite"), max_size_bytes=2 * size)
+    assert reopened.stats()["size_bytes"] == stats["size_bytes"]
+    assert reopened.get("a") == matches(3)
@@ -0,0 +1,183 @@
+import copy
+import json
+import shutil
+import subprocess
+
+import pandas as pd
+import pytest
+
+import benchmark_json_ontology_extender as reference
+import flat_tree
+import json_ontology_extender
+
+
+def dumps(tree):
+    return json.dumps(tree, cls=json_ontology_extender.NpEncoder)
+
+
+def mixed_tree():
+    # one branch with a float value, the other one with ints only
+    return {"name": "root", "NCBI": "0", "children": [
+        {"name": "a", "NCBI": "1", "children": [
+            {"name": "a1", "NCBI": "2", "group_size": 2},
+            {"name": "a2", "NCBI": "3", "group_size": 0.5},
+        ]},
+        {"name": "b", "NCBI": "4", "children": [
+            {"name": "b1", "NCBI": "5", "group_size": 3},
+            {"name": "b2", "NCBI": "6"},
+        ]},
+    ]}
+
+
+def test_accumulate_mixed_column_equals_recursive_sum():
+    expected = mixed_tree()
+    reference.accumulate_field_in_parents(expected, "group_size")
+    actual = mixed_tree()
+    flat_tree.FlatTree(actual).accumulate("group_size")
+    assert dumps(actual) == dumps(expected)
+    # the int branch keeps ints
+    assert dumps(actual["children"][1]["group_size"]) == "3"
+
+
+def test_add_data_to_ontology_equals_recursive_merge():
+    tree, n_nodes = reference.create_synthetic_tree(3, 4)
+    df = reference.create_synthetic_data(200, n_nodes)
+    expected = reference.add_data_to_ontology_recursive(copy.deepcopy(tree), df, "NCBI", "ncbi")
+    actual = json_ontology_extender.add_data_to_ontology(copy.deepcopy(tree), df, "NCBI", "ncbi")
+    assert dumps(actual) == dumps(expected)
+
+
+def test_add_data_to_ontology_with_float_sizes_equals_recursive_merge():
+    tree, n_nodes = reference.create_synthetic_tree(3, 3)
+    df = reference.create_synthetic_data(20, n_nodes)
+    df["matched_size"] = df["matched_size"].astype(float)
+    expected = reference.add_data_to_ontology_recursive(copy.deepcopy(tree), df, "NCBI", "ncbi")
+    actual = json_ontology_extender.add_data_to_ontology(copy.deepcopy(tree), df, "NCBI", "ncbi")
+    assert dumps(actual) == dumps(expected)
+
+
+def test_indexed_merge_equals_scan():
+    tree, n_nodes = reference.create_synthetic_tree(2, 5)
+    df = reference.create_synthetic_data(100, n_nodes)
+    expected = copy.deepcopy(tree)
+    reference.add_data_to_node_by_scan(expected, df, "NCBI", "ncbi")
+    actual = copy.deepcopy(tree)
+    json_ontology_extender.add_data_to_node(actual, df, "NCBI", "ncbi")
+    assert dumps(actual) == dumps(expected)
+
+
+def prune_tree_recursive(node, unmatched_siblings=0, field="matched_size"):
+    # the former recursive prune_tree
+    pruned = dict(node)
+    if "children" not in node:
+        return pruned
+    children = []
+    pruned_children = []
+    kept_unmatched = 0
+    for child in node["children"]:
+        if child.get(field, 0) > 0:
+            children.append(prune_tree_recursive(child, unmatched_siblings, field))
+        elif kept_unmatched < unmatched_siblings:
+            kept_unmatched += 1
+            context_child = dict(child)
+            if "children" in child:
+                del context_child["children"]
+                context_child["pruned_nodes"] = json_ontology_extender.count_nodes(child) - 1
+            children.append(context_child)
+        else:
+            pruned_children.append(child)
+    if len(pruned_children) > 0:
+        children.append(json_ontology_extender.create_pruned_placeholder(pruned_children))
+    pruned["children"] = children
+    return pruned
+
+
+def test_prune_tree_equals_recursive_prune():
+    tree, n_nodes = reference.create_synthetic_tree(4, 4)
+    df = reference.create_synthetic_data(30, n_nodes)
+    # data only for some leaves, the sizes are accumulated in their ancestors
+    df = df[df["ncbi"].astype(int) > n_nodes // 3].drop(columns=["group_size"])
+    tree_root = json_ontology_extender.add_data_to_ontology(tree, df, "NCBI", "ncbi")
+    for unmatched_siblings in (0, 1, 2):
+        expected = prune_tree_recursive(tree_root, unmatched_siblings)
+        actual = json_ontology_extender.prune_tree(tree_root, unmatched_siblings)
+        assert dumps(actual) == dumps(expected)
+        assert actual["children"] is not tree_root["children"]
+
+
+def test_prune_deep_tree():
+    root = node = {"name": "0", "matched_size": 1}
+    for depth in range(1, 5000):
+        child = {"name": str(depth), "matched_size": 1}
+        node["children"] = [child, {"name": "unmatched", "matched_size": 0, "children": [{"name": "leaf"}]}]
+        node = child
+    assert json_ontology_extender.count_nodes(root) == 5000 + 2 * 4999
+    pruned = json_ontology_extender.prune_tree(root)
+    node = pruned
+    while "children" in node:
+        assert node["children"][1]["pruned_nodes"] == 2
+        node = node["children"][0]
+    assert node["name"] == "4999"
+
+
+def class_tree():
+    # CANOPUS ClassyFire ontology: the nodes are identified by their id and have no NCBI field
+    return {"name": "root", "id": "C0", "children": [{"name": "a", "id": "C1", "children": [{"name": "b", "id": "C2"}]},
+                                                      {"name": "c", "id": "C3"}]}
+
+
+def test_other_id_field_does_not_add_ncbi(caplog):
+    counts_df = pd.DataFrame({"id": ["C2", "C3"], "group_size": [2, 1], "matched_size": [1, 1]})
+    merged = json_ontology_extender.add_data_to_ontology(class_tree(), counts_df, "id", "id", id_field="id")
+    assert "NCBI" not in merged and merged["matched_size"] == 2
+    assert not [record for record in caplog.records if record.levelname == "ERROR"]
+
+    # a root without the id is given its name
+    tree = class_tree()
+    del tree["id"]
+    assert json_ontology_extender.add_data_to_ontology(tree, counts_df, "id", "id", id_field="id")["id"] == "root"
+    # by default like the GFOP and microbeMASST trees
+    assert json_ontology_extender.add_data_to_ontology(class_tree(), counts_df, "id", "id")["NCBI"] == "root"
+
+
+def inflate_tree(data):
+    # like inflateTree in collapsible_tree_v3_internal_data.js
+    fields = list(data["columns"])
+    nodes = []
+    for index, parent in enumerate(data["parent"]):
+        node = {field: data["columns"][field][index] for field in fields
+                if data["columns"][field][index] is not None}
+        if node.get("occurrence_fraction") is not None:
+            json_ontology_extender.add_pie_data_to_node(node)
+        nodes.append(node)
+        if parent >= 0:
+            nodes[parent].setdefault("children", []).append(node)
+    return nodes[0]
+
+
+def merged_synthetic_tree():
+    tree, n_nodes = reference.create_synthetic_tree(3, 4)
+    counts_df = reference.create_synthetic_data(30, n_nodes)
+    return json_ontology_extender.add_data_to_ontology(tree, counts_df, "NCBI", "ncbi")
+
+
+def test_compact_json_round_trip():
+    merged = merged_synthetic_tree()
+    data = json.loads(json_ontology_extender.tree_to_compact_json(merged))
+    assert "pie_data" not in data["columns"]
+    assert json.loads(dumps(inflate_tree(data))) == json.loads(dumps(merged))
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="needs node")
+def test_compact_json_round_trip_in_javascript(src_dir, tmp_path):
+    merged = merged_synthetic_tree()
+    script = (src_dir / "collapsible_tree_v3_internal_data.js").read_text()
+    functions = script[script.index("function inflateTree"):script.index("// A recursive helper")]
+    data_file = tmp_path / "data.json"
+    data_file.write_text(json_ontology_extender.tree_to_compact_json(merged))
+    inflate_file = tmp_path / "inflate.js"
+    inflate_file.write_text(functions + "\nconst data = JSON.parse(require('fs').readFileSync({}, 'utf8'));\n"
+                                        "console.log(JSON.stringify(inflateTree(data)));\n".format(
+                                            json.dumps(str(data_file))))
+    inflated = json.loads(subprocess.check_output(["node", str(inflate_file)]))
+    assert inflated == json.loads(dumps(merged))
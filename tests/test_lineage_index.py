@@ -0,0 +1,66 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import lineage_index
+import ontology_binary
+from benchmark_json_ontology_extender import create_synthetic_tree
+
+
+def uneven_tree():
+    # leaves at different depths and a single child chain
+    return {"name": "root", "children": [
+        {"name": "a", "children": [{"name": "a1"}, {"name": "a2", "children": [{"name": "a21"}]}]},
+        {"name": "b", "children": [{"name": "b1", "children": [{"name": "b11", "children": [{"name": "b111"}]}]}]},
+        {"name": "c"},
+    ]}
+
+
+def naive_ancestors(index, node):
+    return [] if node == 0 else [index.parent[node]] + naive_ancestors(index, index.parent[node])
+
+
+def naive_lca(index, first, second):
+    first_path = [first] + naive_ancestors(index, first)
+    return next(node for node in [second] + naive_ancestors(index, second) if node in first_path)
+
+
+def test_lca_and_ancestors_equal_parent_walk():
+    for tree in [uneven_tree(), create_synthetic_tree(3, 3)[0]]:
+        index = lineage_index.LineageIndex.from_tree(tree)
+        pairs = list(itertools.product(range(len(index)), repeat=2))
+        for first, second in pairs:
+            assert index.lca(first, second) == naive_lca(index, first, second)
+            assert index.is_ancestor(first, second) == (first in naive_ancestors(index, second))
+        # vectorized queries
+        first, second = np.array(pairs).T
+        np.testing.assert_array_equal(index.lca(first, second),
+                                      [naive_lca(index, a, b) for a, b in pairs])
+        np.testing.assert_array_equal(index.is_ancestor(first, second),
+                                      [a in naive_ancestors(index, b) for a, b in pairs])
+
+
+def test_lineage_table():
+    index = lineage_index.LineageIndex.from_tree(uneven_tree())
+    table = index.lineage_table()
+    # the top level nodes are the last ancestors
+    assert list(table.columns) == ["leaf", "parent1", "parent2", "parent3"]
+    rows = [[None if pd.isna(value) else value for value in row] for row in table.values.tolist()]
+    assert rows == [["a1", "a", None, None], ["a21", "a2", "a", None], ["b111", "b11", "b1", "b"],
+                    ["c", None, None, None]]
+    assert index.lineage("b111", include_root=True) == ["b111", "b11", "b1", "b", "root"]
+
+    all_nodes = index.lineage_table(leaves_only=False, include_root=True)
+    assert len(all_nodes) == len(index) - 1
+    assert all_nodes.iloc[0, :2].tolist() == ["a", "root"] and all_nodes.iloc[0, 2:].isna().all()
+
+
+def test_binary_ontology_equals_json(tmp_path):
+    tree = create_synthetic_tree(3, 4)[0]
+    out_file = str(tmp_path / ("tree" + ontology_binary.BINARY_SUFFIX))
+    ontology_binary.compile_tree(tree, out_file)
+    compiled = lineage_index.LineageIndex.load(out_file)
+    expected = lineage_index.LineageIndex.from_tree(tree)
+    np.testing.assert_array_equal(compiled.subtree_end, expected.subtree_end)
+    assert compiled.lineage_table().equals(expected.lineage_table())
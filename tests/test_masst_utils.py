@@ -0,0 +1,24 @@
+import pytest
+
+import masst_utils as masst
+
+
+def test_negative_retries_are_rejected():
+    with pytest.raises(ValueError):
+        masst.FastMasstClient("http://127.0.0.1:1/search", max_retries=-1)
+
+
+def test_fast_masst_does_not_retry_by_default(fast_masst_server):
+    assert masst.fast_masst("FAIL", search_url=fast_masst_server.url) is None
+    assert fast_masst_server.requests == ["FAIL"]
+
+    fast_masst_server.requests.clear()
+    assert masst.fast_masst("FAIL", search_url=fast_masst_server.url, max_retries=2) is None
+    assert fast_masst_server.requests == ["FAIL"] * 3
+
+
+def test_search_libraries_skips_matches_without_usi(fast_masst_server):
+    with masst.FastMasstClient(fast_masst_server.url, max_retries=0) as client:
+        result = client.search_libraries("q/a++b", libraries=["gnpsdata_index", "massivekb_index"])
+    assert [match["USI"] for match in result.matches] == ["a", "b"]
+    assert result.matches[0]["libraries"] == ["gnpsdata_index", "massivekb_index"]
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+import metadata_store
+import microbe_masst_results
+
+
+def write_metadata(folder):
+    metadata_file = folder / "metadata.csv"
+    pd.DataFrame({
+        "Filepath": ["f.mzML", "MSV1/ccms_peak/a/b.mzXML", "MSV1/c.mzML", "MSV2/d.mzML", "e"],
+        "MassIVE": ["MSV1", "MSV1", "MSV1", "MSV2", None],
+        "Taxa_NCBI": [1, 2, 2, 3, 4],
+        "Other": ["x", "y", "z", "w", "v"],
+    }).to_csv(metadata_file, index=False)
+    return metadata_file
+
+
+def test_column_round_trip():
+    for values in [pd.Series(["a", np.nan, "b", "a"], dtype=object), pd.Series([3, 1, 3]),
+                   pd.Series([1.5, np.nan, 2.0]), pd.Series(["", ""], dtype=object),
+                   pd.Series([np.nan, np.nan], dtype=object)]:
+        decoded = metadata_store.decode_column(**metadata_store.encode_column(values))
+        pd.testing.assert_series_equal(pd.Series(decoded), values, check_dtype=False)
+
+
+def test_text_columns_are_not_categorical(tmp_path):
+    metadata_file = write_metadata(tmp_path)
+    metadata_df = metadata_store.load_metadata(metadata_file, store_dir=tmp_path / "stores")
+    assert not isinstance(metadata_df["Filepath"].dtype, pd.CategoricalDtype)
+    # unobserved values must not show up as zero counts
+    counts = microbe_masst_results.count_taxa(metadata_df[metadata_df["MassIVE"] == "MSV2"])
+    assert counts["matched_size"].tolist() == [1]
+
+
+def test_store_equals_csv_and_is_written_to_the_store_dir(tmp_path):
+    metadata_file = write_metadata(tmp_path)
+    store_dir = tmp_path / "stores"
+    from_store = metadata_store.load_metadata(metadata_file, store_dir=store_dir)
+    from_csv = microbe_masst_results.read_metadata(metadata_file, use_store=False)
+    pd.testing.assert_frame_equal(from_store, from_csv, check_dtype=False)
+    assert [path.parent for path in tmp_path.rglob("*" + metadata_store.STORE_SUFFIX)] == [store_dir]
@@ -0,0 +1,159 @@
+import json
+import os
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import batch_journal
+import masst_utils as masst
+import microbe_masst_batch
+
+
+class LibraryClient:
+    """
+    Answers search_libraries with fixed matches and errors
+    """
+
+    def __init__(self, matches, errors=()):
+        self.matches = matches
+        self.errors = list(errors)
+
+    def search_libraries(self, usi_or_lib_id, precursor_mz_tol, mz_tol, min_cos, libraries):
+        return masst.FastMasstResult(usi_or_lib_id, ",".join(libraries), self.matches, 1, False, self.errors)
+
+
+def test_partial_library_failure_is_journaled_as_failed(tmp_path):
+    journal = batch_journal.JobJournal(str(tmp_path / "journal.jsonl"))
+    client = LibraryClient([{"USI": "a"}], [masst.FastMasstTimeout("usi", "timeout")])
+    matches = microbe_masst_batch.search_job(client, "usi", 0.05, 0.02, 0.7, journal, "key", ["lib1", "lib2"])
+    assert matches is None
+    state = batch_journal.JobJournal(str(tmp_path / "journal.jsonl")).get("key")
+    assert state["status"] == batch_journal.FAILED
+    assert "matches" not in state
+
+
+def test_matches_without_usi_are_skipped(tmp_path):
+    journal = batch_journal.JobJournal(str(tmp_path / "journal.jsonl"))
+    client = LibraryClient([{"USI": "a"}, {"USI": None}, {"Score": 0.9}])
+    matches = microbe_masst_batch.search_job(client, "usi", 0.05, 0.02, 0.7, journal, "key", ["lib1"])
+    assert matches == ["a"]
+
+
+def test_unique_out_names():
+    jobs_df = pd.DataFrame({"ID": ["u1", "u2", "u3", "u4", "u5", "u6"],
+                            "Compound": ["A", "A_2", "A", np.nan, "B b", "B_b"]})
+    out_names = microbe_masst_batch.unique_out_names(jobs_df)
+    assert list(out_names.values()) == ["A", "A_2", "A_3", "u4", "B b", "B_b_2"]
+    files = {microbe_masst_batch.job_output_html("f", name) for name in out_names.values()}
+    assert len(files) == len(jobs_df)
+
+
+def write_reference_files(folder):
+    ontology = {"name": "root", "NCBI": "0", "children": [
+        {"name": "genus", "NCBI": "1", "children": [
+            {"name": "species a", "NCBI": "2"},
+            {"name": "species b", "NCBI": "3"},
+        ]},
+        {"name": "other", "NCBI": "4"},
+    ]}
+    in_ontology = folder / "ontology.json"
+    in_ontology.write_text(json.dumps(ontology))
+    metadata_file = folder / "metadata.csv"
+    pd.DataFrame({"Filepath": ["MSV1/f1.mzML", "MSV1/f2.mzML", "MSV1/f3.mzML", "MSV1/f4.mzML"],
+                  "MassIVE": ["MSV1"] * 4, "Taxa_NCBI": [2, 2, 3, 4]}).to_csv(metadata_file, index=False)
+    return str(in_ontology), str(metadata_file)
+
+
+@pytest.mark.parametrize("sequential", [True, False])
+def test_run_batch_against_stub(src_dir, tmp_path, fast_masst_server, sequential):
+    in_ontology, metadata_file = write_reference_files(tmp_path)
+    jobs_df = pd.DataFrame({
+        "ID": ["q1/mzspec:MSV1:f1:scan:1+mzspec:MSV1:f3:scan:2", "q2/", "FAIL", "q3/mzspec:MSV1:f4:scan:1"],
+        "Compound": ["first", "no matches", "failed", np.nan]})
+    # job_output_html writes to ../<file_name>_<compound>.html relative to src
+    file_name = os.path.relpath(tmp_path / "out", src_dir.parent)
+    finished_jobs_tsv = str(tmp_path / "finished.tsv")
+
+    def run():
+        return microbe_masst_batch.run_batch(jobs_df, file_name, finished_jobs_tsv, search_workers=2,
+                                             render_workers=1, in_ontology=in_ontology,
+                                             metadata_file=metadata_file, search_url=fast_masst_server.url,
+                                             max_attempts=1, sequential=sequential)
+
+    result = run()
+    trees = result["Tree"].tolist()
+    assert trees[1] == trees[2] == "NO_SUCCESS"
+    assert trees[0] != "NO_SUCCESS" and trees[3] != "NO_SUCCESS"
+    assert sorted(path.name for path in tmp_path.glob("out_*.html")) == ["out_first.html", "out_q3_mzspec_MSV1_f4_scan_1.html"]
+    html = (tmp_path / "out_first.html").read_text()
+    assert "species a" in html
+
+    states = batch_journal.JobJournal(finished_jobs_tsv.replace(".tsv", ".journal.jsonl")).states()
+    assert sorted(state["status"] for state in states.values()) == [batch_journal.DONE, batch_journal.DONE,
+                                                                    batch_journal.FAILED, batch_journal.NO_MATCHES]
+
+    # resume: only the failed job is searched again
+    fast_masst_server.requests.clear()
+    result = run()
+    assert fast_masst_server.requests == ["FAIL"]
+    assert result["Tree"].tolist() == trees
+
+
+def test_resume_renders_again_after_reference_changes_and_expires_no_matches(src_dir, tmp_path, fast_masst_server):
+    in_ontology, metadata_file = write_reference_files(tmp_path)
+    jobs_df = pd.DataFrame({"ID": ["q1/mzspec:MSV1:f1:scan:1", "q2/"], "Compound": ["first", "none"]})
+    file_name = os.path.relpath(tmp_path / "out", src_dir.parent)
+    finished_jobs_tsv = str(tmp_path / "finished.tsv")
+
+    def run(no_matches_expire_after=None):
+        microbe_masst_batch.run_batch(jobs_df, file_name, finished_jobs_tsv, in_ontology=in_ontology,
+                                      metadata_file=metadata_file, search_url=fast_masst_server.url, max_attempts=1,
+                                      sequential=True, no_matches_expire_after=no_matches_expire_after)
+        states = batch_journal.JobJournal(finished_jobs_tsv.replace(".tsv", ".journal.jsonl")).states()
+        return {state["usi"]: state for state in states.values()}
+
+    first = run()
+    first_html = (tmp_path / "out_first.html").read_text()
+    # changed metadata: rendered again without a new search
+    pd.DataFrame({"Filepath": ["MSV1/f1.mzML"], "MassIVE": ["MSV1"], "Taxa_NCBI": [4]}).to_csv(metadata_file,
+                                                                                             index=False)
+    fast_masst_server.requests.clear()
+    second = run()
+    assert fast_masst_server.requests == []
+    assert second["q1/mzspec:MSV1:f1:scan:1"]["render_hash"] != first["q1/mzspec:MSV1:f1:scan:1"]["render_hash"]
+    assert (tmp_path / "out_first.html").read_text() != first_html
+
+    # expired searches without matches are repeated
+    run(no_matches_expire_after=timedelta(days=1))
+    assert fast_masst_server.requests == []
+    run(no_matches_expire_after=timedelta(0))
+    assert fast_masst_server.requests == ["q2/"]
+
+
+@pytest.mark.parametrize("sequential", [True, False])
+def test_unexpected_search_errors_only_fail_their_job(src_dir, tmp_path, fast_masst_server, monkeypatch, sequential):
+    in_ontology, metadata_file = write_reference_files(tmp_path)
+    search_job = microbe_masst_batch.search_job
+
+    def failing_search_job(client, usi_or_lib_id, *args):
+        if usi_or_lib_id == "broken":
+            raise AttributeError("'str' object has no attribute 'get'")
+        return search_job(client, usi_or_lib_id, *args)
+
+    monkeypatch.setattr(microbe_masst_batch, "search_job", failing_search_job)
+    jobs_df = pd.DataFrame({"ID": ["broken", "q1/mzspec:MSV1:f1:scan:1"], "Compound": ["broken", "first"]})
+    file_name = os.path.relpath(tmp_path / "out", src_dir.parent)
+    finished_jobs_tsv = str(tmp_path / "finished.tsv")
+    result = microbe_masst_batch.run_batch(jobs_df, file_name, finished_jobs_tsv, in_ontology=in_ontology,
+                                           metadata_file=metadata_file, search_url=fast_masst_server.url,
+                                           max_attempts=1, sequential=sequential)
+
+    trees = result["Tree"].tolist()
+    assert trees[0] == "NO_SUCCESS" and trees[1] != "NO_SUCCESS"
+    states = batch_journal.JobJournal(finished_jobs_tsv.replace(".tsv", ".journal.jsonl")).states()
+    states = {state["usi"]: state for state in states.values()}
+    assert states["broken"]["status"] == batch_journal.FAILED
+    assert states["broken"]["error"] == "AttributeError"
+    assert states["q1/mzspec:MSV1:f1:scan:1"]["status"] == batch_journal.DONE
@@ -0,0 +1,74 @@
+import pandas as pd
+
+import benchmark_pipeline
+import microbe_masst_results
+
+
+def prepared_metadata():
+    return microbe_masst_results.prepare_metadata(pd.DataFrame({
+        "Filepath": ["MSV1/a.mzML", "MSV1/b.mzML", "MSV2/c.mzXML", "MSV2/d.mzML"],
+        "MassIVE": ["MSV1", "MSV1", "MSV2", "MSV2"],
+        "Taxa_NCBI": [10, 20, 20, 30],
+    }))
+
+
+def test_count_matches_in_file_equals_count_matches(tmp_path):
+    metadata_df = prepared_metadata()
+    masst_df = pd.DataFrame({"filename": ["MSV1/a.mzML", "MSV2/c.mzXML", "MSV1/a.mzML", "MSV9/x.mzML"]})
+    masst_file = tmp_path / "masst.tsv"
+    masst_df.to_csv(masst_file, sep="\t", index=False)
+
+    expected = microbe_masst_results.count_matches(metadata_df, masst_df)
+    actual = microbe_masst_results.count_matches_in_file(metadata_df, masst_file, chunksize=2)
+    pd.testing.assert_frame_equal(actual.sort_values("ncbi").reset_index(drop=True),
+                                  expected.sort_values("ncbi").reset_index(drop=True), check_dtype=False)
+
+
+def test_count_matches_in_file_has_no_unobserved_taxa(tmp_path):
+    metadata_df = prepared_metadata()
+    metadata_df["Taxa_NCBI"] = metadata_df["Taxa_NCBI"].astype("category")
+    masst_file = tmp_path / "masst.tsv"
+    pd.DataFrame({"filename": ["MSV1/a.mzML"]}).to_csv(masst_file, sep="\t", index=False)
+
+    counts = microbe_masst_results.count_matches_in_file(metadata_df, masst_file)
+    assert counts["ncbi"].tolist() == [10]
+    assert counts["matched_size"].tolist() == [1]
+
+
+def count_per_match_row(metadata_df, masst_df):
+    # the former row by row implementation of create_counts_file: every MASST row counts all its metadata rows
+    counts = {}
+    for filename in masst_df["filename"].map(microbe_masst_results.clean_filename):
+        for taxon in metadata_df.loc[metadata_df["Filepath"] == filename, "Taxa_NCBI"]:
+            counts[taxon] = counts.get(taxon, 0) + 1
+    return counts
+
+
+def count_per_usi_file(metadata_df, matching_usi_list):
+    # the former implementation of create_counts_file_from_usi: every matched metadata row counts once
+    counts = {}
+    files = {tuple(usi.split(":")[1:3]) for usi in matching_usi_list}
+    for _, row in metadata_df.iterrows():
+        if (row["MassIVE"], row["fname"]) in files:
+            counts[row["Taxa_NCBI"]] = counts.get(row["Taxa_NCBI"], 0) + 1
+    return counts
+
+
+def as_dict(counts_df):
+    return dict(zip(counts_df["ncbi"].tolist(), counts_df["matched_size"].tolist()))
+
+
+def test_vectorized_counts_equal_row_by_row_counts(tmp_path):
+    metadata_df = benchmark_pipeline.create_synthetic_metadata(300, 40, n_datasets=5)
+    # a file with two taxa
+    metadata_df = pd.concat([metadata_df, metadata_df.iloc[:1].assign(Taxa_NCBI=7)], ignore_index=True)
+    prepared = microbe_masst_results.prepare_metadata(metadata_df)
+
+    masst_file = tmp_path / "masst.tsv"
+    benchmark_pipeline.write_synthetic_masst_file(metadata_df, 200, masst_file)
+    masst_df = pd.read_csv(masst_file, sep="\t")
+    assert as_dict(microbe_masst_results.count_matches_in_file(prepared, masst_file, chunksize=64)) == \
+           count_per_match_row(prepared, masst_df)
+
+    usis = benchmark_pipeline.create_synthetic_usis(metadata_df, 150) + ["mzspec:MSV9:missing:scan:1"]
+    assert as_dict(microbe_masst_results.count_matches_from_usi(prepared, usis)) == count_per_usi_file(prepared, usis)
@@ -0,0 +1,53 @@
+import os
+import json
+
+import numpy as np
+
+import flat_tree
+import json_ontology_extender
+import ontology_binary
+from benchmark_json_ontology_extender import create_synthetic_tree
+
+
+def mixed_tree():
+    # ints, floats, strings, lists, missing values, and different key orders
+    return {"name": "root", "NCBI": "0", "group_size": 3, "children": [
+        {"NCBI": "1", "name": "a", "group_size": 2, "fraction": 0.5, "synonyms": ["x", "y"], "children": [
+            {"name": "a1", "NCBI": "2", "group_size": 2, "fraction": None},
+        ]},
+        {"name": "b", "NCBI": "3", "group_size": 1, "rank": "species", "children": []},
+    ]}
+
+
+def test_round_trip_equals_json(tmp_path):
+    for tree in [mixed_tree(), create_synthetic_tree(3, 4)[0]]:
+        out_file = str(tmp_path / ("tree" + ontology_binary.BINARY_SUFFIX))
+        ontology_binary.compile_tree(tree, out_file)
+        # the same nodes, values, and key order
+        assert json.dumps(ontology_binary.load_tree(out_file)) == json.dumps(tree)
+        assert json.dumps(json_ontology_extender.load_ontology(out_file)) == json.dumps(tree)
+
+
+def test_columns_equal_flat_tree(tmp_path):
+    tree = mixed_tree()
+    out_file = str(tmp_path / ("tree" + ontology_binary.BINARY_SUFFIX))
+    ontology_binary.compile_tree(tree, out_file)
+    compiled = ontology_binary.CompiledOntology(out_file)
+    flat = flat_tree.FlatTree(tree)
+    assert len(compiled) == len(flat)
+    np.testing.assert_array_equal(compiled.parent, flat.parent)
+    np.testing.assert_array_equal(compiled.depth, flat.depth)
+    for field in ["name", "group_size", "fraction", "synonyms", "rank"]:
+        assert compiled.column(field) == flat.columns([field])[field]
+    compiled.close()
+
+
+def test_source_changes_are_detected(tmp_path):
+    source = tmp_path / "tree.json"
+    source.write_text(json.dumps(mixed_tree()))
+    out_file = ontology_binary.compile_ontology(str(source))
+    assert not ontology_binary.CompiledOntology(out_file).is_stale()
+    source.write_text(json.dumps(mixed_tree(), indent=2))
+    mtime_ns = source.stat().st_mtime_ns + 10 ** 9
+    os.utime(source, ns=(mtime_ns, mtime_ns))
+    assert ontology_binary.CompiledOntology(out_file).is_stale()
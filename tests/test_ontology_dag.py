@@ -0,0 +1,80 @@
+import json
+
+import pandas as pd
+
+import ontology_dag
+
+
+def leaf(key, group_size):
+    return {"name": "n{}".format(key), "NCBI": key, "group_size": group_size}
+
+
+def shared_subtree_tree():
+    # taxon 3 with the same subtree under 1 and 2, taxon 6 with different children under 1 and 2
+    return {"name": "root", "NCBI": 0, "children": [
+        {"name": "n1", "NCBI": 1, "children": [
+            {"name": "n3", "NCBI": 3, "children": [leaf(4, 5)]},
+            {"name": "n6", "NCBI": 6, "children": [leaf(7, 1)]},
+        ]},
+        {"name": "n2", "NCBI": 2, "children": [
+            {"name": "n3", "NCBI": 3, "children": [leaf(4, 5)]},
+            {"name": "n6", "NCBI": 6, "children": [leaf(8, 2)]},
+        ]},
+    ]}
+
+
+def test_from_tree_merges_equal_subtrees_only():
+    dag = ontology_dag.OntologyDag.from_tree(shared_subtree_tree())
+    keys = [node["NCBI"] for node in dag.nodes]
+    assert keys.count(3) == 1
+    assert keys.count(4) == 1
+    # different children: separate nodes, each with its own child
+    assert keys.count(6) == 2
+    for index in [index for index, key in enumerate(keys) if key == 6]:
+        assert len(dag.child_lists[index]) == 1
+    assert dag.materialized_size() == 11
+
+
+def test_dag_aggregation_counts_shared_nodes_once():
+    dag = ontology_dag.OntologyDag.from_tree(shared_subtree_tree())
+    counts = pd.DataFrame({"ncbi": ["4", "7", "8"], "matched_size": [2, 1, 1]})
+    ontology_dag.add_data_to_dag(dag, counts, "NCBI", "ncbi", add_pie_data=False)
+    by_key = {}
+    for node in dag.nodes:
+        by_key.setdefault(node["NCBI"], []).append(node)
+    assert by_key[1][0]["group_size"] == 6
+    assert by_key[2][0]["group_size"] == 7
+    assert by_key[3][0]["matched_size"] == 2
+    # the shared subtree is counted once in the root
+    assert dag.nodes[0]["group_size"] == 5 + 1 + 2
+    assert dag.nodes[0]["matched_size"] == 2 + 1 + 1
+    assert by_key[1][0]["occurrence_fraction"] == 3 / 6
+
+
+def test_diamond_is_accumulated_once():
+    # 3 is a child of 1 and 2, both children of the root
+    nodes = [{"name": "root"}, {"name": "1"}, {"name": "2"}, {"name": "3", "group_size": 4}]
+    dag = ontology_dag.OntologyDag(nodes, [[1, 2], [3], [3], []])
+    # pre-order: root, 1, 3, 2
+    assert [node["name"] for node in dag.nodes] == ["root", "1", "3", "2"]
+    assert dag.parent_counts.tolist() == [0, 1, 2, 1]
+    assert dag.accumulate_values([0, None, 4, None]) == [4, 4, 4, 4]
+    assert len(dag.to_tree()["children"][1]["children"]) == 1
+
+
+def test_compact_round_trip():
+    dag = ontology_dag.OntologyDag.from_tree(shared_subtree_tree())
+    copy = ontology_dag.OntologyDag.from_compact(json.loads(dag.to_compact_json()))
+    assert copy.child_lists == dag.child_lists
+    assert copy.nodes == dag.nodes
+    assert json.dumps(copy.to_tree()) == json.dumps(dag.to_tree())
+
+
+def test_other_id_field_does_not_add_ncbi(caplog):
+    tree = {"name": "root", "id": "C0", "children": [{"name": "a", "id": "C1", "children": [{"name": "b", "id": "C2"}]},
+                                                      {"name": "c", "id": "C3"}]}
+    dag = ontology_dag.OntologyDag.from_tree(tree, "id")
+    counts_df = pd.DataFrame({"id": ["C2", "C3"], "matched_size": [1, 1]})
+    ontology_dag.add_data_to_dag(dag, counts_df, "id", "id", id_field="id")
+    assert "NCBI" not in dag.nodes[0] and dag.nodes[0]["matched_size"] == 2
+    assert not [record for record in caplog.records if record.levelname == "ERROR"]
@@ -0,0 +1,64 @@
+import copy
+import json
+
+import pandas as pd
+
+import benchmark_json_ontology_extender as reference
+import json_ontology_extender
+import ontology_matrix
+
+
+def dumps(tree):
+    return json.dumps(tree, cls=json_ontology_extender.NpEncoder)
+
+
+def counts_by_compound(n_nodes):
+    return {"compound {}".format(seed): reference.create_synthetic_data(15, n_nodes, seed=seed)
+            [["ncbi", "matched_size"]] for seed in range(3)}
+
+
+def assert_equal_to_add_data_to_ontology(tree, counts):
+    matrix = ontology_matrix.compute_matrix(tree, counts)
+    for compound, counts_df in counts.items():
+        expected = json_ontology_extender.add_data_to_ontology(copy.deepcopy(tree), counts_df, "NCBI", "ncbi")
+        assert dumps(ontology_matrix.compound_tree(matrix, tree, compound)) == dumps(expected)
+    return matrix
+
+
+def test_matrix_equals_add_data_to_ontology():
+    tree, n_nodes = reference.create_synthetic_tree(3, 4)
+    flat = json_ontology_extender.flat_tree.FlatTree(tree)
+    flat.set_columns({"group_size": list(range(len(flat)))})
+    matrix = assert_equal_to_add_data_to_ontology(tree, counts_by_compound(n_nodes))
+    assert matrix.accumulated_matched_size.all()
+
+
+def test_matrix_uses_the_counts_stored_in_the_ontology():
+    tree, n_nodes = reference.create_synthetic_tree(3, 4)
+    flat = json_ontology_extender.flat_tree.FlatTree(tree)
+    # all nodes have group_size and matched_size, nothing is accumulated
+    flat.set_columns({"group_size": [10] * len(flat), "matched_size": [1] * len(flat)})
+    matrix = assert_equal_to_add_data_to_ontology(tree, counts_by_compound(n_nodes))
+    assert not matrix.accumulated_matched_size.any()
+
+
+def test_report_names_are_safe_and_unique(src_dir, tmp_path):
+    tree, n_nodes = reference.create_synthetic_tree(2, 3)
+    counts = pd.DataFrame({"ncbi": ["1"], "matched_size": [1]})
+    matrix = ontology_matrix.compute_matrix(tree, {"a/b c": counts, "a?b c": counts, "ok": counts})
+    reports = ontology_matrix.export_reports(matrix, tree, str(tmp_path), compress_out_html=False)
+    names = sorted(path.name for path in tmp_path.iterdir())
+    assert names == ["a_b_c.html", "a_b_c_2.html", "ok.html"]
+    assert len(reports) == 3
+
+
+def test_compound_tree_with_other_id_field():
+    tree = {"name": "root", "children": [{"name": "a", "id": "C1"}, {"name": "b", "id": "C2"}]}
+    counts = {"compound": pd.DataFrame({"id": ["C2"], "matched_size": [3]})}
+    matrix = ontology_matrix.compute_matrix(tree, counts, "id", "id")
+    for id_field in ["NCBI", "id"]:
+        expected = json_ontology_extender.add_data_to_ontology(copy.deepcopy(tree), counts["compound"], "id", "id",
+                                                               id_field=id_field)
+        compound_root = ontology_matrix.compound_tree(matrix, tree, "compound", id_field=id_field)
+        assert dumps(compound_root) == dumps(expected)
+        assert compound_root[id_field] == "root"
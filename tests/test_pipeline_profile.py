@@ -0,0 +1,105 @@
+import sys
+import threading
+import tracemalloc
+from unittest import mock
+
+import pipeline_profile
+
+
+def profiled_job(name, profile_file, profile_dir, barrier=None):
+    with pipeline_profile.profile_job("test_job", name, profile_file, profile_dir):
+        with pipeline_profile.stage("allocate"):
+            if barrier is not None:
+                barrier.wait()
+            data = [bytearray(1024) for _ in range(1000)]
+            if barrier is not None:
+                barrier.wait()
+            del data
+
+
+def stage_records(profile_file, stage):
+    return [record for job in pipeline_profile.read_records(profile_file) for record in job["stages"]
+            if record["stage"] == stage]
+
+
+def test_traced_peak_of_a_single_job(tmp_path):
+    profile_file = str(tmp_path / "profile.jsonl")
+    profiled_job("single", profile_file, str(tmp_path / "dumps"))
+    records = stage_records(profile_file, "allocate")
+    assert records[0]["peak_traced_mb"] > 0.5
+
+
+def test_traced_peak_is_not_recorded_for_concurrent_jobs(tmp_path):
+    profile_file = str(tmp_path / "profile.jsonl")
+    barrier = threading.Barrier(2)
+    threads = [threading.Thread(target=profiled_job, args=(name, profile_file, str(tmp_path / "dumps"), barrier))
+               for name in ("first", "second")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    records = stage_records(profile_file, "allocate")
+    assert len(records) == 2
+    assert all("peak_traced_mb" not in record for record in records)
+
+
+def test_without_resource_module(tmp_path, monkeypatch):
+    # the resource module is missing on Windows
+    monkeypatch.setitem(sys.modules, "resource", None)
+    profile_file = str(tmp_path / "profile.jsonl")
+    profiled_job("no_rss", profile_file, None)
+    records = pipeline_profile.read_records(profile_file)
+    assert records[0]["max_rss_mb"] is None
+    summary = pipeline_profile.summarize(records)
+    assert summary["test_job"]["stages"]["allocate"]["max_rss_mb"] is None
+    pipeline_profile.log_summary(summary)
+
+
+def test_concurrent_jobs_share_one_profiler(tmp_path):
+    # Python 3.12+ raises a ValueError if a second cProfile profiler is enabled
+    enabled = []
+    original_enable = pipeline_profile.cProfile.Profile.enable
+
+    class Profile(pipeline_profile.cProfile.Profile):
+        def enable(self):
+            if any(profiler is not self for profiler in enabled):
+                raise ValueError("Another profiling tool is already active")
+            enabled.append(self)
+            original_enable(self)
+
+        def disable(self):
+            # also called by dump_stats
+            super().disable()
+            if self in enabled:
+                enabled.remove(self)
+
+    profile_file = str(tmp_path / "profile.jsonl")
+    # a job that fails before the barrier must not block the other one
+    barrier = threading.Barrier(2, timeout=10)
+    with mock.patch.object(pipeline_profile.cProfile, "Profile", Profile):
+        threads = [threading.Thread(target=profiled_job, args=(name, profile_file, str(tmp_path / "dumps"), barrier))
+                   for name in ("first", "second")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert [record["status"] for record in pipeline_profile.read_records(profile_file)] == ["ok", "ok"]
+    assert len(list((tmp_path / "dumps").glob("*.prof"))) == 1
+    assert len(list((tmp_path / "dumps").glob("*.tracemalloc"))) == 2
+
+
+def test_failed_profiler_start_is_cleaned_up(tmp_path):
+    class Profile:
+        def enable(self):
+            raise ValueError("Another profiling tool is already active")
+
+    profile_file = str(tmp_path / "profile.jsonl")
+    with mock.patch.object(pipeline_profile.cProfile, "Profile", Profile):
+        profiled_job("failed_profiler", profile_file, str(tmp_path / "dumps"))
+    assert pipeline_profile.read_records(profile_file)[0]["status"] == "ok"
+    assert pipeline_profile.running_jobs == 0 and pipeline_profile.tracing_jobs == 0
+    assert not pipeline_profile.profiler_active and not tracemalloc.is_tracing()
+    assert pipeline_profile.current_profile.get() is None
+    # the next job is profiled again
+    profiled_job("profiled", profile_file, str(tmp_path / "dumps"))
+    assert (tmp_path / "dumps" / "test_job_profiled.prof").exists()